@@ -10,12 +10,28 @@ Endpoint para:
 import os
 import json
 import re
+import asyncio
+import hashlib
+import logging
+import random
+import threading
+import time
+import unicodedata
+from collections import Counter
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple
 
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import FastAPI, HTTPException, Header, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
+from common.storage import crear_almacen, json_compacto
+from common.manifiesto import Manifiesto, describir
+from common.limitador import LimitadorVertex, Saturado
+from common.cache_respuestas import CacheRespuestas
+from common.medicion import ALCANCE, Medidor, fijar_alcance
+from common.emociones import TARGET_EMOTIONS
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Config
 PROJECT_ID = os.getenv("AN_PROJECT_ID", "terapia-471517")
@@ -25,25 +41,75 @@ MODEL_ID   = os.getenv("AN_MODEL_ID", "gemini-2.5-flash-lite")
 USE_GCS         = os.getenv("AN_USE_GCS", "true").lower() == "true"
 GCS_BUCKET      = os.getenv("AN_GCS_BUCKET", "ceroooooo")
 GCS_BASE_PREFIX = os.getenv("AN_GCS_BASE_PREFIX", "")  # ej: "prod"
+STORAGE_BACKEND = os.getenv("AN_STORAGE_BACKEND", "gcs").lower()  # "gcs" | "local"
+STORAGE_ROOT    = os.getenv("AN_STORAGE_ROOT", "data_local")     # solo backend local
+
+# Lote: textos cortos se empaquetan en un solo prompt; los largos van solos en paralelo
+BATCH_MAX_ITEMS        = int(os.getenv("AN_BATCH_MAX_ITEMS", "200"))
+BATCH_CONCURRENCY      = int(os.getenv("AN_BATCH_CONCURRENCY", "4"))
+BATCH_PACK_ITEM_TOKENS = int(os.getenv("AN_BATCH_PACK_ITEM_TOKENS", "600"))   # ≤ esto: candidato a empaquetar
+BATCH_PACK_MAX_TOKENS  = int(os.getenv("AN_BATCH_PACK_MAX_TOKENS", "6000"))   # tope de tokens por paquete
+
+# Map-reduce para transcripciones largas
+MR_THRESHOLD_TOKENS = int(os.getenv("AN_MR_THRESHOLD_TOKENS", "3000"))  # > esto: se fragmenta
+MR_CHUNK_TOKENS     = int(os.getenv("AN_MR_CHUNK_TOKENS", "1500"))
+MR_CONCURRENCY      = int(os.getenv("AN_MR_CONCURRENCY", "4"))
+
+# Re-análisis incremental: unidad = párrafo (u oración si el párrafo excede este tope);
+# textos > AN_MR_THRESHOLD_TOKENS usan como unidad los fragmentos del map-reduce
+INC_UNIT_TOKENS = int(os.getenv("AN_INC_UNIT_TOKENS", "250"))
+
+# Clasificador local (léxico + NumPy) con escalamiento a Gemini
+LOCAL_MODE         = os.getenv("AN_LOCAL_MODE", "auto")        # auto | gemini | local
+LOCAL_THRESHOLD    = float(os.getenv("AN_LOCAL_THRESHOLD", "0.6"))
+LOCAL_MAX_TOKENS   = int(os.getenv("AN_LOCAL_MAX_TOKENS", "200"))  # textos más largos van directo a Gemini
+LOCAL_FULL_HITS    = int(os.getenv("AN_LOCAL_FULL_HITS", "3"))     # aciertos léxicos para confianza plena
+LOCAL_SHADOW_RATE  = float(os.getenv("AN_LOCAL_SHADOW_RATE", "0.05"))  # % de respuestas locales comparadas con Gemini
+LOCAL_LEXICON_PATH = os.getenv("AN_LOCAL_LEXICON_PATH", "")      # JSON {emocion: [raices]} opcional
+# Por org: {"org_123": {"modo": "local", "umbral": 0.5}}
+LOCAL_ORGS = json.loads(os.getenv("AN_LOCAL_ORGS", "{}") or "{}")
+
+# Admisión de llamadas a Vertex: tokens/minuto + concurrencia, cola con deadline
+LIMIT_TPM            = int(os.getenv("AN_LIMIT_TPM", "400000"))
+LIMIT_CONCURRENCY    = int(os.getenv("AN_LIMIT_CONCURRENCY", "16"))
+LIMIT_QUEUE          = int(os.getenv("AN_LIMIT_QUEUE", "64"))
+LIMIT_DEADLINE_S     = float(os.getenv("AN_LIMIT_DEADLINE_S", "20"))
+LIMIT_OUTPUT_TOKENS  = int(os.getenv("AN_LIMIT_OUTPUT_TOKENS", "400"))   # salida esperada por llamada
+LIMIT_RETRY_AFTER_S  = int(os.getenv("AN_LIMIT_RETRY_AFTER_S", "5"))     # si Vertex mismo responde 429
+
+# Caché de respuestas del modelo (determinista: misma entrada + modelo + plantilla → misma salida)
+CACHE_ENABLED   = os.getenv("AN_CACHE_ENABLED", "true").lower() == "true"
+CACHE_TIER      = os.getenv("AN_CACHE_TIER", "memoria")      # memoria | disco | gcs ({org_id}/_cache/)
+CACHE_DIR       = os.getenv("AN_CACHE_DIR", "/tmp/an_cache")
+CACHE_MAX_ITEMS = int(os.getenv("AN_CACHE_MAX_ITEMS", "2048"))
+CACHE_TTL_S     = float(os.getenv("AN_CACHE_TTL_S", str(30 * 24 * 3600)))
+PROMPT_VERSION  = os.getenv("AN_PROMPT_VERSION", "1")        # súbelo al cambiar las plantillas de prompt
+
+# Medición de tokens/costo por llamada
+METER_SINK        = os.getenv("AN_METER_SINK", "gcs" if USE_GCS else "none")  # gcs | bigquery | none
+METER_BQ_TABLE    = os.getenv("AN_METER_BQ_TABLE", "")     # proyecto.dataset.tabla (obligatoria con sink bigquery)
+METER_BATCH       = int(os.getenv("AN_METER_BATCH", "200"))
+METER_FLUSH_S     = float(os.getenv("AN_METER_FLUSH_S", "60"))
+METER_MAX_PENDING = int(os.getenv("AN_METER_MAX_PENDING", "20000"))
+# USD por 1M tokens; sobreescribible con JSON {"modelo": {"entrada": x, "salida": y}}
+METER_PRICES = json.loads(os.getenv("AN_METER_PRICES", "") or json.dumps({
+    "gemini-2.5-flash-lite": {"entrada": 0.10, "salida": 0.40},
+    "gemini-2.5-flash":      {"entrada": 0.30, "salida": 2.50},
+}))
+
+logger = logging.getLogger(__name__)
+
+# Almacenamiento compartido (cliente perezoso)
+ALMACEN = crear_almacen(GCS_BUCKET, GCS_BASE_PREFIX, PROJECT_ID, STORAGE_BACKEND, STORAGE_ROOT)
+MANIFIESTO = Manifiesto(ALMACEN)  # índice por sesión (sessions/{session_id}/manifest.json)
 
 # Lazy singletons (evitar fallas en import-time)
-_storage_client = None
 _vertex_inited  = False
 _model          = None
 
 def _ts() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
 
-def _prefix() -> str:
-    return f"{GCS_BASE_PREFIX.strip('/')}/" if GCS_BASE_PREFIX else ""
-
-def get_storage_client():
-    global _storage_client
-    if _storage_client is None:
-        from google.cloud import storage
-        _storage_client = storage.Client(project=PROJECT_ID)
-    return _storage_client
-
 def ensure_vertex_model():
     """Inicializa Vertex AI y devuelve el modelo (lazy)."""
     global _vertex_inited, _model
@@ -59,27 +125,42 @@ def upload_json_to_gcs(org_id: str, doctor_uid: str, patient_id: str,
                        session_id: str, note_id: str, data: Dict[str, Any]) -> str:
     if not USE_GCS:
         raise HTTPException(status_code=500, detail="GCS no habilitado en Analysis.")
-    client = get_storage_client()
-    bucket = client.bucket(GCS_BUCKET)
-    fname = f"analisis_{_ts()}.json"
-    path = f"{_prefix()}{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/derived/analisis/{note_id}/{fname}"
-    blob = bucket.blob(path)
-    blob.upload_from_string(json.dumps(data, ensure_ascii=False, indent=4), content_type="application/json")
-    return f"gs://{GCS_BUCKET}/{path}"
+    path = ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, "derived", "analisis", note_id, f"analisis_{_ts()}.json")
+    return ALMACEN.put_json(path, data)
+
+def upload_batch_json_to_gcs(org_id: str, doctor_uid: str, patient_id: str, data: Dict[str, Any]) -> str:
+    """Un solo objeto por lote (puede abarcar varias sesiones del paciente)."""
+    if not USE_GCS:
+        raise HTTPException(status_code=500, detail="GCS no habilitado en Analysis.")
+    path = ALMACEN.ruta_paciente(org_id, doctor_uid, patient_id, "derived", "analisis_lote", f"lote_{_ts()}.json")
+    return ALMACEN.put_json(path, data)
+
+def cache_parrafos_path(org_id: str, doctor_uid: str, patient_id: str, session_id: str, note_id: str) -> str:
+    return ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, "derived", "analisis", note_id, "cache_parrafos.json")
+
+def leer_cache_parrafos(path: str) -> Dict[str, Any]:
+    """{huella: resultado}. Best-effort: si no existe o es de otro modelo o versión de prompt
+    (AN_PROMPT_VERSION), caché vacía: todo se vuelve a analizar."""
+    if not USE_GCS:
+        return {}
+    try:
+        data = ALMACEN.get_json(path)
+    except Exception:
+        return {}
+    if data.get("modelo") != MODEL_ID or data.get("prompt_version") != PROMPT_VERSION:
+        return {}
+    return data.get("parrafos", {})
+
+def guardar_cache_parrafos(path: str, parrafos: Dict[str, Any]) -> None:
+    if not USE_GCS:
+        return
+    ALMACEN.put_json(path, {"modelo": MODEL_ID, "prompt_version": PROMPT_VERSION, "actualizado": _ts(),
+                            "parrafos": parrafos})
 
 def download_gcs_text(uri: str) -> str:
     if not uri or not uri.startswith("gs://"):
         raise HTTPException(status_code=400, detail="gcs_uri inválido")
-    _, rest = uri.split("gs://", 1)
-    bucket_name, blob_path = rest.split("/", 1)
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    return blob.download_as_text(encoding="utf-8")
-
-TARGET_EMOTIONS = [
-    "alegria","tristeza","enojo","miedo","sorpresa","disgusto","estres","calma","aversión","anticipación"
-]
+    return ALMACEN.get_text(uri)
 
 def limpiar_json(data: Dict[str, Any]) -> Dict[str, Any]:
     out: Dict[str, Any] = {}
@@ -95,6 +176,443 @@ def limpiar_json(data: Dict[str, Any]) -> Dict[str, Any]:
             out[emocion] = {"porcentaje": pct, "entidades": entidades}
     return out
 
+def construir_prompt(texto: str) -> str:
+    return f"""
+Analiza el siguiente texto y extrae estas emociones: {', '.join(TARGET_EMOTIONS)}.
+Para cada emoción encontrada, asigna un porcentaje (0-100) e identifica entidades relacionadas.
+
+Texto: {texto}
+
+Devuelve SOLO un JSON con el formato:
+{{
+  "emocion": {{
+    "porcentaje": 85.5,
+    "entidades": ["entidad1","entidad2"]
+  }}
+}}
+""".strip()
+
+def construir_prompt_paquete(textos: Dict[str, str]) -> str:
+    """Varios textos cortos en un solo prompt; la respuesta viene indexada por id."""
+    return f"""
+Analiza CADA uno de los siguientes textos por separado y extrae estas emociones: {', '.join(TARGET_EMOTIONS)}.
+Para cada emoción encontrada en cada texto, asigna un porcentaje (0-100) e identifica entidades relacionadas.
+
+Textos (JSON, la clave es el id del texto):
+{json.dumps(textos, ensure_ascii=False)}
+
+Devuelve SOLO un JSON con un objeto por id (incluye TODOS los ids), con el formato:
+{{
+  "id": {{
+    "emocion": {{
+      "porcentaje": 85.5,
+      "entidades": ["entidad1","entidad2"]
+    }}
+  }}
+}}
+""".strip()
+
+# Admisión de llamadas a Vertex (ver common/limitador.py)
+LIMITADOR = LimitadorVertex(LIMIT_TPM, LIMIT_CONCURRENCY, LIMIT_QUEUE, LIMIT_DEADLINE_S,
+                            "Servicio de análisis saturado, reintenta más tarde.")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Caché determinista de respuestas del modelo
+# ──────────────────────────────────────────────────────────────────────────────
+CACHE = CacheRespuestas("analisis", CACHE_MAX_ITEMS, CACHE_TTL_S, CACHE_TIER, modelo=MODEL_ID,
+                        version_prompt=PROMPT_VERSION, habilitada=CACHE_ENABLED, dir_disco=CACHE_DIR,
+                        almacen=ALMACEN if USE_GCS else None)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Medición de tokens/costo por llamada a Gemini
+# ──────────────────────────────────────────────────────────────────────────────
+# (ver common/medicion.py; el alcance de la solicitud se fija con fijar_alcance)
+MEDIDOR = Medidor("analisis", METER_SINK, METER_BATCH, modelo=MODEL_ID, precios=METER_PRICES, flush_s=METER_FLUSH_S,
+                  max_pendientes=METER_MAX_PENDING, bq_tabla=METER_BQ_TABLE, proyecto=PROJECT_ID,
+                  almacen=ALMACEN if USE_GCS else None)
+
+async def generar(model, prompt: str, operacion: str = "analisis") -> Dict[str, Any]:
+    """
+    generate_content_async (salida JSON) detrás del limitador, con caché por huella del
+    prompt completo (plantilla + texto). Se cachea el JSON ya parseado.
+    Cada llamada real al modelo queda medida (tokens, latencia, costo, alcance).
+    """
+    async def _llamar() -> Dict[str, Any]:
+        async with LIMITADOR.admitir(estimar_tokens(prompt) + LIMIT_OUTPUT_TOKENS):
+            try:
+                t0 = time.perf_counter()
+                response = await model.generate_content_async(
+                    prompt,
+                    generation_config={"response_mime_type": "application/json"}
+                )
+                MEDIDOR.registrar(operacion, response, (time.perf_counter() - t0) * 1000)
+            except Exception as e:
+                # google.api_core.exceptions.ResourceExhausted: Vertex mismo nos limitó
+                if type(e).__name__ in ("ResourceExhausted", "TooManyRequests"):
+                    raise Saturado(LIMIT_RETRY_AFTER_S, "Vertex AI limitó la solicitud (429).")
+                raise
+        return parsear_respuesta(response)
+
+    return await CACHE.obtener_o_calcular(CACHE.clave(prompt), _llamar, org_id=ALCANCE.get().get("org_id"),
+                                          cacheable=lambda v: isinstance(v, dict))
+
+async def mapear(fn, items, limite: int) -> list:
+    """asyncio.gather con a lo más `limite` corrutinas activas (abanico por solicitud)."""
+    sem = asyncio.Semaphore(limite)
+
+    async def _uno(x):
+        async with sem:
+            return await fn(x)
+
+    return await asyncio.gather(*[_uno(x) for x in items])
+
+def parsear_respuesta(response) -> Dict[str, Any]:
+    raw = ""
+    if response and getattr(response, "candidates", None):
+        raw = response.candidates[0].content.parts[0].text.strip()
+
+    # Intentar parsear como JSON puro; si no, usa regex como respaldo
+    try:
+        return json.loads(raw)
+    except Exception:
+        m = re.search(r"\{.*\}", raw, re.DOTALL)
+        if not m:
+            raise HTTPException(status_code=500, detail="No se encontró JSON en la respuesta del modelo.")
+        return json.loads(m.group())
+
+async def analizar_texto(model, texto: str) -> Dict[str, Any]:
+    """Una llamada a Gemini → emociones limpias."""
+    return limpiar_json(await generar(model, construir_prompt(texto)))
+
+async def analizar_paquete(model, textos: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+    """Una llamada para varios textos. Solo devuelve los ids que el modelo respondió bien."""
+    parsed = await generar(model, construir_prompt_paquete(textos), operacion="analisis_paquete")
+    return {k: limpiar_json(v) for k, v in parsed.items() if k in textos and isinstance(v, dict)}
+
+def estimar_tokens(texto: str) -> int:
+    # ~4 caracteres por token en español es suficiente para decidir empaquetado
+    return len(texto) // 4 + 1
+
+def empaquetar(textos: Dict[str, str], max_tokens: int) -> List[Dict[str, str]]:
+    """Agrupa textos (en orden) en paquetes de hasta ~max_tokens."""
+    paquetes: List[Dict[str, str]] = []
+    actual: Dict[str, str] = {}
+    tokens_actual = 0
+    for clave, texto in textos.items():
+        tk = estimar_tokens(texto)
+        if actual and tokens_actual + tk > max_tokens:
+            paquetes.append(actual)
+            actual, tokens_actual = {}, 0
+        actual[clave] = texto
+        tokens_actual += tk
+    if actual:
+        paquetes.append(actual)
+    return paquetes
+
+async def analizar_paquete_con_respaldo(model, textos: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+    """Paquete con ids cortos; lo que el modelo omita (o si falla) se analiza individualmente."""
+    if len(textos) == 1:
+        clave, texto = next(iter(textos.items()))
+        return {clave: await analizar_texto(model, texto)}
+    alias = {f"t{i}": clave for i, clave in enumerate(textos)}
+    try:
+        parcial = await analizar_paquete(model, {a: textos[c] for a, c in alias.items()})
+    except Saturado:
+        raise
+    except Exception:
+        parcial = {}
+    out = {alias[a]: r for a, r in parcial.items()}
+    for clave, texto in textos.items():
+        if clave not in out:
+            out[clave] = await analizar_texto(model, texto)
+    return out
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Map-reduce: fragmentar → analizar en paralelo → combinar
+# ──────────────────────────────────────────────────────────────────────────────
+_RE_PARRAFOS  = re.compile(r"\n\s*\n")
+_RE_ORACIONES = re.compile(r"(?<=[.!?…])\s+")
+
+def _unidades(texto: str, max_tokens: int) -> List[str]:
+    """Párrafos; si uno excede el tope, sus oraciones; si una oración excede, corte duro."""
+    max_chars = max_tokens * 4
+    out: List[str] = []
+    for parrafo in _RE_PARRAFOS.split(texto):
+        parrafo = parrafo.strip()
+        if not parrafo:
+            continue
+        if len(parrafo) <= max_chars:
+            out.append(parrafo)
+            continue
+        for oracion in _RE_ORACIONES.split(parrafo):
+            oracion = oracion.strip()
+            while len(oracion) > max_chars:
+                out.append(oracion[:max_chars])
+                oracion = oracion[max_chars:]
+            if oracion:
+                out.append(oracion)
+    return out
+
+def dividir_en_fragmentos(texto: str, max_tokens: int = MR_CHUNK_TOKENS) -> List[str]:
+    """
+    Agrupa párrafos/oraciones consecutivos hasta ~max_tokens por fragmento.
+    Pasada la mitad del tope, también se corta tras una unidad cuya huella cae en 1 de cada 4:
+    los cortes dependen del contenido, así que editar un párrafo solo cambia su fragmento
+    (y a lo sumo el siguiente) en lugar de desplazar todos los cortes posteriores.
+    """
+    fragmentos: List[str] = []
+    actual: List[str] = []
+    tokens_actual = 0
+    for u in _unidades(texto, max_tokens):
+        tk = estimar_tokens(u)
+        if actual and tokens_actual + tk > max_tokens:
+            fragmentos.append("\n\n".join(actual))
+            actual, tokens_actual = [], 0
+        actual.append(u)
+        tokens_actual += tk
+        if tokens_actual >= max_tokens // 2 and int(clave_unidad(u)[:8], 16) % 4 == 0:
+            fragmentos.append("\n\n".join(actual))
+            actual, tokens_actual = [], 0
+    if actual:
+        fragmentos.append("\n\n".join(actual))
+    return fragmentos
+
+def huella(texto: str) -> str:
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+def clave_unidad(texto: str) -> str:
+    """Clave de caché de un párrafo/fragmento: huella con espacios normalizados."""
+    return huella(" ".join(texto.split()))
+
+def combinar_resultados(parciales: List[Tuple[int, Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Reduce: porcentaje ponderado por longitud (un fragmento sin la emoción cuenta como 0)
+    y entidades sin duplicados (ignorando mayúsculas), en orden de aparición.
+    """
+    total = sum(peso for peso, _ in parciales) or 1
+    out: Dict[str, Any] = {}
+    for emocion in TARGET_EMOTIONS:
+        acumulado = 0.0
+        entidades: List[str] = []
+        vistas = set()
+        presente = False
+        for peso, res in parciales:
+            datos = res.get(emocion)
+            if not datos:
+                continue
+            presente = True
+            acumulado += float(datos.get("porcentaje", 0.0)) * peso
+            for ent in datos.get("entidades", []):
+                clave = ent.strip().lower()
+                if clave and clave not in vistas:
+                    vistas.add(clave)
+                    entidades.append(ent.strip())
+        if presente:
+            out[emocion] = {"porcentaje": round(acumulado / total, 2), "entidades": entidades}
+    return out
+
+async def analizar_texto_largo(
+    model, texto: str, cache: Optional[Dict[str, Any]] = None
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Map en paralelo (AN_MR_CONCURRENCY) sobre fragmentos + reduce. Con `cache` ({clave: resultado})
+    solo se analizan los fragmentos que no están. Devuelve (combinado, fragmentos, caché_vigente).
+    """
+    cache = cache or {}
+    fragmentos = dividir_en_fragmentos(texto)
+    claves = [clave_unidad(f) for f in fragmentos]
+    faltantes: Dict[str, str] = {}
+    for clave, f in zip(claves, fragmentos):
+        if clave not in cache:
+            faltantes.setdefault(clave, f)
+    resultados = await mapear(lambda f: analizar_texto(model, f), list(faltantes.values()), MR_CONCURRENCY)
+    nuevos = dict(zip(faltantes, resultados))
+
+    vigente = {clave: cache[clave] if clave in cache else nuevos[clave] for clave in claves}
+    detalle = [
+        {"indice": i, "caracteres": len(f), "sha256": huella(f), "resultado": vigente[c], "desde_cache": c in cache}
+        for i, (f, c) in enumerate(zip(fragmentos, claves))
+    ]
+    combinado = combinar_resultados([(len(f), vigente[c]) for f, c in zip(fragmentos, claves)])
+    return combinado, detalle, vigente
+
+async def analizar_incremental(
+    model, texto: str, cache: Dict[str, Any]
+) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any], Optional[List[Dict[str, Any]]]]:
+    """
+    Divide en unidades con huella estable; solo las nuevas o cambiadas van a Gemini.
+    Devuelve (combinado, caché_actualizada, stats, fragmentos). La caché resultante contiene
+    solo las unidades del texto actual.
+      - texto corto: párrafos, empaquetados y en paralelo (fragmentos = None)
+      - texto > AN_MR_THRESHOLD_TOKENS: fragmentos del map-reduce, cada uno en su llamada
+    """
+    if estimar_tokens(texto) > MR_THRESHOLD_TOKENS:
+        combinado, detalle, vigente = await analizar_texto_largo(model, texto, cache)
+        total_chars = sum(d["caracteres"] for d in detalle) or 1
+        stats = {
+            "unidad": "fragmento",
+            "parrafos": len(detalle),
+            "parrafos_desde_cache": sum(1 for d in detalle if d["desde_cache"]),
+            "fraccion_cache": round(sum(d["caracteres"] for d in detalle if d["desde_cache"]) / total_chars, 4),
+            "llamadas_modelo": len({c for c in vigente if c not in cache}),
+        }
+        return combinado, vigente, stats, detalle
+
+    unidades = _unidades(texto, INC_UNIT_TOKENS)
+    claves = [clave_unidad(u) for u in unidades]
+
+    faltantes: Dict[str, str] = {}
+    for clave, u in zip(claves, unidades):
+        if clave not in cache:
+            faltantes.setdefault(clave, u)
+
+    paquetes = empaquetar(faltantes, BATCH_PACK_MAX_TOKENS)
+    nuevos: Dict[str, Any] = {}
+    for parcial in await mapear(lambda p: analizar_paquete_con_respaldo(model, p), paquetes, MR_CONCURRENCY):
+        nuevos.update(parcial)
+
+    # Un resultado vacío ({}: párrafo sin emociones) también es un acierto de caché
+    vigente = {clave: cache[clave] if clave in cache else nuevos[clave] for clave in claves}
+    combinado = combinar_resultados([(len(u), vigente[c]) for u, c in zip(unidades, claves)])
+
+    total_chars = sum(len(u) for u in unidades) or 1
+    chars_cache = sum(len(u) for u, c in zip(unidades, claves) if c in cache)
+    stats = {
+        "unidad": "parrafo",
+        "parrafos": len(unidades),
+        "parrafos_desde_cache": sum(1 for c in claves if c in cache),
+        "fraccion_cache": round(chars_cache / total_chars, 4) if unidades else 0.0,
+        "llamadas_modelo": len(paquetes),
+    }
+    return combinado, vigente, stats, None
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Clasificador local: léxico de raíces en español, puntuación vectorizada con NumPy.
+# Responde al instante si está seguro; si no, se escala a Gemini.
+# ──────────────────────────────────────────────────────────────────────────────
+LEXICO_EMOCIONES: Dict[str, List[str]] = {
+    "alegria":      ["feliz", "felic", "alegr", "content", "disfrut", "encant", "entusias", "animad",
+                     "sonri", "divert", "orgull", "satisf", "agradec", "placer", "ilusion"],
+    "tristeza":     ["trist", "llor", "deprim", "melancol", "desanim", "soledad", "vacio", "pena",
+                     "duelo", "extrañ", "nostalg", "desesper", "abatid", "decaid"],
+    "enojo":        ["enoj", "enfad", "ira", "rabia", "furi", "molest", "irrit", "colera", "odi",
+                     "frustr", "indign", "resent", "coraje"],
+    "miedo":        ["miedo", "temor", "teme", "asust", "panic", "terror", "pavor", "aterr",
+                     "insegur", "fobi", "amenaz"],
+    "sorpresa":     ["sorpr", "asombr", "inesper", "impact", "increibl", "desconcert", "imprevist"],
+    "disgusto":     ["disgust", "desagrad", "decepcion", "insatisf", "descontent", "fastid"],
+    "estres":       ["estres", "ansie", "agobi", "presion", "nervios", "tension", "tens", "preocup",
+                     "abrum", "insomn", "saturad", "agotad"],
+    "calma":        ["calm", "tranquil", "relaj", "seren", "paz", "sosieg", "descans", "equilibr"],
+    "aversión":     ["asco", "repugn", "repuls", "aversion", "rechaz", "nause", "asquer"],
+    "anticipación": ["espera", "expect", "anticip", "planea", "esperanz", "deseand", "impacien", "futuro"],
+}
+_NEGACIONES = {"no", "nunca", "sin", "tampoco", "ni", "jamas"}
+_RE_PALABRAS = re.compile(r"[a-zñ]+")
+
+def _normalizar(texto: str) -> str:
+    """Minúsculas y sin acentos, conservando la ñ."""
+    descompuesto = unicodedata.normalize("NFKD", texto.lower())
+    sin_acentos = "".join(c for c in descompuesto if not unicodedata.combining(c) or c == "\u0303")
+    return unicodedata.normalize("NFC", sin_acentos)
+
+class ClasificadorLocal:
+    """Matriz raíz×emoción (V×E); un texto se puntúa como bincount(raíces) @ W."""
+
+    def __init__(self, lexico: Dict[str, List[str]]):
+        import numpy as np
+        self.np = np
+        raices = sorted({_normalizar(r) for rs in lexico.values() for r in rs})
+        self.indice = {r: i for i, r in enumerate(raices)}
+        self.largos = sorted({len(r) for r in raices}, reverse=True)
+        self.W = np.zeros((len(raices), len(TARGET_EMOTIONS)), dtype=np.float32)
+        for emocion, rs in lexico.items():
+            if emocion in TARGET_EMOTIONS:
+                for r in rs:
+                    self.W[self.indice[_normalizar(r)], TARGET_EMOTIONS.index(emocion)] = 1.0
+
+    def _raiz(self, palabra: str) -> Optional[int]:
+        for n in self.largos:
+            if n <= len(palabra):
+                i = self.indice.get(palabra[:n])
+                if i is not None:
+                    return i
+        return None
+
+    def clasificar(self, texto: str) -> Tuple[Dict[str, Any], float]:
+        """Devuelve (resultado con el formato de Gemini, confianza 0-1)."""
+        np = self.np
+        palabras = _RE_PALABRAS.findall(_normalizar(texto))
+        idx = []
+        for k, palabra in enumerate(palabras):
+            i = self._raiz(palabra)
+            # "no estoy triste" no cuenta para tristeza
+            if i is not None and not _NEGACIONES.intersection(palabras[max(0, k - 2):k]):
+                idx.append(i)
+        if not idx:
+            return {}, 0.0
+        conteo = np.bincount(np.asarray(idx), minlength=self.W.shape[0]).astype(np.float32)
+        puntajes = conteo @ self.W
+        dist = puntajes / puntajes.sum()
+        confianza = float(dist.max()) * min(1.0, len(idx) / LOCAL_FULL_HITS)
+        resultado = {
+            TARGET_EMOTIONS[e]: {"porcentaje": round(float(dist[e]) * 100, 2), "entidades": []}
+            for e in np.flatnonzero(puntajes)
+        }
+        return resultado, confianza
+
+_clasificador_local = None
+
+def get_clasificador_local() -> ClasificadorLocal:
+    global _clasificador_local
+    if _clasificador_local is None:
+        lexico = LEXICO_EMOCIONES
+        if LOCAL_LEXICON_PATH:
+            with open(LOCAL_LEXICON_PATH, encoding="utf-8") as f:
+                lexico = json.load(f)
+        _clasificador_local = ClasificadorLocal(lexico)
+    return _clasificador_local
+
+def config_local(org_id: str) -> Tuple[str, float]:
+    cfg = LOCAL_ORGS.get(org_id, {})
+    return cfg.get("modo", LOCAL_MODE), float(cfg.get("umbral", LOCAL_THRESHOLD))
+
+def comparar_resultados(local: Dict[str, Any], remoto: Dict[str, Any]) -> Tuple[bool, float]:
+    """(misma emoción dominante, diferencia media absoluta en puntos porcentuales)."""
+    def top(r):
+        return max(r, key=lambda e: r[e]["porcentaje"]) if r else None
+    dif = sum(
+        abs(local.get(e, {}).get("porcentaje", 0.0) - remoto.get(e, {}).get("porcentaje", 0.0))
+        for e in TARGET_EMOTIONS
+    ) / len(TARGET_EMOTIONS)
+    return top(local) == top(remoto), dif
+
+STATS_LOCAL = {
+    "solicitudes": 0, "respondidas_local": 0, "escaladas": 0,
+    "latencia_local_ms": 0.0, "latencia_gemini_ms": 0.0, "llamadas_gemini": 0,
+    "comparaciones": 0, "coincidencias_top": 0, "diferencia_media_total": 0.0,
+}
+_stats_lock = threading.Lock()
+
+def _registrar(**valores):
+    with _stats_lock:
+        for k, v in valores.items():
+            STATS_LOCAL[k] += v
+
+def registrar_comparacion(local: Dict[str, Any], remoto: Dict[str, Any]) -> None:
+    coincide, dif = comparar_resultados(local, remoto)
+    _registrar(comparaciones=1, coincidencias_top=int(coincide), diferencia_media_total=dif)
+
+async def comparar_en_sombra(texto: str, local: Dict[str, Any]) -> None:
+    """Muestra de respuestas locales también enviadas a Gemini (background) para medir acuerdo."""
+    try:
+        t0 = time.perf_counter()
+        remoto = await analizar_texto(ensure_vertex_model(), texto)
+        _registrar(llamadas_gemini=1, latencia_gemini_ms=(time.perf_counter() - t0) * 1000)
+        registrar_comparacion(local, remoto)
+    except Exception:
+        pass
+
 # ──────────────────────────────────────────────────────────────────────────────
 
 app = FastAPI(title="API Análisis de Emociones (texto o gcs_uri)")
@@ -106,14 +624,58 @@ class TextoEntrada(BaseModel):
     patient_id: str
     session_id: str
     note_id: str
+    # Reutiliza resultados por párrafo de análisis previos de esta misma nota
+    incremental: bool = False
+
+class ItemLote(BaseModel):
+    note_id: str
+    texto: Optional[str] = None
+    gcs_uri: Optional[str] = None
+    session_id: Optional[str] = None  # default: session_id del lote
+
+class LoteEntrada(BaseModel):
+    org_id: str
+    patient_id: str
+    session_id: Optional[str] = None
+    items: List[ItemLote]
+
+@app.on_event("startup")
+async def _iniciar_medicion():
+    app.state.tarea_medicion = asyncio.create_task(MEDIDOR.bucle())
+
+@app.on_event("shutdown")
+async def _cerrar_medicion():
+    app.state.tarea_medicion.cancel()
+    await run_in_threadpool(MEDIDOR.enviar)
 
 @app.get("/health")
 def health():
     return {"ok": True}
 
+@app.get("/metrics")
+def metrics():
+    """Contadores del clasificador local para ajustar AN_LOCAL_THRESHOLD."""
+    with _stats_lock:
+        s = dict(STATS_LOCAL)
+    return {
+        "clasificador_local": {
+            **s,
+            "fraccion_local": round(s["respondidas_local"] / s["solicitudes"], 4) if s["solicitudes"] else None,
+            "latencia_local_ms_media": round(s["latencia_local_ms"] / s["solicitudes"], 3) if s["solicitudes"] else None,
+            "latencia_gemini_ms_media": round(s["latencia_gemini_ms"] / s["llamadas_gemini"], 1) if s["llamadas_gemini"] else None,
+            "acuerdo_top": round(s["coincidencias_top"] / s["comparaciones"], 4) if s["comparaciones"] else None,
+            "diferencia_media_pp": round(s["diferencia_media_total"] / s["comparaciones"], 2) if s["comparaciones"] else None,
+        },
+        "limitador_vertex": LIMITADOR.estado(),
+        "cache_respuestas": CACHE.estado(),
+        "medicion": MEDIDOR.estado(),
+        "almacenamiento": ALMACEN.metricas.estado(),
+    }
+
 @app.post("/analizar_emociones")
-def analizar_emociones(
+async def analizar_emociones(
     entrada: TextoEntrada,
+    background_tasks: BackgroundTasks,
     user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
 ):
     """
@@ -123,62 +685,74 @@ def analizar_emociones(
     Guarda SOLO en GCS (si AN_USE_GCS=true).
     """
     try:
+        fijar_alcance(entrada.org_id, user_id or "_public", entrada.session_id, entrada.note_id)
         if not entrada.texto and not entrada.gcs_uri:
             raise HTTPException(status_code=400, detail="Debes enviar 'texto' o 'gcs_uri'.")
 
         # Cargar texto
-        texto = entrada.texto if entrada.texto is not None else download_gcs_text(entrada.gcs_uri)
+        texto = entrada.texto if entrada.texto is not None else await run_in_threadpool(download_gcs_text, entrada.gcs_uri)
 
-        # Modelo Gemini (lazy)
-        model = ensure_vertex_model()
+        # Vía rápida: clasificador local para textos cortos; si no está seguro se escala
+        modo, umbral = config_local(entrada.org_id)
+        local, confianza = None, None
+        if modo != "gemini" and estimar_tokens(texto) <= LOCAL_MAX_TOKENS:
+            t0 = time.perf_counter()
+            local, confianza = get_clasificador_local().clasificar(texto)
+            _registrar(solicitudes=1, latencia_local_ms=(time.perf_counter() - t0) * 1000)
 
-        prompt = f"""
-Analiza el siguiente texto y extrae estas emociones: {', '.join(TARGET_EMOTIONS)}.
-Para cada emoción encontrada, asigna un porcentaje (0-100) e identifica entidades relacionadas.
+        doctor_uid = user_id or "_public"
+        t0 = time.perf_counter()
+        if local is not None and (modo == "local" or confianza >= umbral):
+            _registrar(respondidas_local=1)
+            if random.random() < LOCAL_SHADOW_RATE:
+                background_tasks.add_task(comparar_en_sombra, texto, local)
+            result = {"mensaje": "Análisis completado", "resultado": local}
+        elif entrada.incremental:
+            # Modelo Gemini (lazy)
+            model = ensure_vertex_model()
+            # Solo párrafos (o, en textos largos, fragmentos del map-reduce) nuevos/cambiados van
+            # al modelo; el resto sale de la caché de la nota, que este mismo análisis deja
+            # lista para las ediciones posteriores (/guardar_nota)
+            path_cache = cache_parrafos_path(entrada.org_id, doctor_uid, entrada.patient_id,
+                                             entrada.session_id, entrada.note_id)
+            cache = await run_in_threadpool(leer_cache_parrafos, path_cache)
+            cleaned, vigente, stats, fragmentos = await analizar_incremental(model, texto, cache)
+            if set(vigente) != set(cache):
+                await run_in_threadpool(guardar_cache_parrafos, path_cache, vigente)
+            result = {"mensaje": "Análisis completado", "resultado": cleaned, "cache": stats}
+            if fragmentos is not None:
+                result["fragmentos"] = fragmentos
+        # Textos largos con incremental=false: map-reduce por fragmentos, sin caché de la nota
+        elif estimar_tokens(texto) > MR_THRESHOLD_TOKENS:
+            cleaned, fragmentos, _ = await analizar_texto_largo(ensure_vertex_model(), texto)
+            result = {"mensaje": "Análisis completado", "resultado": cleaned, "fragmentos": fragmentos}
+        else:
+            # Pedimos salida JSON
+            cleaned = await analizar_texto(ensure_vertex_model(), texto)
+            result = {"mensaje": "Análisis completado", "resultado": cleaned}
 
-Texto: {texto}
-
-Devuelve SOLO un JSON con el formato:
-{{
-  "emocion": {{
-    "porcentaje": 85.5,
-    "entidades": ["entidad1","entidad2"]
-  }}
-}}
-""".strip()
-
-        # Pedimos salida JSON
-        response = model.generate_content(
-            prompt,
-            generation_config={"response_mime_type": "application/json"}
-        )
-
-        raw = ""
-        if response and getattr(response, "candidates", None):
-            raw = response.candidates[0].content.parts[0].text.strip()
-
-        # Intentar parsear como JSON puro; si no, usa regex como respaldo
-        try:
-            parsed = json.loads(raw)
-        except Exception:
-            m = re.search(r"\{.*\}", raw, re.DOTALL)
-            if not m:
-                raise HTTPException(status_code=500, detail="No se encontró JSON en la respuesta del modelo.")
-            parsed = json.loads(m.group())
-
-        cleaned = limpiar_json(parsed)
-
-        result = {"mensaje": "Análisis completado", "resultado": cleaned}
+        if local is not None:
+            result["motor"] = "local" if result["resultado"] is local else "gemini"
+            result["confianza_local"] = round(confianza, 4)
+            if result["motor"] == "gemini":
+                _registrar(escaladas=1, llamadas_gemini=1, latencia_gemini_ms=(time.perf_counter() - t0) * 1000)
+                registrar_comparacion(local, result["resultado"])
 
         # Guardar SOLO en GCS
-        gcs_path = upload_json_to_gcs(
+        gcs_path = await run_in_threadpool(
+            upload_json_to_gcs,
             org_id=entrada.org_id,
-            doctor_uid=user_id or "_public",
+            doctor_uid=doctor_uid,
             patient_id=entrada.patient_id,
             session_id=entrada.session_id,
             note_id=entrada.note_id,
             data=result
         ) if USE_GCS else None
+        if gcs_path:
+            await run_in_threadpool(
+                MANIFIESTO.registrar_seguro, entrada.org_id, doctor_uid, entrada.patient_id, entrada.session_id,
+                [describir(gcs_path, json_compacto(result), content_type="application/json", nota=entrada.note_id)],
+            )
 
         return {**result, "archivo_guardado_gcs": gcs_path}
 
@@ -186,3 +760,118 @@ Devuelve SOLO un JSON con el formato:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/analizar_emociones/lote")
+async def analizar_emociones_lote(
+    entrada: LoteEntrada,
+    user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
+):
+    """
+    Analiza muchos textos en una sola petición.
+      - Textos cortos (≤ AN_BATCH_PACK_ITEM_TOKENS) se empaquetan varios por prompt.
+      - Textos largos van con una llamada propia.
+      - Todas las llamadas corren en paralelo con máximo AN_BATCH_CONCURRENCY a la vez
+        (y pasan por el limitador global de Vertex).
+    Si un paquete falla o el modelo omite ids, esos textos se reintentan individualmente.
+    Devuelve resultado o error por note_id y escribe UN solo JSON del lote en GCS.
+    """
+    if not entrada.items:
+        raise HTTPException(status_code=400, detail="El lote está vacío.")
+    if len(entrada.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BATCH_MAX_ITEMS} textos por lote.")
+    # Los resultados se indexan por note_id: un id repetido pisaría el resultado del otro
+    repetidos = sorted(nid for nid, n in Counter(it.note_id for it in entrada.items).items() if n > 1)
+    if repetidos:
+        raise HTTPException(status_code=400, detail=f"note_id repetido en el lote: {', '.join(repetidos)}")
+
+    model = ensure_vertex_model()
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+    fijar_alcance(entrada.org_id, user_id or "_public", entrada.session_id)
+    resultados: Dict[str, Dict[str, Any]] = {}
+
+    async def _llamar(fn, *args):
+        async with sem:
+            return await fn(*args)
+
+    # 1) Cargar textos (los gcs_uri en paralelo)
+    async def _cargar(item: ItemLote) -> Optional[str]:
+        try:
+            if item.texto is not None:
+                return item.texto
+            if item.gcs_uri:
+                return await _llamar(run_in_threadpool, download_gcs_text, item.gcs_uri)
+            raise HTTPException(status_code=400, detail="Debes enviar 'texto' o 'gcs_uri'.")
+        except HTTPException as e:
+            resultados[item.note_id] = {"ok": False, "error": e.detail}
+        except Exception as e:
+            resultados[item.note_id] = {"ok": False, "error": str(e)}
+        return None
+
+    textos = await asyncio.gather(*[_cargar(it) for it in entrada.items])
+    pendientes = {it.note_id: t for it, t in zip(entrada.items, textos) if t is not None}
+
+    # 2) Empaquetar cortos (por tokens); los largos van solos
+    cortos = {nid: t for nid, t in pendientes.items() if estimar_tokens(t) <= BATCH_PACK_ITEM_TOKENS}
+    individuales: List[str] = [nid for nid in pendientes if nid not in cortos]
+    paquetes = empaquetar(cortos, BATCH_PACK_MAX_TOKENS)
+    # Un paquete de un solo texto es simplemente una llamada individual
+    individuales += [next(iter(p)) for p in paquetes if len(p) == 1]
+    paquetes = [p for p in paquetes if len(p) > 1]
+
+    async def _individual(note_id: str):
+        # Cada corrutina del gather tiene su propia copia del contexto
+        fijar_alcance(entrada.org_id, user_id or "_public", entrada.session_id, note_id)
+        try:
+            resultados[note_id] = {"ok": True, "resultado": await _llamar(analizar_texto, model, pendientes[note_id])}
+        except HTTPException as e:
+            resultados[note_id] = {"ok": False, "error": e.detail}
+        except Exception as e:
+            resultados[note_id] = {"ok": False, "error": str(e)}
+
+    async def _paquete(textos_paquete: Dict[str, str]):
+        # Ids cortos en el prompt: menos tokens y menos riesgo de que el modelo los altere
+        alias = {f"t{i}": nid for i, nid in enumerate(textos_paquete)}
+        try:
+            parcial = await _llamar(analizar_paquete, model, {a: textos_paquete[nid] for a, nid in alias.items()})
+        except Saturado as e:
+            for nid in alias.values():
+                resultados[nid] = {"ok": False, "error": e.detail}
+            return
+        except Exception:
+            parcial = {}
+        faltantes = []
+        for a, nid in alias.items():
+            if a in parcial:
+                resultados[nid] = {"ok": True, "resultado": parcial[a]}
+            else:
+                faltantes.append(nid)
+        await asyncio.gather(*[_individual(nid) for nid in faltantes])
+
+    await asyncio.gather(
+        *[_individual(nid) for nid in individuales],
+        *[_paquete(p) for p in paquetes],
+    )
+
+    items_out = [
+        {"note_id": it.note_id, "session_id": it.session_id or entrada.session_id, **resultados.get(it.note_id, {"ok": False, "error": "sin resultado"})}
+        for it in entrada.items
+    ]
+    result = {
+        "mensaje": "Análisis por lote completado",
+        "total": len(items_out),
+        "ok": sum(1 for r in items_out if r["ok"]),
+        "llamadas_modelo": len(individuales) + len(paquetes),
+        "items": items_out,
+    }
+
+    # Guardar SOLO en GCS: una escritura para todo el lote
+    gcs_path = None
+    if USE_GCS:
+        try:
+            gcs_path = await run_in_threadpool(
+                upload_batch_json_to_gcs, entrada.org_id, user_id or "_public", entrada.patient_id, result
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error guardando el lote en GCS: {e}")
+
+    return {**result, "archivo_guardado_gcs": gcs_path}
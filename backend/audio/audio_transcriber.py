@@ -1,11 +1,27 @@
+import io
 import os
+import hashlib
 import json
+import asyncio
+import logging
+import tempfile
+import threading
+import time
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Form, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from common.storage import crear_almacen, json_compacto
+from common.manifiesto import Manifiesto, describir
+from common.contenido import guardar_raw
+from common.limitador import LimitadorVertex, Saturado
+from common.cache_respuestas import CacheRespuestas
+from common.medicion import ALCANCE, Medidor, fijar_alcance
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Config
 PROJECT_ID = os.getenv("AUDIO_PROJECT_ID", "terapia-471517")
@@ -15,18 +31,87 @@ MODEL_ID   = os.getenv("AUDIO_MODEL_ID", "gemini-2.5-flash")
 USE_GCS         = os.getenv("AUDIO_USE_GCS", "true").lower() == "true"
 GCS_BUCKET      = os.getenv("AUDIO_GCS_BUCKET", "ceroooooo")
 GCS_BASE_PREFIX = os.getenv("AUDIO_GCS_BASE_PREFIX", "")  # ej: "prod"
+STORAGE_BACKEND = os.getenv("AUDIO_STORAGE_BACKEND", "gcs").lower()  # "gcs" | "local"
+STORAGE_ROOT    = os.getenv("AUDIO_STORAGE_ROOT", "data_local")     # solo backend local
+RAW_DEDUP       = os.getenv("AUDIO_RAW_DEDUP", "true").lower() == "true"  # raw/ direccionado por SHA-256
+
+# Segmentación de audios largos (cortes en silencios, transcripción en paralelo)
+CHUNK_ENABLED      = os.getenv("AUDIO_CHUNK_ENABLED", "true").lower() == "true"
+CHUNK_THRESHOLD_S  = float(os.getenv("AUDIO_CHUNK_THRESHOLD_S", "360"))  # solo se segmenta por encima de esto
+CHUNK_MAX_S        = float(os.getenv("AUDIO_CHUNK_MAX_S", "300"))
+CHUNK_MIN_S        = float(os.getenv("AUDIO_CHUNK_MIN_S", "60"))
+CHUNK_CONCURRENCY  = int(os.getenv("AUDIO_CHUNK_CONCURRENCY", "4"))
+CHUNK_RETRIES      = int(os.getenv("AUDIO_CHUNK_RETRIES", "2"))
+SILENCE_MIN_MS     = int(os.getenv("AUDIO_SILENCE_MIN_MS", "700"))
+SILENCE_REL_DB     = float(os.getenv("AUDIO_SILENCE_REL_DB", "16"))  # dB por debajo del promedio del audio
+
+# Preprocesamiento: VAD (recorta silencios largos) + mono 16 kHz + códec compacto
+PREPROCESS_ENABLED = os.getenv("AUDIO_PREPROCESS", "true").lower() == "true"
+PRE_CODEC          = os.getenv("AUDIO_PRE_CODEC", "opus").lower()   # "opus" | "flac"
+PRE_OPUS_BITRATE   = os.getenv("AUDIO_PRE_OPUS_BITRATE", "24k")
+VAD_AGGRESSIVENESS = int(os.getenv("AUDIO_VAD_AGGRESSIVENESS", "2"))  # 0-3 (webrtcvad)
+VAD_MAX_GAP_MS     = int(os.getenv("AUDIO_VAD_MAX_GAP_MS", "1500"))   # pausas más largas se recortan...
+VAD_KEEP_GAP_MS    = int(os.getenv("AUDIO_VAD_KEEP_GAP_MS", "300"))   # ...a esta duración
+VAD_PAD_MS         = int(os.getenv("AUDIO_VAD_PAD_MS", "150"))
+
+# Modo de entrada al modelo:
+#   "bytes": el audio se descarga/lee en memoria (permite preprocesar y segmentar).
+#   "uri":   el audio va a Gemini por referencia gs:// (Part.from_uri); las subidas se
+#            escriben a GCS en streaming resumible desde el spool en disco. La memoria
+#            no depende de la duración, pero no hay preprocesamiento ni segmentación.
+AUDIO_INPUT_MODE   = os.getenv("AUDIO_INPUT_MODE", "bytes").lower()
+UPLOAD_CHUNK_BYTES = int(os.getenv("AUDIO_UPLOAD_CHUNK_MB", "8")) * 1024 * 1024  # múltiplo de 256 KiB
+
+# Transcripción en vivo por WebSocket (ventanas deslizantes)
+STREAM_WINDOW_S = float(os.getenv("AUDIO_STREAM_WINDOW_S", "30"))  # audio nuevo mínimo para cerrar un segmento
+STREAM_TICK_S   = float(os.getenv("AUDIO_STREAM_TICK_S", "10"))    # cada cuánto se procesa lo recibido
+STREAM_PARTIALS = os.getenv("AUDIO_STREAM_PARTIALS", "true").lower() == "true"
+
+# Admisión de llamadas a Vertex: tokens/minuto + concurrencia, cola con deadline
+LIMIT_TPM           = int(os.getenv("AUDIO_LIMIT_TPM", "1000000"))
+LIMIT_CONCURRENCY   = int(os.getenv("AUDIO_LIMIT_CONCURRENCY", "8"))
+LIMIT_QUEUE         = int(os.getenv("AUDIO_LIMIT_QUEUE", "32"))
+LIMIT_DEADLINE_S    = float(os.getenv("AUDIO_LIMIT_DEADLINE_S", "60"))
+LIMIT_RETRY_AFTER_S = int(os.getenv("AUDIO_LIMIT_RETRY_AFTER_S", "10"))    # si Vertex mismo responde 429
+TOKENS_PER_AUDIO_S  = int(os.getenv("AUDIO_TOKENS_PER_S", "32"))           # tokenización de audio de Gemini
+LIMIT_DEFAULT_S     = float(os.getenv("AUDIO_LIMIT_DEFAULT_S", "600"))     # duración supuesta si no se conoce
+LIMIT_OUTPUT_TOKENS = int(os.getenv("AUDIO_LIMIT_OUTPUT_TOKENS", "2000"))
+
+# Caché de transcripciones (misma huella de audio + modelo + prompt → misma salida)
+CACHE_ENABLED   = os.getenv("AUDIO_CACHE_ENABLED", "true").lower() == "true"
+CACHE_TIER      = os.getenv("AUDIO_CACHE_TIER", "memoria")      # memoria | disco | gcs ({org_id}/_cache/)
+CACHE_DIR       = os.getenv("AUDIO_CACHE_DIR", "/tmp/audio_cache")
+CACHE_MAX_ITEMS = int(os.getenv("AUDIO_CACHE_MAX_ITEMS", "256"))
+CACHE_TTL_S     = float(os.getenv("AUDIO_CACHE_TTL_S", str(30 * 24 * 3600)))
+PROMPT_VERSION  = os.getenv("AUDIO_PROMPT_VERSION", "1")        # súbelo al cambiar TRANSCRIPTION_PROMPT
+
+# Medición de tokens/costo por llamada
+METER_SINK        = os.getenv("AUDIO_METER_SINK", "gcs" if USE_GCS else "none")  # gcs | bigquery | none
+METER_BQ_TABLE    = os.getenv("AUDIO_METER_BQ_TABLE", "")     # proyecto.dataset.tabla (obligatoria con sink bigquery)
+METER_BATCH       = int(os.getenv("AUDIO_METER_BATCH", "100"))
+METER_FLUSH_S     = float(os.getenv("AUDIO_METER_FLUSH_S", "60"))
+METER_MAX_PENDING = int(os.getenv("AUDIO_METER_MAX_PENDING", "20000"))
+# USD por 1M tokens (entrada = tarifa de audio); sobreescribible con JSON {"modelo": {"entrada": x, "salida": y}}
+METER_PRICES = json.loads(os.getenv("AUDIO_METER_PRICES", "") or json.dumps({
+    "gemini-2.5-flash":      {"entrada": 1.00, "salida": 2.50},
+    "gemini-2.5-flash-lite": {"entrada": 0.30, "salida": 0.40},
+}))
+
+TRANSCRIPTION_PROMPT = "Transcribe el audio a texto en español. Devuelve SOLO la transcripción."
+
+logger = logging.getLogger(__name__)
+
+# Almacenamiento compartido (cliente perezoso)
+ALMACEN = crear_almacen(GCS_BUCKET, GCS_BASE_PREFIX, PROJECT_ID, STORAGE_BACKEND, STORAGE_ROOT)
+MANIFIESTO = Manifiesto(ALMACEN)  # índice por sesión (sessions/{session_id}/manifest.json)
 
 # Lazy singletons para evitar fallas en import-time
-_storage_client = None
 _vertex_inited = False
 _model = None
 
 def _ts() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
 
-def _prefix() -> str:
-    return f"{GCS_BASE_PREFIX.strip('/')}/" if GCS_BASE_PREFIX else ""
-
 def guess_mime(filename: str, fallback: str) -> str:
     low = (filename or "").lower()
     if low.endswith(".m4a"): return "audio/mp4"
@@ -36,13 +121,6 @@ def guess_mime(filename: str, fallback: str) -> str:
     if low.endswith(".webm"): return "audio/webm"
     return fallback
 
-def get_storage_client():
-    global _storage_client
-    if _storage_client is None:
-        from google.cloud import storage
-        _storage_client = storage.Client(project=PROJECT_ID)
-    return _storage_client
-
 def ensure_vertex_model():
     """Inicializa Vertex AI y devuelve el modelo (lazy)."""
     global _vertex_inited, _model
@@ -54,39 +132,345 @@ def ensure_vertex_model():
         _vertex_inited = True
     return _model
 
-def gcs_upload_bytes(org_id: str, doctor_uid: str, patient_id: str, session_id: str,
-                     subfolder: str, filename: str, content: bytes, content_type: str) -> str:
+def gcs_upload_raw(org_id: str, doctor_uid: str, patient_id: str, session_id: str, note_id: str,
+                   filename: str, content_type: str, content: Optional[bytes] = None, fileobj=None) -> Dict[str, Any]:
+    """
+    Audio crudo desde bytes o desde un file-like (subida resumible por chunks, sin cargarlo en memoria).
+    Con AUDIO_RAW_DEDUP el SHA-256 se calcula antes de subir y un audio repetido no se transfiere.
+    Devuelve la entrada de manifiesto; los bytes quedan en entrada["contenido"].
+    """
     if not USE_GCS:
         raise HTTPException(status_code=500, detail="GCS no habilitado en Audio Transcriber.")
-    client = get_storage_client()
-    bucket = client.bucket(GCS_BUCKET)
-    path = f"{_prefix()}{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/{subfolder}/{filename}"
-    blob = bucket.blob(path)
-    blob.upload_from_string(content, content_type=content_type)
-    return f"gs://{GCS_BUCKET}/{path}"
+    return guardar_raw(ALMACEN, org_id, doctor_uid, patient_id, session_id, note_id, filename, content_type,
+                       data=content, fileobj=fileobj, dedup=RAW_DEDUP, chunk_size=UPLOAD_CHUNK_BYTES)
 
 def gcs_upload_json(org_id: str, doctor_uid: str, patient_id: str, session_id: str,
                     note_id: str, data: Dict[str, Any]) -> str:
     if not USE_GCS:
         raise HTTPException(status_code=500, detail="GCS no habilitado en Audio Transcriber.")
-    client = get_storage_client()
-    bucket = client.bucket(GCS_BUCKET)
-    fname = f"transcripcion_{_ts()}.json"
-    path = f"{_prefix()}{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/derived/transcription/{note_id}/{fname}"
-    blob = bucket.blob(path)
-    blob.upload_from_string(json.dumps(data, ensure_ascii=False, indent=4), content_type="application/json")
-    return f"gs://{GCS_BUCKET}/{path}"
+    path = ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, "derived", "transcription", note_id,
+                        f"transcripcion_{_ts()}.json")
+    return ALMACEN.put_json(path, data)
 
 def download_gcs_bytes(uri: str) -> bytes:
     """gs://bucket/path -> bytes"""
     if not uri.startswith("gs://"):
         raise HTTPException(status_code=400, detail="gcs_uri inválido")
-    _, rest = uri.split("gs://", 1)
-    bucket_name, blob_path = rest.split("/", 1)
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    return blob.download_as_bytes()
+    return ALMACEN.get_bytes(uri)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Limitador de Vertex (API async): admisión explícita en vez del tope implícito del threadpool
+# (ver common/limitador.py)
+LIMITADOR = LimitadorVertex(LIMIT_TPM, LIMIT_CONCURRENCY, LIMIT_QUEUE, LIMIT_DEADLINE_S,
+                            "Servicio de transcripción saturado, reintenta más tarde.")
+
+async def generar_transcripcion(model, audio_part, segundos: Optional[float], clave: Optional[str] = None,
+                                operacion: str = "transcripcion") -> str:
+    """
+    generate_content_async detrás del limitador; los tokens se estiman por duración del audio.
+    Con `clave` (huella del audio) la transcripción no vacía se cachea.
+    """
+    async def _llamar() -> str:
+        tokens = int((segundos if segundos is not None else LIMIT_DEFAULT_S) * TOKENS_PER_AUDIO_S) + LIMIT_OUTPUT_TOKENS
+        async with LIMITADOR.admitir(tokens):
+            try:
+                t0 = time.perf_counter()
+                resp = await model.generate_content_async(
+                    [audio_part, TRANSCRIPTION_PROMPT], generation_config={"response_mime_type": "text/plain"}
+                )
+                MEDIDOR.registrar(operacion, resp, (time.perf_counter() - t0) * 1000,
+                                  segundos_audio=round(segundos, 2) if segundos is not None else None)
+            except Exception as e:
+                # google.api_core.exceptions.ResourceExhausted: Vertex mismo nos limitó
+                if type(e).__name__ in ("ResourceExhausted", "TooManyRequests"):
+                    raise Saturado(LIMIT_RETRY_AFTER_S, "Vertex AI limitó la solicitud (429).")
+                raise
+        return (resp.candidates[0].content.parts[0].text or "").strip() if resp and resp.candidates else ""
+
+    if clave is None:
+        return await _llamar()
+    return await CACHE.obtener_o_calcular(clave, _llamar, org_id=ALCANCE.get().get("org_id"))
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Caché determinista de respuestas del modelo
+# ──────────────────────────────────────────────────────────────────────────────
+CACHE = CacheRespuestas("audio", CACHE_MAX_ITEMS, CACHE_TTL_S, CACHE_TIER, modelo=MODEL_ID,
+                        version_prompt=PROMPT_VERSION, habilitada=CACHE_ENABLED, dir_disco=CACHE_DIR,
+                        almacen=ALMACEN if USE_GCS else None)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Medición de tokens/costo por llamada a Gemini
+# ──────────────────────────────────────────────────────────────────────────────
+# (ver common/medicion.py; el alcance de la solicitud se fija con fijar_alcance)
+MEDIDOR = Medidor("audio", METER_SINK, METER_BATCH, modelo=MODEL_ID, precios=METER_PRICES, flush_s=METER_FLUSH_S,
+                  max_pendientes=METER_MAX_PENDING, bq_tabla=METER_BQ_TABLE, proyecto=PROJECT_ID,
+                  almacen=ALMACEN if USE_GCS else None)
+
+def huella_gcs(uri: str) -> Optional[str]:
+    """crc32c del objeto (una lectura de metadatos); None si no se puede obtener."""
+    try:
+        meta = ALMACEN.metadatos(uri)
+        version = meta and (meta["crc32c"] or meta["generation"])
+        return f"{uri}#{version}" if version else None
+    except Exception:
+        return None
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Transcripción (una llamada o por segmentos)
+
+async def transcribir_bytes(model, audio_bytes: bytes, mime: str, segundos: Optional[float] = None,
+                            cachear: bool = True) -> str:
+    """Una sola llamada a Gemini con el audio completo."""
+    from vertexai.generative_models import Part
+    audio_part = Part.from_data(data=audio_bytes, mime_type=mime)
+    clave = CACHE.clave(TRANSCRIPTION_PROMPT, mime, hashlib.sha256(audio_bytes).hexdigest()) if cachear else None
+    return await generar_transcripcion(model, audio_part, segundos, clave,
+                                       operacion="transcripcion" if cachear else "transcripcion_parcial")
+
+async def transcribir_uri(model, uri: str, mime: str, segundos: Optional[float] = None) -> str:
+    """Una sola llamada a Gemini referenciando el audio en GCS (sin pasar los bytes por el servicio)."""
+    from vertexai.generative_models import Part
+    audio_part = Part.from_uri(uri=uri, mime_type=mime)
+    # La huella incluye el crc32c: si el objeto se reescribe, la clave cambia
+    huella = await run_in_threadpool(huella_gcs, uri) if CACHE_ENABLED else None
+    clave = CACHE.clave(TRANSCRIPTION_PROMPT, mime, huella) if huella else None
+    return await generar_transcripcion(model, audio_part, segundos, clave)
+
+def cargar_audio(audio_bytes: bytes, mime: str):
+    """
+    Decodifica con pydub/ffmpeg a mono 16 kHz (suficiente para voz y ~10x menos RAM que
+    estéreo 44.1 kHz). Devuelve None si no hay decoder disponible o el formato falla.
+    """
+    try:
+        from pydub import AudioSegment
+    except ImportError:
+        return None
+    # Archivo temporal: m4a/mp4 necesita seek (moov al final) y ffmpeg no puede por pipe
+    with tempfile.NamedTemporaryFile(suffix=".audio") as tmp:
+        tmp.write(audio_bytes)
+        tmp.flush()
+        try:
+            return AudioSegment.from_file(tmp.name, parameters=["-ac", "1", "-ar", "16000"])
+        except Exception as e:
+            logger.warning(f"[audio] No se pudo decodificar el audio ({mime}): {e}")
+            return None
+
+def puntos_de_corte(audio) -> List[Tuple[int, int]]:
+    """
+    Devuelve [(inicio_ms, fin_ms), ...] con segmentos de CHUNK_MIN_S..CHUNK_MAX_S.
+    Cada corte cae en el último silencio dentro de la ventana permitida; si no hay
+    silencio, se corta duro en CHUNK_MAX_S.
+    """
+    from pydub.silence import detect_silence
+
+    total = len(audio)
+    max_ms, min_ms = int(CHUNK_MAX_S * 1000), int(CHUNK_MIN_S * 1000)
+    # Detección sobre una copia mono 8 kHz: mucho más rápida y suficiente para silencios
+    probe = audio.set_channels(1).set_frame_rate(8000)
+    thresh = (probe.dBFS if probe.dBFS != float("-inf") else -60) - SILENCE_REL_DB
+    silencios = [(a + b) // 2 for a, b in detect_silence(probe, min_silence_len=SILENCE_MIN_MS, silence_thresh=thresh, seek_step=50)]
+
+    segmentos: List[Tuple[int, int]] = []
+    cursor = 0
+    while total - cursor > max_ms:
+        candidatos = [m for m in silencios if cursor + min_ms <= m <= cursor + max_ms]
+        corte = candidatos[-1] if candidatos else cursor + max_ms
+        segmentos.append((cursor, corte))
+        cursor = corte
+    segmentos.append((cursor, total))
+    return segmentos
+
+def codificar(segmento) -> Tuple[bytes, str]:
+    """Codifica a Opus (ogg) o FLAC según AUDIO_PRE_CODEC. Devuelve (bytes, mime)."""
+    buf = io.BytesIO()
+    if PRE_CODEC == "flac":
+        segmento.export(buf, format="flac")
+        return buf.getvalue(), "audio/flac"
+    segmento.export(buf, format="ogg", codec="libopus", bitrate=PRE_OPUS_BITRATE)
+    return buf.getvalue(), "audio/ogg"
+
+# Mapa de tiempos tras el recorte: [(orig_inicio_ms, orig_fin_ms, proc_inicio_ms), ...]
+MapaTiempos = List[Tuple[int, int, int]]
+
+def detectar_voz(audio) -> List[Tuple[int, int]]:
+    """
+    Intervalos [(inicio_ms, fin_ms)] con voz. Usa webrtcvad (frames de 30 ms) si está
+    instalado; si no, cae a detección por energía de pydub.
+    """
+    try:
+        import webrtcvad
+    except ImportError:
+        from pydub.silence import detect_nonsilent
+        thresh = (audio.dBFS if audio.dBFS != float("-inf") else -60) - SILENCE_REL_DB
+        return [tuple(r) for r in detect_nonsilent(audio, min_silence_len=VAD_MAX_GAP_MS, silence_thresh=thresh, seek_step=20)]
+
+    vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+    pcm = audio.set_channels(1).set_frame_rate(16000).set_sample_width(2).raw_data
+    frame_ms = 30
+    frame_bytes = 16000 * frame_ms // 1000 * 2
+    intervalos: List[Tuple[int, int]] = []
+    inicio = None
+    for i, off in enumerate(range(0, len(pcm) - frame_bytes + 1, frame_bytes)):
+        voz = vad.is_speech(pcm[off:off + frame_bytes], 16000)
+        if voz and inicio is None:
+            inicio = i * frame_ms
+        elif not voz and inicio is not None:
+            intervalos.append((inicio, i * frame_ms))
+            inicio = None
+    if inicio is not None:
+        intervalos.append((inicio, len(audio)))
+    return intervalos
+
+def recortar_silencios(audio) -> Tuple[Any, MapaTiempos]:
+    """
+    Une los tramos de voz separados por menos de VAD_MAX_GAP_MS y reemplaza las pausas
+    más largas por VAD_KEEP_GAP_MS de silencio. Si no se detecta voz, no recorta nada.
+    """
+    from pydub import AudioSegment
+
+    total = len(audio)
+    tramos: List[List[int]] = []
+    for a, b in detectar_voz(audio):
+        a, b = max(0, a - VAD_PAD_MS), min(total, b + VAD_PAD_MS)
+        if tramos and a - tramos[-1][1] < VAD_MAX_GAP_MS:
+            tramos[-1][1] = max(tramos[-1][1], b)
+        else:
+            tramos.append([a, b])
+    if not tramos:
+        return audio, [(0, total, 0)]
+
+    pausa = AudioSegment.silent(duration=VAD_KEEP_GAP_MS, frame_rate=audio.frame_rate)
+    salida = AudioSegment.empty().set_frame_rate(audio.frame_rate)
+    mapa: MapaTiempos = []
+    for i, (a, b) in enumerate(tramos):
+        if i:
+            salida += pausa
+        mapa.append((a, b, len(salida)))
+        salida += audio[a:b]
+    return salida, mapa
+
+def a_tiempo_original(mapa: MapaTiempos, ms: int) -> int:
+    """Convierte un instante del audio recortado al instante del audio original."""
+    for orig_a, orig_b, proc_a in reversed(mapa):
+        if ms >= proc_a:
+            return min(orig_b, orig_a + (ms - proc_a))
+    return ms
+
+def preprocesar_audio(audio, bytes_original: int) -> Tuple[Any, MapaTiempos, bytes, Dict[str, Any]]:
+    """
+    VAD + mono 16 kHz (ya viene así de cargar_audio) y mide el ahorro frente al original
+    codificando el resultado con el códec compacto.
+    """
+    recortado, mapa = recortar_silencios(audio)
+    data, mime = codificar(recortado)
+    seg_orig, seg_proc = len(audio) / 1000, len(recortado) / 1000
+    stats = {
+        "codec": mime,
+        "bytes_original": bytes_original,
+        "bytes_procesado": len(data),
+        "bytes_ahorrados": max(0, bytes_original - len(data)),
+        "segundos_original": round(seg_orig, 2),
+        "segundos_procesado": round(seg_proc, 2),
+        "segundos_ahorrados": round(seg_orig - seg_proc, 2),
+    }
+    return recortado, mapa, data, stats
+
+async def transcribir_con_reintentos(model, data: bytes, mime: str, etiqueta: str,
+                                    sem: Optional[asyncio.Semaphore] = None,
+                                    segundos: Optional[float] = None) -> str:
+    """Transcribe un segmento con hasta CHUNK_RETRIES reintentos (backoff exponencial)."""
+    for intento in range(CHUNK_RETRIES + 1):
+        try:
+            if sem is None:
+                return await transcribir_bytes(model, data, mime, segundos)
+            async with sem:
+                return await transcribir_bytes(model, data, mime, segundos)
+        except Saturado:
+            # Sin reintento local: la contrapresión llega al cliente como 429
+            raise
+        except Exception as e:
+            logger.warning(f"[chunks] {etiqueta} intento {intento + 1} falló: {e}")
+            if intento == CHUNK_RETRIES:
+                raise
+            await asyncio.sleep(2 ** intento)
+    return ""
+
+async def transcribir_por_segmentos(model, audio, note_id: str, mapa: Optional[MapaTiempos] = None,
+                                    reportar: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+    """
+    Transcribe los segmentos en paralelo (máx. CHUNK_CONCURRENCY llamadas a la vez).
+    Solo los segmentos que fallan se reintentan; el resto se conserva.
+    Si uno aborta la nota (Saturado u otra excepción), los demás se cancelan en vez de
+    seguir gastando llamadas al modelo para una respuesta que ya es un error.
+    Con `mapa` (audio recortado por VAD), los tiempos se reportan sobre el audio original.
+    """
+    segmentos = puntos_de_corte(audio)
+    sem = asyncio.Semaphore(CHUNK_CONCURRENCY)
+    _t = (lambda ms: a_tiempo_original(mapa, ms)) if mapa else (lambda ms: ms)
+    reportar = reportar or (lambda *a, **k: None)
+    listos = 0
+    reportar("modelo", 25, segmento=0, segmentos=len(segmentos))
+
+    async def _uno(idx: int, inicio: int, fin: int) -> Dict[str, Any]:
+        seg = {"idx": idx, "inicio_s": round(_t(inicio) / 1000, 2), "fin_s": round(_t(fin) / 1000, 2), "texto": ""}
+        data, mime = await run_in_threadpool(codificar, audio[inicio:fin])
+        try:
+            seg["texto"] = await transcribir_con_reintentos(model, data, mime, f"Nota {note_id} segmento {idx}", sem,
+                                                            segundos=(fin - inicio) / 1000)
+        except Saturado:
+            raise
+        except Exception as e:
+            seg["error"] = str(e)
+        nonlocal listos
+        listos += 1
+        # 25% → 90% repartido entre segmentos
+        reportar("modelo", 25 + 65 * listos / len(segmentos), segmento=listos, segmentos=len(segmentos))
+        return seg
+
+    tareas = [asyncio.create_task(_uno(i, a, b)) for i, (a, b) in enumerate(segmentos)]
+    try:
+        resultados = await asyncio.gather(*tareas)
+    except BaseException:
+        for t in tareas:
+            t.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        raise
+    resultados.sort(key=lambda r: r["idx"])
+    return {
+        "texto": "\n".join(r["texto"] for r in resultados if r["texto"]).strip(),
+        "segmentos": resultados,
+        "segmentos_fallidos": [r["idx"] for r in resultados if "error" in r],
+    }
+
+async def transcribir_desde_bytes(model, audio_bytes: bytes, mime: str, note_id: str,
+                                  reportar: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+    """Modo "bytes": decodifica, preprocesa y transcribe (en segmentos si es largo)."""
+    reportar = reportar or (lambda *a, **k: None)
+
+    # Decodificar (mono 16 kHz) solo si hay algo que hacer con el audio decodificado
+    audio = None
+    if CHUNK_ENABLED or PREPROCESS_ENABLED:
+        reportar("preprocesando", 10)
+        audio = await run_in_threadpool(cargar_audio, audio_bytes, mime)
+
+    # Preprocesamiento: lo que se manda al modelo es el audio recortado y recodificado
+    mapa: Optional[MapaTiempos] = None
+    pre_stats: Optional[Dict[str, Any]] = None
+    if audio is not None and PREPROCESS_ENABLED:
+        audio, mapa, audio_bytes, pre_stats = await run_in_threadpool(preprocesar_audio, audio, len(audio_bytes))
+        mime = pre_stats["codec"]
+        logger.info(f"[preproceso] Nota {note_id}: {pre_stats}")
+
+    # Transcripción: por segmentos si el audio es largo, si no en una sola llamada
+    if audio is not None and CHUNK_ENABLED and len(audio) / 1000 > CHUNK_THRESHOLD_S:
+        payload = await transcribir_por_segmentos(model, audio, note_id, mapa, reportar)
+    else:
+        reportar("modelo", 25)
+        texto = await transcribir_bytes(model, audio_bytes, mime, len(audio) / 1000 if audio is not None else None)
+        payload = {"texto": texto}
+    if pre_stats:
+        payload["preprocesamiento"] = pre_stats
+    return payload
 
 # ──────────────────────────────────────────────────────────────────────────────
 
@@ -98,83 +482,446 @@ class TranscripcionRespuesta(BaseModel):
     audio_gcs: Optional[str]         # gs://... del audio (si vino file, se sube; si vino gcs_uri, se refleja)
     resultado: Dict[str, Any]        # {"texto": "...", "archivo_guardado_gcs": "gs://..."}
 
+@app.on_event("startup")
+async def _iniciar_medicion():
+    app.state.tarea_medicion = asyncio.create_task(MEDIDOR.bucle())
+
+@app.on_event("shutdown")
+async def _cerrar_medicion():
+    app.state.tarea_medicion.cancel()
+    await run_in_threadpool(MEDIDOR.enviar)
+
 @app.get("/health")
 def health():
     return {"ok": True}
 
+@app.get("/metrics")
+def metrics():
+    return {"limitador_vertex": LIMITADOR.estado(), "cache_respuestas": CACHE.estado(), "medicion": MEDIDOR.estado(),
+            "almacenamiento": ALMACEN.metricas.estado()}
+
+def respuesta_ndjson(servicio: str, pipeline: Callable[[Callable[..., None]], Awaitable[Dict[str, Any]]]) -> StreamingResponse:
+    """
+    Modo progreso (header X-Progress: ndjson): una línea JSON por evento
+      {"type": "progress", "servicio", "etapa", "pct", ...}  ...  {"type": "result", "data": {...}}
+    o {"type": "error", "status", "detail"} al final. El status HTTP es 200 una vez que empieza el stream.
+    """
+    cola: asyncio.Queue = asyncio.Queue()
+
+    def reportar(etapa: str, pct: float, **extra) -> None:
+        cola.put_nowait({"type": "progress", "servicio": servicio, "etapa": etapa, "pct": round(pct, 1), **extra})
+
+    async def correr():
+        try:
+            cola.put_nowait({"type": "result", "data": await pipeline(reportar)})
+        except HTTPException as e:
+            extra = {"retry_after": e.headers["Retry-After"]} if e.headers and "Retry-After" in e.headers else {}
+            cola.put_nowait({"type": "error", "status": e.status_code, "detail": e.detail, **extra})
+        except Exception as e:
+            cola.put_nowait({"type": "error", "status": 500, "detail": str(e)})
+        finally:
+            cola.put_nowait(None)
+
+    async def stream():
+        tarea = asyncio.create_task(correr())
+        try:
+            while (evento := await cola.get()) is not None:
+                yield json.dumps(evento, ensure_ascii=False) + "\n"
+        finally:
+            if not tarea.done():
+                tarea.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def _sin_reporte(etapa: str, pct: float, **extra) -> None:
+    pass
+
 @app.post("/transcribir_audio", response_model=TranscripcionRespuesta)
 async def transcribir_audio(
     file: UploadFile = File(None, description="Archivo de audio (mp3, m4a, wav, etc.)"),
     gcs_uri: Optional[str] = Form(default=None, description="URI de GCS gs://bucket/path"),
     user_id_header: Optional[str] = Header(default=None, alias="X-User-Id"),  # doctor_uid
+    progress: Optional[str] = Header(default=None, alias="X-Progress"),      # "ndjson" → stream de progreso
     org_id: str = Form(...),
     patient_id: str = Form(...),
     session_id: str = Form(...),
     note_id: str = Form(...),
+    modo: Optional[str] = Form(default=None, description="bytes | uri (default: AUDIO_INPUT_MODE)"),
 ):
     """
     Acepta:
       - file (multipart)  O  gcs_uri (gs://…)
-    Si llega file: sube el binario a GCS bajo /raw/ y transcribe desde bytes.
-    Si llega gcs_uri: descarga bytes de GCS para transcribir (más estable).
+    Modo "bytes" (default):
+      Si llega file: sube el binario a GCS bajo /raw/ y transcribe desde bytes.
+      Si llega gcs_uri: descarga bytes de GCS para transcribir (más estable).
+    Modo "uri": el audio queda en GCS y Gemini lo lee por referencia.
+    Antes del modelo: VAD + mono 16 kHz + Opus/FLAC (el original se archiva tal cual en raw/).
+    Audios largos se cortan en silencios y se transcriben por segmentos en paralelo.
     Guarda SOLO el JSON de la transcripción en GCS.
+    Con X-Progress: ndjson la respuesta es un stream de eventos de etapa/porcentaje.
     """
     uid = user_id_header or "_public"
+    modo = (modo or AUDIO_INPUT_MODE).lower()
 
-    try:
-        # Modelo de Vertex AI (lazy)
-        model = ensure_vertex_model()
-        from vertexai.generative_models import Part  # importar aquí por seguridad
-
-        audio_gcs_uri: Optional[str] = None
+    if file is None and not gcs_uri:
+        raise HTTPException(status_code=400, detail="Debes enviar 'file' o 'gcs_uri'.")
+    if modo == "uri" and (not USE_GCS or ALMACEN.backend != "gcs"):
+        raise HTTPException(status_code=400, detail="El modo 'uri' requiere AUDIO_USE_GCS=true y AUDIO_STORAGE_BACKEND=gcs.")
+    if file is None and modo == "uri" and not gcs_uri.startswith("gs://"):
+        raise HTTPException(status_code=400, detail="gcs_uri inválido")
 
-        # Preparar bytes + MIME
-        if file is not None:
+    # Lo que depende del UploadFile se resuelve antes de (posiblemente) empezar el stream:
+    # según la versión, FastAPI cierra los archivos del form al salir del handler.
+    audio_bytes: Optional[bytes] = None
+    archivo_raw = None  # modo uri: spool de la subida, lo consume (y cierra) el pipeline
+    audio_gcs_uri: Optional[str] = None if file is not None else gcs_uri
+    entradas: List[Dict[str, Any]] = []  # objetos escritos en esta nota → manifiesto de la sesión
+    if file is not None:
+        _, ext = os.path.splitext(file.filename or "audio.bin")
+        gcs_filename = f"{note_id}_{_ts()}{ext or '.bin'}"
+        raw_ctype = guess_mime(file.filename or "", file.content_type or "application/octet-stream")
+        mime = guess_mime(file.filename or "", file.content_type or "audio/mpeg")
+        if modo == "uri":
+            # Starlette ya spoolea la subida a disco; la mandamos a GCS por chunks
+            size = file.file.seek(0, os.SEEK_END)
+            file.file.seek(0)
+            if not size:
+                raise HTTPException(status_code=400, detail="Archivo vacío o no válido.")
+            # La subida a GCS corre dentro del pipeline (con su evento de progreso): el spool
+            # se le quita al UploadFile para que cerrar el form no lo cierre a mitad del stream.
+            archivo_raw, file.file = file.file, io.BytesIO()
+        else:
             audio_bytes = await file.read()
             if not audio_bytes:
                 raise HTTPException(status_code=400, detail="Archivo vacío o no válido.")
-            # Subir a GCS (raw)
-            _, ext = os.path.splitext(file.filename or "audio.bin")
-            gcs_filename = f"{note_id}_{_ts()}{ext or '.bin'}"
-            audio_gcs_uri = gcs_upload_bytes(
+    else:
+        mime = guess_mime(gcs_uri, "audio/mpeg")
+
+    async def pipeline(reportar: Callable[..., None]) -> Dict[str, Any]:
+        nonlocal audio_bytes, audio_gcs_uri
+        fijar_alcance(org_id, uid, session_id, note_id)
+        try:
+            # Modelo de Vertex AI (lazy)
+            model = ensure_vertex_model()
+
+            if modo == "uri":
+                if archivo_raw is not None:
+                    reportar("subiendo_gcs", 0)
+                    entrada_raw = await run_in_threadpool(
+                        gcs_upload_raw, org_id, uid, patient_id, session_id, note_id,
+                        gcs_filename, raw_ctype, fileobj=archivo_raw,
+                    )
+                    audio_gcs_uri = entrada_raw["contenido"]
+                    entradas.append(entrada_raw)
+                reportar("modelo", 20)
+                texto = await transcribir_uri(model, audio_gcs_uri, mime)
+                payload = {"texto": texto, "modo": "uri"}
+
+            else:
+                if file is not None:
+                    # Subir a GCS (raw)
+                    reportar("subiendo_gcs", 0)
+                    entrada_raw = await run_in_threadpool(
+                        gcs_upload_raw,
+                        org_id=org_id, doctor_uid=uid, patient_id=patient_id,
+                        session_id=session_id, note_id=note_id, filename=gcs_filename,
+                        content_type=raw_ctype, content=audio_bytes
+                    )
+                    audio_gcs_uri = entrada_raw["contenido"]
+                    entradas.append(entrada_raw)
+                else:
+                    reportar("descargando_gcs", 0)
+                    audio_bytes = await run_in_threadpool(download_gcs_bytes, gcs_uri)
+
+                payload = await transcribir_desde_bytes(model, audio_bytes, mime, note_id, reportar)
+
+            # Guardar JSON en GCS
+            reportar("persistiendo", 95)
+            json_gcs_uri = await run_in_threadpool(
+                gcs_upload_json,
                 org_id=org_id, doctor_uid=uid, patient_id=patient_id,
-                session_id=session_id, subfolder="raw", filename=gcs_filename,
-                content=audio_bytes, content_type=guess_mime(file.filename or "", file.content_type or "application/octet-stream")
-            )
-            mime = guess_mime(file.filename or "", file.content_type or "audio/mpeg")
+                session_id=session_id, note_id=note_id, data=payload
+            ) if USE_GCS else None
+            if json_gcs_uri:
+                entradas.append(describir(json_gcs_uri, json_compacto(payload), content_type="application/json", nota=note_id))
+                await run_in_threadpool(MANIFIESTO.registrar_seguro, org_id, uid, patient_id, session_id, entradas)
 
-        elif gcs_uri:
-            audio_bytes = download_gcs_bytes(gcs_uri)
-            audio_gcs_uri = gcs_uri
-            mime = guess_mime(gcs_uri, "audio/mpeg")
+            reportar("completado", 100)
+            return {
+                "mensaje": "Transcripción parcial (hubo segmentos fallidos)" if payload.get("segmentos_fallidos") else "Transcripción completada",
+                "user_id": uid,
+                "audio_gcs": audio_gcs_uri,
+                "resultado": {**payload, "archivo_guardado_gcs": json_gcs_uri},
+            }
 
-        else:
-            raise HTTPException(status_code=400, detail="Debes enviar 'file' o 'gcs_uri'.")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            if archivo_raw is not None:
+                archivo_raw.close()
 
-        # Transcripción
-        audio_part = Part.from_data(data=audio_bytes, mime_type=mime)
-        prompt = "Transcribe el audio a texto en español. Devuelve SOLO la transcripción."
-        resp = model.generate_content([audio_part, prompt], generation_config={"response_mime_type": "text/plain"})
+    if (progress or "").lower() == "ndjson":
+        return respuesta_ndjson("audio", pipeline)
+    return await pipeline(_sin_reporte)
 
-        # Extraer texto
-        texto = (resp.candidates[0].content.parts[0].text or "").strip() if resp and resp.candidates else ""
+# ──────────────────────────────────────────────────────────────────────────────
+# Transcripción en vivo (WebSocket)
+#
+# Protocolo (ws /ws/transcribir?org_id=..&patient_id=..&session_id=..&note_id=..&mime=audio/webm):
+#   cliente → binario: chunks del MediaRecorder (webm/ogg) en orden
+#   cliente → texto:   {"type": "stop"} al terminar de grabar
+#   servidor → texto:  {"type": "partial", "texto": ...}                    (cola aún abierta)
+#                      {"type": "final", "idx", "inicio_s", "fin_s", "texto"} (segmento cerrado)
+#                      {"type": "done", "texto", "segmentos", "audio_gcs", "archivo_guardado_gcs"}
+#                      {"type": "error", "detail": ...}
+# Los chunks se acumulan en un spool en disco (se sube completo al final) y, en paralelo, un
+# ffmpeg vivo los decodifica a PCM a medida que llegan: cada tick solo procesa lo nuevo, en
+# lugar de re-decodificar toda la grabación. Cada STREAM_TICK_S se cierra un segmento en el
+# último silencio una vez juntados STREAM_WINDOW_S nuevos; el PCM ya cerrado se descarta.
+# mp4 no se puede decodificar por pipe (el índice puede ir al final): ahí se re-decodifica
+# el spool, solo desde el último segmento cerrado hacia adelante en la salida.
 
-        payload = {"texto": texto}
+PCM_BYTES_POR_MS = 16000 * 2 // 1000   # mono 16 kHz s16le
+MIMES_POR_PIPE = ("audio/webm", "audio/ogg")
+
+def decodificar_spool(path: str):
+    """
+    Decodifica el contenedor parcial (webm/ogg truncado) a PCM mono 16 kHz vía ffmpeg.
+    Usa lo que ffmpeg alcance a decodificar aunque el archivo termine a medias.
+    """
+    import subprocess
+    from pydub import AudioSegment
+    proc = subprocess.run(
+        ["ffmpeg", "-v", "quiet", "-i", path, "-ac", "1", "-ar", "16000", "-f", "s16le", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False,
+    )
+    return AudioSegment(data=proc.stdout, sample_width=2, frame_rate=16000, channels=1)
+
+class DecodificadorPCM:
+    """
+    ffmpeg de larga vida: contenedor por stdin → PCM mono 16 kHz por stdout, leído por un hilo.
+    Se alimenta con lo nuevo del spool (offset propio) y guarda solo el PCM aún no descartado,
+    así que la memoria y el trabajo por tick son proporcionales al audio pendiente.
+    """
+
+    def __init__(self):
+        import subprocess
+        self.proc = subprocess.Popen(
+            ["ffmpeg", "-v", "quiet", "-i", "pipe:0", "-ac", "1", "-ar", "16000", "-f", "s16le", "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        self.enviados = 0          # bytes del spool ya escritos a ffmpeg
+        self.base_ms = 0           # ms de audio descartados al inicio del buffer
+        self._pcm = bytearray()
+        self._lock = threading.Lock()
+        self._lector = threading.Thread(target=self._leer, daemon=True)
+        self._lector.start()
+
+    def _leer(self) -> None:
+        while True:
+            bloque = self.proc.stdout.read1(64 * 1024)
+            if not bloque:
+                return
+            with self._lock:
+                self._pcm += bloque
+
+    def alimentar(self, path: str, final: bool = False) -> None:
+        """Bloqueante. Escribe a ffmpeg lo que llegó al spool desde la última vez; final cierra la entrada."""
+        with open(path, "rb") as f:
+            f.seek(self.enviados)
+            for bloque in iter(lambda: f.read(256 * 1024), b""):
+                self.proc.stdin.write(bloque)
+                self.enviados += len(bloque)
+        self.proc.stdin.flush()
+        if final:
+            self.proc.stdin.close()
+            self._lector.join(timeout=30)
+            self.proc.wait(timeout=5)
+
+    def desde(self, ms: int):
+        """Audio decodificado a partir de `ms` (absoluto); descarta lo anterior."""
+        from pydub import AudioSegment
+        with self._lock:
+            corte = max(0, (ms - self.base_ms) * PCM_BYTES_POR_MS)
+            del self._pcm[:corte]
+            self.base_ms = max(self.base_ms, ms)
+            data = bytes(self._pcm[:len(self._pcm) - len(self._pcm) % 2])
+        return AudioSegment(data=data, sample_width=2, frame_rate=16000, channels=1)
+
+    def cerrar(self) -> None:
+        if self.proc.poll() is None:
+            self.proc.kill()
+        for flujo in (self.proc.stdin, self.proc.stdout):
+            try:
+                flujo.close()
+            except Exception:
+                pass
 
-        # Guardar JSON en GCS
-        json_gcs_uri = gcs_upload_json(
-            org_id=org_id, doctor_uid=uid, patient_id=patient_id,
-            session_id=session_id, note_id=note_id, data=payload
-        ) if USE_GCS else None
+class SesionEnVivo:
+    def __init__(self, ws: WebSocket, model, note_id: str, mime: str):
+        self.ws = ws
+        self.model = model
+        self.note_id = note_id
+        self.mime = mime
+        self.spool = tempfile.NamedTemporaryFile(suffix=".stream")
+        self.recibidos = 0
+        self.finalizado_ms = 0
+        self.segmentos: List[Dict[str, Any]] = []
+        self.tarea: Optional[asyncio.Task] = None
+        self.ultimo_tick = 0.0
+        self.decodificador: Optional[DecodificadorPCM] = None
+        if mime.split(";")[0] in MIMES_POR_PIPE:
+            try:
+                self.decodificador = DecodificadorPCM()
+            except Exception as e:
+                logger.warning(f"[en_vivo] Nota {note_id}: sin decodificación incremental ({e}), se usa el spool")
 
+    def agregar(self, chunk: bytes) -> None:
+        self.spool.write(chunk)
+        self.spool.flush()
+        self.recibidos += len(chunk)
+
+    def tick(self) -> None:
+        """Lanza un procesamiento en background si no hay otro corriendo y ya pasó STREAM_TICK_S."""
+        ahora = time.monotonic()
+        if (self.tarea is None or self.tarea.done()) and ahora - self.ultimo_tick >= STREAM_TICK_S:
+            self.ultimo_tick = ahora
+            self.tarea = asyncio.create_task(self.procesar(final=False))
+
+    def _corte(self, nuevo) -> Optional[int]:
+        """Punto (ms, relativo a `nuevo`) donde cerrar un segmento, o None si aún no toca."""
+        from pydub.silence import detect_silence
+        window_ms = int(STREAM_WINDOW_S * 1000)
+        if len(nuevo) < window_ms:
+            return None
+        thresh = (nuevo.dBFS if nuevo.dBFS != float("-inf") else -60) - SILENCE_REL_DB
+        silencios = [(a + b) // 2 for a, b in detect_silence(nuevo, min_silence_len=SILENCE_MIN_MS, silence_thresh=thresh, seek_step=50)]
+        # Dejamos al menos 1 s de cola: el último tramo del spool puede venir incompleto
+        candidatos = [m for m in silencios if window_ms // 2 <= m <= len(nuevo) - 1000]
+        if candidatos:
+            return candidatos[-1]
+        return len(nuevo) - 1000 if len(nuevo) >= int(CHUNK_MAX_S * 1000) else None
+
+    def _pendiente(self, final: bool):
+        """Bloqueante. Audio desde el último segmento cerrado (finalizado_ms) hasta lo recibido."""
+        if self.decodificador is not None:
+            try:
+                self.decodificador.alimentar(self.spool.name, final)
+                return self.decodificador.desde(self.finalizado_ms)
+            except Exception as e:
+                # ffmpeg murió (datos inválidos, BrokenPipe): el resto de la sesión va por el spool
+                logger.warning(f"[en_vivo] Nota {self.note_id}: decodificación incremental falló ({e}), se usa el spool")
+                self.decodificador.cerrar()
+                self.decodificador = None
+        return decodificar_spool(self.spool.name)[self.finalizado_ms:]
+
+    async def procesar(self, final: bool) -> None:
+        try:
+            nuevo = await run_in_threadpool(self._pendiente, final)
+            corte = len(nuevo) if final else self._corte(nuevo)
+
+            if corte:
+                inicio, fin = self.finalizado_ms, self.finalizado_ms + corte
+                data, mime = await run_in_threadpool(codificar, nuevo[:corte])
+                seg = {"idx": len(self.segmentos), "inicio_s": round(inicio / 1000, 2), "fin_s": round(fin / 1000, 2), "texto": ""}
+                try:
+                    seg["texto"] = await transcribir_con_reintentos(self.model, data, mime, f"Nota {self.note_id} en vivo {seg['idx']}",
+                                                                    segundos=(fin - inicio) / 1000)
+                except Exception as e:
+                    seg["error"] = str(e)
+                self.segmentos.append(seg)
+                self.finalizado_ms = fin
+                nuevo = nuevo[corte:]
+                await self.ws.send_json({"type": "final", **seg})
+
+            cola = nuevo
+            if STREAM_PARTIALS and not final and len(cola) >= 3000:
+                data, mime = await run_in_threadpool(codificar, cola)
+                # Los parciales son efímeros: no se cachean
+                texto = await transcribir_bytes(self.model, data, mime, len(cola) / 1000, cachear=False)
+                await self.ws.send_json({"type": "partial", "inicio_s": round(self.finalizado_ms / 1000, 2), "texto": texto})
+        except Exception as e:
+            logger.warning(f"[en_vivo] Nota {self.note_id}: fallo procesando ventana: {e}")
+
+    def transcript(self) -> Dict[str, Any]:
         return {
-            "mensaje": "Transcripción completada",
-            "user_id": uid,
-            "audio_gcs": audio_gcs_uri,
-            "resultado": {**payload, "archivo_guardado_gcs": json_gcs_uri},
+            "texto": "\n".join(s["texto"] for s in self.segmentos if s["texto"]).strip(),
+            "segmentos": self.segmentos,
+            "segmentos_fallidos": [s["idx"] for s in self.segmentos if "error" in s],
+            "modo": "en_vivo",
         }
 
-    except HTTPException:
-        raise
+@app.websocket("/ws/transcribir")
+async def transcribir_en_vivo(
+    ws: WebSocket,
+    org_id: str,
+    patient_id: str,
+    session_id: str,
+    note_id: str,
+    mime: str = "audio/webm",
+):
+    await ws.accept()
+    uid = ws.headers.get("x-user-id") or "_public"
+    fijar_alcance(org_id, uid, session_id, note_id)
+    sesion = SesionEnVivo(ws, ensure_vertex_model(), note_id, mime)
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg.get("type") == "websocket.disconnect":
+                return
+            if msg.get("bytes"):
+                sesion.agregar(msg["bytes"])
+                sesion.tick()
+            elif msg.get("text"):
+                try:
+                    ctrl = json.loads(msg["text"])
+                except ValueError:
+                    ctrl = {}
+                if ctrl.get("type") == "stop":
+                    break
+
+        if sesion.tarea is not None:
+            await sesion.tarea
+        if not sesion.recibidos:
+            await ws.send_json({"type": "error", "detail": "No se recibió audio."})
+            return
+        await sesion.procesar(final=True)
+        payload = sesion.transcript()
+
+        # Audio completo + transcripción bajo el mismo layout que /transcribir_audio
+        audio_gcs_uri = json_gcs_uri = None
+        if USE_GCS:
+            ext = {"audio/webm": ".webm", "audio/ogg": ".ogg", "audio/mp4": ".m4a"}.get(mime.split(";")[0], ".bin")
+            entrada_raw = await run_in_threadpool(
+                gcs_upload_raw, org_id, uid, patient_id, session_id, note_id,
+                f"{note_id}_{_ts()}{ext}", mime.split(";")[0], fileobj=sesion.spool,
+            )
+            audio_gcs_uri = entrada_raw["contenido"]
+            json_gcs_uri = await run_in_threadpool(
+                gcs_upload_json, org_id, uid, patient_id, session_id, note_id, payload,
+            )
+            entradas = [
+                entrada_raw,
+                describir(json_gcs_uri, json_compacto(payload), content_type="application/json", nota=note_id),
+            ]
+            await run_in_threadpool(MANIFIESTO.registrar_seguro, org_id, uid, patient_id, session_id, entradas)
+
+        await ws.send_json({"type": "done", **payload, "audio_gcs": audio_gcs_uri, "archivo_guardado_gcs": json_gcs_uri})
+        await ws.close()
+    except WebSocketDisconnect:
+        logger.info(f"[en_vivo] Cliente desconectado (nota {note_id})")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.warning(f"[en_vivo] Nota {note_id}: {e}")
+        try:
+            await ws.send_json({"type": "error", "detail": str(e)})
+            await ws.close(code=1011)
+        except Exception:
+            pass
+    finally:
+        if sesion.tarea is not None and not sesion.tarea.done():
+            sesion.tarea.cancel()
+        if sesion.decodificador is not None:
+            sesion.decodificador.cerrar()
+        sesion.spool.close()
@@ -0,0 +1 @@
+"""Código compartido por los servicios del backend (se copia a /app/common en cada imagen)."""
@@ -0,0 +1,134 @@
+"""
+Caché determinista de respuestas del modelo (lo usan análisis y audio).
+
+Misma entrada + modelo + versión de plantilla → misma salida, así que la respuesta se
+guarda por huella y se reutiliza. Dos niveles con TTL: LRU en memoria y, opcionalmente,
+persistente ("disco" local o "gcs"). Todo va acotado por organización: en el bucket bajo
+{prefix}{org_id}/_cache/{servicio}/, para que borrar o auditar un tenant incluya su caché.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger("cache_respuestas")
+
+SIN_ORG = "_sin_org"
+
+class CacheRespuestas:
+    """
+    Clave = sha256(servicio, modelo, version_prompt, partes), donde las partes son
+    exactamente lo que determina la salida (plantilla + entrada). Subir version_prompt
+    invalida todo lo anterior sin borrar nada (las entradas viejas dejan de consultarse).
+    nivel: "memoria" | "disco" (bajo dir_disco) | "gcs" (necesita `almacen`).
+    """
+
+    def __init__(self, servicio: str, max_items: int, ttl_s: float, nivel: str, *, modelo: str,
+                 version_prompt: str, habilitada: bool = True, dir_disco: Optional[str] = None, almacen=None):
+        if nivel not in ("memoria", "disco", "gcs"):
+            raise ValueError(f"Nivel de caché desconocido: {nivel}")
+        self.servicio = servicio
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.nivel = nivel
+        self.modelo = modelo
+        self.version_prompt = version_prompt
+        self.habilitada = habilitada
+        self.dir_disco = dir_disco or os.path.join("/tmp", f"cache_{servicio}")
+        self.almacen = almacen
+        self._persistente = nivel == "disco" or (nivel == "gcs" and almacen is not None)
+        self._lru: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits_memoria": 0, "hits_persistente": 0, "misses": 0}
+
+    def clave(self, *partes: str) -> str:
+        h = hashlib.sha256()
+        for parte in (self.servicio, self.modelo, self.version_prompt, *partes):
+            h.update(parte.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def _vigente(self, entrada: Optional[Dict[str, Any]]) -> bool:
+        return bool(entrada) and time.time() - entrada["t"] < self.ttl_s
+
+    def _ruta(self, org: str, clave: str) -> str:
+        if self.nivel == "disco":
+            return os.path.join(self.dir_disco, org, self.servicio, clave[:2], f"{clave}.json")
+        return self.almacen.ruta_servicio(org, "_cache", self.servicio, clave[:2], f"{clave}.json")
+
+    def _leer_persistente(self, org: str, clave: str) -> Optional[Dict[str, Any]]:
+        try:
+            if self.nivel == "disco":
+                with open(self._ruta(org, clave), encoding="utf-8") as f:
+                    return json.load(f)
+            return self.almacen.get_json(self._ruta(org, clave))
+        except Exception:
+            return None
+
+    def _escribir_persistente(self, org: str, clave: str, entrada: Dict[str, Any]) -> None:
+        try:
+            datos = json.dumps(entrada, ensure_ascii=False)
+            if self.nivel == "disco":
+                ruta = self._ruta(org, clave)
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                tmp = f"{ruta}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(datos)
+                os.replace(tmp, ruta)
+            else:
+                self.almacen.put_bytes(self._ruta(org, clave), datos.encode("utf-8"), "application/json")
+        except Exception as e:
+            logger.warning(f"[cache] No se pudo persistir {clave[:12]}: {e}")
+
+    def _a_memoria(self, k: Tuple[str, str], entrada: Dict[str, Any]) -> None:
+        with self._lock:
+            self._lru[k] = entrada
+            self._lru.move_to_end(k)
+            while len(self._lru) > self.max_items:
+                self._lru.popitem(last=False)
+
+    def _contar(self, stat: str) -> None:
+        with self._lock:
+            self.stats[stat] += 1
+
+    async def obtener_o_calcular(self, clave: str, calcular: Callable[[], Awaitable[Any]], *,
+                                 org_id: Optional[str] = None, cacheable: Callable[[Any], bool] = bool) -> Any:
+        if not self.habilitada:
+            return await calcular()
+        org = org_id or SIN_ORG
+        k = (org, clave)
+        with self._lock:
+            entrada = self._lru.get(k)
+            if self._vigente(entrada):
+                self._lru.move_to_end(k)
+                self.stats["hits_memoria"] += 1
+                return entrada["v"]
+        if self._persistente:
+            entrada = await asyncio.to_thread(self._leer_persistente, org, clave)
+            if self._vigente(entrada):
+                self._a_memoria(k, entrada)
+                self._contar("hits_persistente")
+                return entrada["v"]
+        self._contar("misses")
+        valor = await calcular()
+        if cacheable(valor):
+            entrada = {"t": time.time(), "v": valor}
+            self._a_memoria(k, entrada)
+            if self._persistente:
+                await asyncio.to_thread(self._escribir_persistente, org, clave, entrada)
+        return valor
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self.stats)
+            s["en_memoria"] = len(self._lru)
+        total = s["hits_memoria"] + s["hits_persistente"] + s["misses"]
+        s["hit_rate"] = round((s["hits_memoria"] + s["hits_persistente"]) / total, 4) if total else None
+        s.update({"nivel": self.nivel, "prompt_version": self.version_prompt, "ttl_s": self.ttl_s})
+        return s
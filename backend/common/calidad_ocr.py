@@ -0,0 +1,69 @@
+"""
+Compuerta de calidad del texto OCR (la usa el orquestador antes de mandar a análisis).
+
+Texto vacío o basura (símbolos, fragmentos sin palabras, otro idioma) no vale una llamada
+al modelo: se puntúa localmente y el frontend pide recapturar la imagen.
+"""
+
+import re
+from typing import Any, Dict, Optional
+
+_STOPWORDS_ES = {
+    "de", "la", "que", "el", "en", "y", "a", "los", "se", "del", "las", "un", "por", "con",
+    "no", "una", "su", "para", "es", "al", "lo", "como", "más", "mas", "pero", "sus", "le",
+    "ya", "o", "me", "mi", "muy", "sin", "sobre", "también", "tambien", "hay", "yo", "te",
+    "esta", "está", "este", "eso", "fue", "ha", "son", "porque", "cuando", "todo", "nos",
+}
+_WORD_RE = re.compile(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+")
+_VOCALES = set("aeiouáéíóúü")
+
+def evaluar_calidad_ocr(texto: str, confianza: Optional[float] = None, *,
+                        min_score: float = 0.5, min_chars: int = 12) -> Dict[str, Any]:
+    """
+    Puntaje 0-1 del texto OCR combinando:
+      - proporción de letras sobre caracteres no-espacio (basura = muchos símbolos),
+      - proporción de tokens con forma de palabra (≥2 letras y alguna vocal),
+      - detección de idioma español por stopwords,
+      - confianza del motor OCR (Vision/Tesseract) si viene.
+    No hace llamadas de red: es barato correrlo antes de decidir si se analiza.
+    ok = score ≥ min_score; con menos de min_chars caracteres visibles el score es 0.
+    """
+    texto = (texto or "").strip()
+    visibles = [c for c in texto if not c.isspace()]
+    motivos = []
+
+    if len(visibles) < min_chars:
+        motivos.append("texto_vacio_o_muy_corto")
+        return {"score": 0.0, "ok": False, "motivos": motivos, "chars": len(visibles), "idioma": None}
+
+    ratio_letras = sum(c.isalpha() for c in visibles) / len(visibles)
+    tokens = texto.split()
+    palabras = _WORD_RE.findall(texto.lower())
+    con_forma = [w for w in palabras if len(w) >= 2 and any(v in _VOCALES for v in w)]
+    ratio_palabras = len(con_forma) / len(tokens) if tokens else 0.0
+    ratio_es = sum(w in _STOPWORDS_ES for w in palabras) / len(palabras) if palabras else 0.0
+    # ~15% de stopwords ya es típico de prosa en español
+    score_idioma = min(1.0, ratio_es / 0.15)
+
+    componentes = [(ratio_letras, 0.3), (ratio_palabras, 0.3), (score_idioma, 0.2)]
+    if confianza is not None:
+        componentes.append((float(confianza), 0.2))
+    peso_total = sum(p for _, p in componentes)
+    score = sum(v * p for v, p in componentes) / peso_total
+
+    if ratio_letras < 0.6:
+        motivos.append("muchos_simbolos")
+    if ratio_palabras < 0.5:
+        motivos.append("pocas_palabras_validas")
+    if ratio_es < 0.05:
+        motivos.append("idioma_no_detectado")
+    if confianza is not None and confianza < 0.5:
+        motivos.append("baja_confianza_ocr")
+
+    return {
+        "score": round(score, 3),
+        "ok": score >= min_score,
+        "motivos": motivos,
+        "chars": len(visibles),
+        "idioma": "es" if ratio_es >= 0.05 else None,
+    }
@@ -0,0 +1,151 @@
+"""
+Almacenamiento direccionado por contenido para medios crudos (fotos, audios).
+
+Los bytes se guardan una sola vez por organización, nombrados por su SHA-256:
+  {prefix}{org_id}/_cas/sha256/{ab}/{sha256}
+y cada nota deja una referencia pequeña en su sesión (el layout raw/ se conserva):
+  .../sessions/{session_id}/raw/{note_id}_{ts}{ext}.ref.json -> {"sha256", "contenido", "size", "ct", "nota", "ts"}
+
+El hash se calcula antes de subir: si el objeto ya existe (misma foto, reintento tras
+timeout) no se transfiere de nuevo, pero se "toca" (sube su `updated`) para que la
+reconciliación no lo tome por huérfano mientras se escribe la referencia nueva.
+Alcance por organización para no mezclar tenants.
+
+Reconciliación (job en background, p. ej. Cloud Run Job / cron):
+  python -m common.contenido --bucket B --org ORG [--prefix P] [--backend local --raiz DIR]
+                             [--borrar-huerfanos --gracia-h 24]
+reporta bytes ahorrados por deduplicación y objetos sin referencias (huérfanos).
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, Optional
+
+from .storage import UPLOAD_CHUNK_BYTES, crear_almacen, json_compacto
+
+CAS_DIR = "_cas"
+
+def _ts() -> str:
+    return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+def sha256_de(data: Optional[bytes] = None, fileobj=None) -> Dict[str, Any]:
+    """{"sha256", "size"} de bytes o de un file-like (por chunks, sin cargarlo entero)."""
+    if data is not None:
+        return {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}
+    h, size = hashlib.sha256(), 0
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+        h.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return {"sha256": h.hexdigest(), "size": size}
+
+def ruta_contenido(almacen, org_id: str, sha256: str) -> str:
+    return almacen.ruta_servicio(org_id, CAS_DIR, "sha256", sha256[:2], sha256)
+
+def guardar_raw(almacen, org_id: str, doctor_uid: str, patient_id: str, session_id: str,
+                note_id: str, filename: str, content_type: str, *,
+                data: Optional[bytes] = None, fileobj=None, dedup: bool = True,
+                chunk_size: int = UPLOAD_CHUNK_BYTES) -> Dict[str, Any]:
+    """
+    Guarda un medio crudo de la nota y devuelve su entrada de manifiesto:
+      {"uri": referencia/objeto en raw/, "contenido": gs:// con los bytes, "size", "sha256",
+       "ts", "ct", "nota", "dedup": True si los bytes ya estaban}
+    Con dedup=False se escribe como antes (raw/{filename}) y contenido == uri.
+    """
+    h = sha256_de(data, fileobj)
+    base = {**h, "ts": _ts(), "ct": content_type, "nota": note_id}
+    if not dedup:
+        ruta = almacen.ruta(org_id, doctor_uid, patient_id, session_id, "raw", filename)
+        if data is not None:
+            uri = almacen.put_bytes(ruta, data, content_type)
+        else:
+            uri = almacen.put_stream(ruta, fileobj, content_type, chunk_size)
+        return {**base, "uri": uri, "contenido": uri, "dedup": False}
+
+    ruta_cas = ruta_contenido(almacen, org_id, h["sha256"])
+    # tocar en vez de metadatos: un borrado de huérfanos concurrente no puede ganarle
+    existente = almacen.tocar(ruta_cas)
+    repetido = existente is not None and existente["size"] == h["size"]
+    if repetido:
+        almacen.metricas.sumar_bytes("dedup_evitado", h["size"])
+        contenido = almacen.uri(ruta_cas)
+    elif data is not None:
+        contenido = almacen.put_bytes(ruta_cas, data, content_type)
+    else:
+        contenido = almacen.put_stream(ruta_cas, fileobj, content_type, chunk_size)
+
+    ref = {"sha256": h["sha256"], "contenido": contenido, "size": h["size"], "ct": content_type,
+           "nota": note_id, "ts": base["ts"]}
+    ruta_ref = almacen.ruta(org_id, doctor_uid, patient_id, session_id, "raw", f"{filename}.ref.json")
+    uri_ref = almacen.put_bytes(ruta_ref, json_compacto(ref), "application/json")
+    return {**base, "uri": uri_ref, "contenido": contenido, "dedup": repetido}
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Reconciliación
+
+def reconciliar(almacen, org_id: str, borrar_huerfanos: bool = False, gracia_h: float = 24.0) -> Dict[str, Any]:
+    """
+    Cruza referencias (raw/*.ref.json) con objetos de _cas/ de la organización:
+      - ahorro: bytes que se habrían guardado sin deduplicar (size * (refs - 1))
+      - huérfanos: objetos sin referencias (subida interrumpida antes de escribir la ref).
+        Solo se borran si se pide y son más viejos que la gracia (pueden estar en curso).
+        El listado puede quedar viejo mientras corre el job: el borrado vuelve a comprobar
+        `updated` de forma atómica, así que un objeto reutilizado (tocado) entretanto se conserva.
+    """
+    prefijo_org = almacen.ruta_servicio(org_id, "")
+    prefijo_cas = almacen.ruta_servicio(org_id, CAS_DIR, "sha256") + "/"
+    objetos: Dict[str, Dict[str, Any]] = {}
+    refs: Dict[str, int] = {}
+    refs_invalidas = 0
+
+    for obj in almacen.listar(prefijo_org):
+        ruta = obj["ruta"]
+        if ruta.startswith(prefijo_cas):
+            objetos[ruta.rsplit("/", 1)[-1]] = obj
+        elif "/raw/" in ruta and ruta.endswith(".ref.json"):
+            try:
+                sha = almacen.get_json(ruta)["sha256"]
+                refs[sha] = refs.get(sha, 0) + 1
+            except Exception:
+                refs_invalidas += 1
+
+    limite = datetime.now(timezone.utc) - timedelta(hours=gracia_h)
+    ahorro = sum(o["size"] * (refs[sha] - 1) for sha, o in objetos.items() if refs.get(sha, 0) > 1)
+    huerfanos = [o for sha, o in objetos.items() if sha not in refs]
+    borrados = 0
+    if borrar_huerfanos:
+        for o in huerfanos:
+            if (o["updated"] and datetime.fromisoformat(o["updated"]) < limite
+                    and almacen.borrar_si_viejo(o["ruta"], limite)):
+                borrados += 1
+
+    return {
+        "org_id": org_id,
+        "objetos_unicos": len(objetos),
+        "bytes_almacenados": sum(o["size"] for o in objetos.values()),
+        "referencias": sum(refs.values()),
+        "referencias_invalidas": refs_invalidas,
+        "referencias_sin_objeto": len([sha for sha in refs if sha not in objetos]),
+        "bytes_ahorrados_dedup": ahorro,
+        "huerfanos": len(huerfanos),
+        "bytes_huerfanos": sum(o["size"] for o in huerfanos),
+        "huerfanos_borrados": borrados,
+    }
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Reconciliación del almacenamiento por contenido")
+    ap.add_argument("--bucket", required=True)
+    ap.add_argument("--org", required=True)
+    ap.add_argument("--prefix", default="")
+    ap.add_argument("--backend", default=os.getenv("STORAGE_BACKEND", "gcs"))
+    ap.add_argument("--raiz", default=os.getenv("STORAGE_ROOT", "data_local"))
+    ap.add_argument("--borrar-huerfanos", action="store_true")
+    ap.add_argument("--gracia-h", type=float, default=24.0)
+    args = ap.parse_args()
+
+    almacen = crear_almacen(args.bucket, args.prefix, backend=args.backend, raiz=args.raiz)
+    print(json.dumps(reconciliar(almacen, args.org, args.borrar_huerfanos, args.gracia_h), indent=2))
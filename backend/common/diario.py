@@ -0,0 +1,182 @@
+"""
+Diario write-behind de notas en SQLite (lo usa el orquestador).
+
+Una escritura se registra en disco (WAL, synchronous=FULL) y se confirma al cliente;
+un flusher en el event loop la lleva al destino (Firestore) en lotes, con reintentos.
+Lo que quedó en el archivo al reiniciar se reintenta (replay).
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger("diario")
+
+class DiarioNotas:
+    """
+    Diario append-only en SQLite (WAL, synchronous=FULL) de escrituras de notas pendientes.
+      agregar()  → una fila por escritura; la petición se confirma en cuanto está en disco
+      flusher    → toma hasta `lote` filas listas, se queda con la última por nota,
+                   agrupa por sesión y llama escribir(cliente, notas) por sesión (en paralelo)
+      éxito      → borra las filas aplicadas (las más nuevas de la misma nota siguen pendientes)
+      fallo      → backoff exponencial por fila (tope max_backoff_s); nunca se descarta
+    Al arrancar, lo que quedó en el archivo se reintenta (replay).
+    agregar() puede llamarse desde cualquier hilo; el flusher vive en el event loop de bucle().
+    """
+
+    def __init__(self, path: str, escribir: Callable[[Any, List[Dict[str, Any]]], None],
+                 lote: int = 100, flush_s: float = 0.5, max_backoff_s: float = 300.0,
+                 espera_lectura_s: float = 10.0):
+        self.escribir = escribir
+        self.lote = lote
+        self.flush_s = flush_s
+        self.max_backoff_s = max_backoff_s
+        self.espera_lectura_s = espera_lectura_s
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS notas ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, clave TEXT NOT NULL, sesion TEXT NOT NULL,"
+            " payload TEXT NOT NULL, creado REAL NOT NULL, intentos INTEGER NOT NULL DEFAULT 0,"
+            " proximo REAL NOT NULL DEFAULT 0, error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS notas_sesion ON notas (sesion)")
+        self._lock = threading.Lock()
+        self._despertar: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {"registradas": 0, "aplicadas": 0, "deduplicadas": 0, "fallos": 0,
+                      "lotes": 0, "flush_ms_ultimo": None, "flush_ms_total": 0.0, "ultimo_error": None}
+
+    @staticmethod
+    def _sesion(nota: Dict[str, Any]) -> str:
+        return "/".join(nota[k] for k in ("org_id", "doctor_uid", "patient_id", "session_id"))
+
+    def agregar(self, nota: Dict[str, Any]) -> None:
+        sesion = self._sesion(nota)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO notas (clave, sesion, payload, creado) VALUES (?, ?, ?, ?)",
+                (f"{sesion}/{nota['note_id']}", sesion, json.dumps(nota, ensure_ascii=False), time.time()),
+            )
+            self.stats["registradas"] += 1
+        self._avisar()
+
+    def _avisar(self) -> None:
+        """Despierta al flusher. asyncio.Event no es thread-safe: se agenda en su loop."""
+        if self._loop is not None and self._despertar is not None:
+            self._loop.call_soon_threadsafe(self._despertar.set)
+
+    def _tomar_lote(self) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT seq, clave, sesion, payload, intentos FROM notas WHERE proximo <= ? ORDER BY seq LIMIT ?",
+                (time.time(), self.lote),
+            ).fetchall()
+
+    def _confirmar(self, filas: List[tuple]) -> None:
+        with self._lock:
+            self._conn.executemany("DELETE FROM notas WHERE seq = ?", [(f[0],) for f in filas])
+            # Versiones más viejas de la misma nota que estaban en backoff: ya quedaron superadas
+            self._conn.executemany("DELETE FROM notas WHERE clave = ? AND seq < ?", [(f[1], f[0]) for f in filas])
+
+    def _posponer(self, filas: List[tuple], error: str) -> None:
+        ahora = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE notas SET intentos = intentos + 1, proximo = ?, error = ? WHERE seq = ?",
+                [(ahora + min(2 ** f[4], self.max_backoff_s), error[:500], f[0]) for f in filas],
+            )
+
+    def pendientes(self, sesion: Optional[str] = None) -> int:
+        with self._lock:
+            if sesion is None:
+                return self._conn.execute("SELECT COUNT(*) FROM notas").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM notas WHERE sesion = ?", (sesion,)).fetchone()[0]
+
+    async def vaciar(self, db_client) -> int:
+        """Un ciclo del flusher. Devuelve cuántas filas se aplicaron."""
+        filas = await asyncio.to_thread(self._tomar_lote)
+        if not filas:
+            return 0
+        t0 = time.perf_counter()
+        # Dedupe: por nota solo la escritura más reciente del lote; las anteriores se confirman con ella
+        por_clave: Dict[str, List[tuple]] = {}
+        for f in filas:
+            por_clave.setdefault(f[1], []).append(f)
+        self.stats["deduplicadas"] += len(filas) - len(por_clave)
+        por_sesion: Dict[str, List[List[tuple]]] = {}
+        for grupo in por_clave.values():
+            por_sesion.setdefault(grupo[-1][2], []).append(grupo)
+
+        async def _sesion(grupos: List[List[tuple]]) -> int:
+            notas = [json.loads(g[-1][3]) for g in grupos]
+            filas_sesion = [f for g in grupos for f in g]
+            try:
+                await asyncio.to_thread(self.escribir, db_client, notas)
+            except Exception as e:
+                self.stats["fallos"] += 1
+                self.stats["ultimo_error"] = str(e)[:300]
+                logger.warning(f"[diario] Sesión {grupos[0][-1][2]}: escritura fallida, se reintenta: {e}")
+                await asyncio.to_thread(self._posponer, filas_sesion, str(e))
+                return 0
+            await asyncio.to_thread(self._confirmar, filas_sesion)
+            return len(notas)
+
+        aplicadas = sum(await asyncio.gather(*[_sesion(g) for g in por_sesion.values()]))
+        ms = (time.perf_counter() - t0) * 1000
+        self.stats["aplicadas"] += aplicadas
+        self.stats["lotes"] += 1
+        self.stats["flush_ms_ultimo"] = round(ms, 1)
+        self.stats["flush_ms_total"] += ms
+        return aplicadas
+
+    async def bucle(self, db_client) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._despertar = asyncio.Event()
+        if self.pendientes():
+            logger.info(f"[diario] Replay: {self.pendientes()} escrituras pendientes de una ejecución anterior")
+        while True:
+            try:
+                await asyncio.wait_for(self._despertar.wait(), timeout=self.flush_s)
+            except asyncio.TimeoutError:
+                pass
+            self._despertar.clear()
+            try:
+                # Mientras haya lotes completos, seguir sin esperar
+                while await self.vaciar(db_client) >= self.lote:
+                    pass
+            except Exception as e:
+                logger.warning(f"[diario] Error en el flusher: {e}")
+
+    async def esperar_sesion(self, org_id: str, doctor_uid: str, patient_id: str, session_id: str,
+                             timeout: Optional[float] = None) -> bool:
+        """Para lecturas que deben ver lo ya confirmado al cliente (p. ej. finalizar la sesión)."""
+        sesion = "/".join((org_id, doctor_uid, patient_id, session_id))
+        limite = time.monotonic() + (self.espera_lectura_s if timeout is None else timeout)
+        while await asyncio.to_thread(self.pendientes, sesion):
+            if time.monotonic() > limite:
+                return False
+            self._avisar()
+            await asyncio.sleep(0.1)
+        return True
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            pendientes, mas_vieja, con_error = self._conn.execute(
+                "SELECT COUNT(*), MIN(creado), SUM(intentos > 0) FROM notas"
+            ).fetchone()
+        lotes = self.stats["lotes"]
+        return {
+            **{k: v for k, v in self.stats.items() if k != "flush_ms_total"},
+            "flush_ms_medio": round(self.stats["flush_ms_total"] / lotes, 1) if lotes else None,
+            "pendientes": pendientes,
+            "pendientes_con_error": con_error or 0,
+            "antiguedad_max_s": round(time.time() - mas_vieja, 1) if mas_vieja else 0.0,
+        }
@@ -0,0 +1,10 @@
+"""
+Emociones que extrae el análisis (lo usan análisis y orquestador).
+
+Una sola lista: el prompt del modelo, el léxico local y la serie diaria por paciente
+del orquestador deben coincidir, o las emociones nuevas no se acumularían.
+"""
+
+TARGET_EMOTIONS = [
+    "alegria","tristeza","enojo","miedo","sorpresa","disgusto","estres","calma","aversión","anticipación"
+]
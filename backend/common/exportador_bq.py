@@ -0,0 +1,252 @@
+"""
+Exportación de notas a BigQuery en micro-lotes (lo usa el orquestador).
+
+Las filas se juntan en memoria y se insertan con insert_rows_json (insertId por fila,
+{note_id}:v{version}:{i}, para que BigQuery deduplique reintentos de la misma versión).
+Lo que no se pudo insertar va a un spill ndjson durable, que se toma (rename atómico a
+*.reintento) y se reinserta con backoff exponencial mientras BigQuery siga fallando. El
+*.reintento se borra recién cuando todas sus filas se insertaron o volvieron al spill: si el
+proceso muere a mitad, el próximo arranque lo encuentra y lo reintenta.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("exportador_bq")
+
+class ExportadorBigQuery:
+    """
+    Buffer en memoria por tabla → insert_rows_json en bloque cada `flush_s` o al juntar
+    `lote` filas. Fallos (excepción o errores por fila) → spill ndjson durable. El spill se
+    reintenta cada `flush_s` mientras funcione; si el reintento falla, el siguiente espera el
+    doble (hasta `reintento_max_s`). Una fila que sigue fallando `max_espera_s` después de su
+    primer fallo va a {spill}.rechazadas para revisión manual: se cuenta tiempo, no intentos,
+    para que una caída de BigQuery de algunas horas no descarte nada.
+    encolar_nota() puede llamarse desde cualquier hilo; el flusher vive en el event loop de bucle().
+    """
+
+    def __init__(self, client, dataset: str, spill_path: str,
+                 filas_de: Callable[[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]],
+                 tablas: Iterable[str] = ("notes", "notes_emotions"), lote: int = 500,
+                 flush_s: float = 5.0, max_buffer: int = 20000, max_espera_s: float = 72 * 3600,
+                 reintento_max_s: float = 600.0):
+        self.client = client
+        self.dataset = dataset
+        self.spill_path = spill_path
+        self.filas_de = filas_de
+        self.lote = lote
+        self.flush_s = flush_s
+        self.max_buffer = max_buffer
+        self.max_espera_s = max_espera_s
+        self.reintento_max_s = reintento_max_s
+        self._reintentos_fallidos = 0          # reintentos del spill seguidos con fallos (backoff)
+        self._proximo_reintento = 0.0          # time.monotonic() a partir del cual se reintenta
+        os.makedirs(os.path.dirname(spill_path) or ".", exist_ok=True)
+        self._buffers: Dict[str, Deque[Dict[str, Any]]] = {t: deque() for t in tablas}
+        self._lock = threading.Lock()
+        self._despertar: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {"encoladas": 0, "insertadas": 0, "lotes": 0, "errores": 0, "a_spill": 0,
+                      "desde_spill": 0, "rechazadas": 0, "flush_ms_ultimo": None, "ultimo_error": None}
+
+    def _tabla(self, nombre: str) -> str:
+        return f"{self.client.project}.{self.dataset}.{nombre}"
+
+    def encolar_nota(self, nota: Dict[str, Any]) -> None:
+        """Thread-safe (se llama desde el hilo que escribió en Firestore)."""
+        filas = self.filas_de(nota)
+        if nota.get("version") is not None:
+            sello = f"v{nota['version']}"
+        else:
+            sello = hashlib.sha256(json.dumps(nota, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        excedente = []
+        with self._lock:
+            for tabla, fs in filas.items():
+                for i, f in enumerate(fs):
+                    fila = {"tabla": tabla, "id": f"{nota['note_id']}:{sello}:{i}", "fila": f}
+                    if len(self._buffers[tabla]) >= self.max_buffer:
+                        excedente.append(fila)
+                    else:
+                        self._buffers[tabla].append(fila)
+            self.stats["encoladas"] += sum(len(fs) for fs in filas.values())
+            lleno = any(len(b) >= self.lote for b in self._buffers.values())
+        if excedente:
+            self._a_spill(excedente, fallo=False)
+        if lleno and self._loop is not None and self._despertar is not None:
+            self._loop.call_soon_threadsafe(self._despertar.set)
+
+    def _a_spill(self, filas: List[Dict[str, Any]], fallo: bool = True) -> None:
+        """fallo=False: filas que no se intentaron (buffer lleno, cierre) y no cuentan como intento."""
+        reintentar, rechazadas = [], []
+        ahora = time.time()
+        for fila in filas:
+            fila = {**fila, "intentos": fila.get("intentos", 0) + int(fallo)}
+            if fallo:
+                fila.setdefault("primer_fallo", ahora)
+            vencida = ahora - fila.get("primer_fallo", ahora) > self.max_espera_s
+            (rechazadas if vencida else reintentar).append(fila)
+        with self._lock:
+            for path, grupo in ((self.spill_path, reintentar), (f"{self.spill_path}.rechazadas", rechazadas)):
+                if not grupo:
+                    continue
+                with open(path, "a", encoding="utf-8") as f:
+                    for fila in grupo:
+                        f.write(json.dumps(fila, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.stats["a_spill"] += len(reintentar)
+            self.stats["rechazadas"] += len(rechazadas)
+
+    def _desde_spill(self) -> int:
+        """
+        Bloqueante. Toma el spill (rename atómico: lo nuevo va a un spill nuevo) y reinserta
+        cada *.reintento pendiente, incluidos los que dejó un proceso que murió a mitad.
+        Si alguna fila volvió a fallar, agenda el próximo reintento con backoff.
+        """
+        with self._lock:
+            if os.path.exists(self.spill_path):
+                os.replace(self.spill_path, f"{self.spill_path}.{os.getpid()}.{time.time_ns()}.reintento")
+        leidas = fallidas = 0
+        for p in sorted(glob.glob(f"{glob.escape(self.spill_path)}.*.reintento")):
+            n, f = self._reintentar_archivo(p)
+            leidas, fallidas = leidas + n, fallidas + f
+        if fallidas:
+            self._reintentos_fallidos += 1
+            espera = min(self.reintento_max_s, self.flush_s * 2 ** self._reintentos_fallidos)
+            self._proximo_reintento = time.monotonic() + espera * random.uniform(0.5, 1.0)
+        else:
+            self._reintentos_fallidos = 0
+            self._proximo_reintento = 0.0
+        return leidas
+
+    def _reintentar_archivo(self, path: str) -> Tuple[int, int]:
+        """(filas leídas, filas que volvieron al spill)."""
+        import fcntl
+        try:
+            f = open(path, encoding="utf-8")
+        except FileNotFoundError:
+            return 0, 0
+        with f:
+            # flock: otro worker vivo que comparte el directorio puede estar con el mismo archivo
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0, 0
+            try:
+                if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    return 0, 0
+            except FileNotFoundError:
+                return 0, 0   # lo terminó y borró otro proceso mientras esperábamos
+            lotes: Dict[str, List[Dict[str, Any]]] = {}
+            n = fallidas = 0
+            for linea in f:
+                if not linea.strip():
+                    continue
+                try:
+                    fila = json.loads(linea)
+                except ValueError:
+                    # Última línea cortada por una caída durante la escritura del spill
+                    logger.warning(f"[bq] Línea ilegible en {path}, se descarta")
+                    continue
+                lote = lotes.setdefault(fila["tabla"], [])
+                lote.append(fila)
+                n += 1
+                if len(lote) >= self.lote:
+                    fallidas += self._insertar(fila["tabla"], lote)
+                    lotes[fila["tabla"]] = []
+            for tabla, lote in lotes.items():
+                if lote:
+                    fallidas += self._insertar(tabla, lote)
+            # Recién ahora: cada fila está en BigQuery o de vuelta en el spill
+            os.unlink(path)
+        with self._lock:
+            self.stats["desde_spill"] += n
+        return n, fallidas
+
+    def _insertar(self, tabla: str, filas: List[Dict[str, Any]]) -> int:
+        """Bloqueante. Lo que no entra va al spill; devuelve cuántas filas fueron."""
+        try:
+            errores = self.client.insert_rows_json(
+                self._tabla(tabla), [f["fila"] for f in filas], row_ids=[f["id"] for f in filas],
+            )
+        except Exception as e:
+            self.stats["errores"] += 1
+            self.stats["ultimo_error"] = str(e)[:300]
+            logger.warning(f"[bq] {tabla}: lote de {len(filas)} filas falló, a spill: {e}")
+            self._a_spill(filas)
+            return len(filas)
+        fallidas = sorted({err["index"] for err in errores or []})
+        if fallidas:
+            self.stats["errores"] += 1
+            self.stats["ultimo_error"] = str(errores[0].get("errors"))[:300]
+            logger.warning(f"[bq] {tabla}: {len(fallidas)} filas rechazadas, a spill: {errores[0]}")
+            self._a_spill([filas[i] for i in fallidas])
+        self.stats["insertadas"] += len(filas) - len(fallidas)
+        return len(fallidas)
+
+    async def vaciar(self) -> int:
+        t0 = time.perf_counter()
+        lotes = []
+        with self._lock:
+            for tabla, buf in self._buffers.items():
+                while buf:
+                    n = min(len(buf), self.lote)
+                    lotes.append((tabla, [buf.popleft() for _ in range(n)]))
+        if not lotes:
+            return 0
+        await asyncio.gather(*[asyncio.to_thread(self._insertar, t, fs) for t, fs in lotes])
+        self.stats["lotes"] += len(lotes)
+        self.stats["flush_ms_ultimo"] = round((time.perf_counter() - t0) * 1000, 1)
+        return sum(len(fs) for _, fs in lotes)
+
+    async def bucle(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._despertar = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._despertar.wait(), timeout=self.flush_s)
+            except asyncio.TimeoutError:
+                pass
+            self._despertar.clear()
+            try:
+                await self.vaciar()
+                if time.monotonic() >= self._proximo_reintento:
+                    await asyncio.to_thread(self._desde_spill)
+            except Exception as e:
+                logger.warning(f"[bq] Error en el exportador: {e}")
+
+    async def cerrar(self, timeout: float = 8) -> None:
+        """Último vaciado; lo que no alcance a insertarse queda en el spill para el próximo arranque."""
+        try:
+            await asyncio.wait_for(self.vaciar(), timeout=timeout)
+        except Exception as e:
+            logger.warning(f"[bq] Cierre con filas sin exportar: {e}")
+        with self._lock:
+            restantes = [f for b in self._buffers.values() for f in b]
+            for b in self._buffers.values():
+                b.clear()
+        if restantes:
+            self._a_spill(restantes, fallo=False)
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            en_buffer = {t: len(b) for t, b in self._buffers.items()}
+        espera = max(0.0, self._proximo_reintento - time.monotonic())
+        return {**self.stats, "en_buffer": en_buffer, "spill_bytes": _tamano(self.spill_path),
+                "proximo_reintento_s": round(espera, 1),
+                "reintento_bytes": sum(_tamano(p) for p in glob.glob(f"{glob.escape(self.spill_path)}.*.reintento"))}
+
+def _tamano(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
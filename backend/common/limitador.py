@@ -0,0 +1,112 @@
+"""
+Limitador de llamadas a Vertex AI (lo usan análisis y audio).
+
+Sin él, la concurrencia la fija el threadpool de Starlette y, cuando Vertex limita, las
+solicitudes se apilan sin contrapresión. Admite por tokens/minuto y por concurrencia;
+lo que no cabe espera en una cola con deadline y, si no alcanza, sale 429 con Retry-After.
+"""
+
+import math
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+class Saturado(HTTPException):
+    """Cola llena o deadline vencido → 429 con Retry-After."""
+    def __init__(self, retry_after: float, detail: str = "Servicio saturado, reintenta más tarde."):
+        super().__init__(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+class LimitadorVertex:
+    """
+    Admite llamadas por tokens estimados en una ventana deslizante de 60 s y por
+    solicitudes concurrentes. Lo que no cabe espera (FIFO aproximado) hasta
+    `deadline_s`; si ya hay `max_cola` esperando, se rechaza de inmediato.
+    """
+
+    def __init__(self, tpm: int, concurrencia: int, max_cola: int, deadline_s: float,
+                 mensaje_saturado: str = "Servicio saturado, reintenta más tarde."):
+        self.tpm = tpm
+        self.concurrencia = concurrencia
+        self.max_cola = max_cola
+        self.deadline_s = deadline_s
+        self.mensaje_saturado = mensaje_saturado
+        self.en_curso = 0
+        self.en_cola = 0
+        self.ventana: Deque[Tuple[float, int]] = deque()
+        self.tokens_ventana = 0
+        self.admitidas = 0
+        self.rechazadas = 0
+        self.vencidas = 0
+        self._cond: Optional[asyncio.Condition] = None
+
+    def _purgar(self, ahora: float) -> None:
+        while self.ventana and ahora - self.ventana[0][0] >= 60:
+            self.tokens_ventana -= self.ventana.popleft()[1]
+
+    def _cabe(self, tokens: int) -> bool:
+        if self.en_curso >= self.concurrencia:
+            return False
+        # Una solicitud más grande que el TPM entra sola con la ventana vacía
+        return self.tokens_ventana + tokens <= self.tpm or not self.ventana
+
+    def _espera_estimada(self, ahora: float, tokens: int) -> float:
+        """Si faltan tokens: segundos hasta que expire el consumo más antiguo; si no, ~1 s (concurrencia)."""
+        if self.ventana and self.tokens_ventana + tokens > self.tpm:
+            return max(0.05, self.ventana[0][0] + 60 - ahora)
+        return 1.0
+
+    async def adquirir(self, tokens: int) -> None:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        loop = asyncio.get_running_loop()
+        async with self._cond:
+            self._purgar(loop.time())
+            if not self._cabe(tokens):
+                if self.en_cola >= self.max_cola:
+                    self.rechazadas += 1
+                    raise Saturado(self._espera_estimada(loop.time(), tokens), self.mensaje_saturado)
+                self.en_cola += 1
+                limite = loop.time() + self.deadline_s
+                try:
+                    while True:
+                        ahora = loop.time()
+                        self._purgar(ahora)
+                        if self._cabe(tokens):
+                            break
+                        restante = limite - ahora
+                        if restante <= 0:
+                            self.vencidas += 1
+                            raise Saturado(self._espera_estimada(ahora, tokens), "Tiempo de espera agotado en la cola de Vertex.")
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), min(restante, self._espera_estimada(ahora, tokens)))
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    self.en_cola -= 1
+            self.en_curso += 1
+            self.admitidas += 1
+            self.ventana.append((loop.time(), tokens))
+            self.tokens_ventana += tokens
+
+    async def liberar(self) -> None:
+        async with self._cond:
+            self.en_curso -= 1
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def admitir(self, tokens: int):
+        await self.adquirir(tokens)
+        try:
+            yield
+        finally:
+            await self.liberar()
+
+    def estado(self) -> Dict[str, Any]:
+        return {
+            "en_curso": self.en_curso, "en_cola": self.en_cola, "tokens_ultimo_minuto": self.tokens_ventana,
+            "tpm": self.tpm, "concurrencia": self.concurrencia,
+            "admitidas": self.admitidas, "rechazadas": self.rechazadas, "vencidas": self.vencidas,
+        }
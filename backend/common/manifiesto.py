@@ -0,0 +1,132 @@
+"""
+Manifiesto por sesión: un JSON compacto que indexa todo lo que hay bajo
+  {org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/
+
+    {
+      "v": 1,
+      "actualizado": "20250101_120000",
+      "objetos": {                                 # clave = ruta relativa a la sesión
+        "raw/n1_20250101_115959.jpg":            {"size": 123, "sha256": "...", "ts": "...", "ct": "image/jpeg", "nota": "n1"},
+        "derived/ocr/n1/ocr_20250101_120000.json": {"size": 456, "sha256": "...", "ts": "...", "ct": "application/json", "nota": "n1"}
+      },
+      "ultimos": {"ocr/n1/ocr": "derived/ocr/n1/ocr_20250101_120000.json", "raw/n1/n1": "raw/n1_..."}
+    }
+
+"ultimos" responde "el último derivado de tipo X de la nota N" sin listar prefijos. La clave
+lleva el nombre del archivo sin sello de tiempo ({tipo}/{nota}/{familia}): las versiones de
+ocr_*.json compiten entre sí, pero thumb.webp y preview.webp no se pisan.
+Las actualizaciones son lectura-modificación-escritura condicionadas a la generación
+leída (if_generation_match en GCS, flock en disco): si otro servicio escribió entre
+medio, se relee y se reintenta.
+"""
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from .storage import json_compacto, partir_uri
+
+MANIFEST_NAME    = "manifest.json"
+MANIFEST_RETRIES = int(os.getenv("STORAGE_MANIFEST_RETRIES", "8"))
+
+logger = logging.getLogger("manifiesto")
+
+def _ts() -> str:
+    return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+def describir(uri: str, data: Optional[bytes] = None, fileobj=None,
+              content_type: str = "application/octet-stream", nota: Optional[str] = None) -> Dict[str, Any]:
+    """Entrada de manifiesto para un objeto recién escrito (hash del contenido que se subió).
+    Con fileobj (spool de una subida en streaming) se hashea por chunks sin cargarlo entero."""
+    if data is not None:
+        size, sha = len(data), hashlib.sha256(data).hexdigest()
+    elif fileobj is not None:
+        h, size = hashlib.sha256(), 0
+        fileobj.seek(0)
+        for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+            h.update(chunk)
+            size += len(chunk)
+        sha = h.hexdigest()
+    else:
+        raise ValueError("describir() requiere data o fileobj")
+    return {"uri": uri, "size": size, "sha256": sha, "ts": _ts(), "ct": content_type, "nota": nota}
+
+def _tipo(relativa: str) -> str:
+    """raw/...                      -> "raw"
+       derived/{tipo}/{nota}/...    -> tipo"""
+    partes = relativa.split("/")
+    return partes[1] if partes[0] == "derived" and len(partes) > 2 else partes[0]
+
+_SELLO = re.compile(r"_\d{8}_\d{6}$")
+
+def _familia(relativa: str) -> str:
+    """.../ocr_20250101_120000.json -> "ocr";  .../thumb.webp -> "thumb"  (sin extensiones ni sello)"""
+    return _SELLO.sub("", relativa.rsplit("/", 1)[-1].split(".", 1)[0])
+
+class Manifiesto:
+    def __init__(self, almacen):
+        self.almacen = almacen
+
+    def ruta(self, org_id: str, doctor_uid: str, patient_id: str, session_id: str) -> str:
+        return self.almacen.ruta(org_id, doctor_uid, patient_id, session_id, MANIFEST_NAME)
+
+    def leer(self, org_id: str, doctor_uid: str, patient_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        data, _ = self.almacen.leer_con_generacion(self.ruta(org_id, doctor_uid, patient_id, session_id))
+        return None if data is None else json.loads(data)
+
+    def registrar(self, org_id: str, doctor_uid: str, patient_id: str, session_id: str,
+                  entradas: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """Agrega/actualiza entradas (de describir()) en una sola escritura condicionada."""
+        ruta = self.ruta(org_id, doctor_uid, patient_id, session_id)
+        base = self.almacen.ruta(org_id, doctor_uid, patient_id, session_id) + "/"
+        nuevas: List[Dict[str, Any]] = []
+        for e in entradas:
+            _, obj = partir_uri(e["uri"])
+            if not obj.startswith(base):
+                raise ValueError(f"{e['uri']} no pertenece a la sesión {session_id}")
+            nuevas.append({**e, "rel": obj[len(base):]})
+
+        for intento in range(MANIFEST_RETRIES):
+            raw, generacion = self.almacen.leer_con_generacion(ruta)
+            m = json.loads(raw) if raw else {"v": 1, "objetos": {}, "ultimos": {}}
+            for e in nuevas:
+                m["objetos"][e["rel"]] = {k: e[k] for k in ("size", "sha256", "ts", "ct", "nota", "contenido") if e.get(k) is not None}
+                if e.get("nota"):
+                    clave = f"{_tipo(e['rel'])}/{e['nota']}/{_familia(e['rel'])}"
+                    previo = m["ultimos"].get(clave)
+                    # Los nombres llevan timestamp: el mayor es el más reciente
+                    if previo is None or e["rel"] >= previo:
+                        m["ultimos"][clave] = e["rel"]
+            m["actualizado"] = _ts()
+            if self.almacen.escribir_si_generacion(ruta, json_compacto(m), "application/json", generacion):
+                return m
+            time.sleep(min(0.05 * 2 ** intento, 1.0) * random.uniform(0.5, 1.0))
+        raise RuntimeError(f"Manifiesto {ruta}: conflicto persistente tras {MANIFEST_RETRIES} intentos")
+
+    def registrar_seguro(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        """Como registrar(), pero un fallo solo se registra en el log: el artefacto ya está escrito."""
+        try:
+            return self.registrar(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"[manifiesto] No se pudo actualizar: {e}")
+            return None
+
+    @staticmethod
+    def ultimo(m: Optional[Dict[str, Any]], tipo: str, nota: str, familia: Optional[str] = None) -> Optional[str]:
+        """Ruta relativa del último objeto `tipo` de `nota` (de esa familia si se indica), o None.
+        Sin familia compiten los últimos de todas sus familias, más la clave {tipo}/{nota} de
+        manifiestos anteriores a las familias: gana el registrado más tarde ("ts" de su entrada)
+        y, con el mismo ts, el de nombre mayor (los sellos _YYYYMMDD_HHMMSS ordenan como fechas)."""
+        m = m or {}
+        ultimos, objetos = m.get("ultimos", {}), m.get("objetos", {})
+        if familia is not None:
+            return ultimos.get(f"{tipo}/{nota}/{familia}")
+        prefijo = f"{tipo}/{nota}/"
+        candidatos = [rel for k, rel in ultimos.items() if k.startswith(prefijo) or k == f"{tipo}/{nota}"]
+        return max(candidatos, key=lambda rel: (objetos.get(rel, {}).get("ts", ""), rel), default=None)
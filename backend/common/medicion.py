@@ -0,0 +1,167 @@
+"""
+Medición de tokens/costo por llamada a Gemini (lo usan análisis y audio).
+
+Cada llamada real al modelo se registra con su usage_metadata, latencia y el alcance de la
+solicitud (org, doctor, sesión, nota); se agrega en memoria para /metrics y se envía por
+lotes al sink de analítica.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("medicion")
+
+# Alcance de la solicitud en curso (org, doctor, sesión, nota). Las corrutinas creadas
+# con gather/create_task heredan el contexto, así que no hace falta pasarlo por parámetro.
+ALCANCE: ContextVar[Dict[str, Optional[str]]] = ContextVar("alcance_medicion", default={})
+
+def fijar_alcance(org_id: Optional[str], doctor_uid: Optional[str],
+                  session_id: Optional[str] = None, note_id: Optional[str] = None) -> None:
+    ALCANCE.set({"org_id": org_id, "doctor_uid": doctor_uid, "session_id": session_id, "note_id": note_id})
+
+class Medidor:
+    """
+    Registra cada llamada al modelo (usage_metadata, latencia, modelo, alcance), agrega en
+    memoria por (org, modelo, operación) y manda las filas por lotes al sink de analítica:
+      - "gcs":      NDJSON en {prefix}_metering/{servicio}/ds=YYYY-MM-DD/ (tabla externa/carga en BQ)
+      - "bigquery": insert_rows_json a `bq_tabla`
+      - "none":     solo agregados en memoria
+    Cada lote de "gcs" se parte por el día UTC de sus filas (un objeto por partición ds=).
+    La configuración inválida (sink desconocido, bigquery sin tabla, gcs sin almacén) se rechaza al arrancar:
+    de otro modo cada envío fallaría y las filas se acumularían hasta descartarse.
+    """
+
+    def __init__(self, servicio: str, sink: str, lote: int, *, modelo: str,
+                 precios: Dict[str, Dict[str, float]], flush_s: float = 60.0, max_pendientes: int = 20000,
+                 bq_tabla: str = "", proyecto: Optional[str] = None, almacen=None):
+        if sink not in ("gcs", "bigquery", "none"):
+            raise ValueError(f"Sink de medición desconocido: {sink}")
+        if sink == "bigquery" and not bq_tabla:
+            raise ValueError("METER_SINK=bigquery requiere METER_BQ_TABLE (proyecto.dataset.tabla)")
+        if sink == "gcs" and almacen is None:
+            raise ValueError("METER_SINK=gcs requiere almacenamiento (USE_GCS=true) o METER_SINK=none")
+        self.servicio = servicio
+        self.sink = sink
+        self.lote = lote
+        self.modelo = modelo
+        self.precios = precios
+        self.flush_s = flush_s
+        self.max_pendientes = max_pendientes
+        self.bq_tabla = bq_tabla
+        self.proyecto = proyecto
+        self.almacen = almacen
+        self.agregados: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+        self.pendientes: List[Dict[str, Any]] = []
+        self.ultimo_envio = time.time()
+        self.envios_fallidos = 0
+        self._lock = threading.Lock()
+
+    def registrar(self, operacion: str, respuesta, latencia_ms: float, **extra) -> None:
+        usage = getattr(respuesta, "usage_metadata", None)
+        tokens_in = int(getattr(usage, "prompt_token_count", 0) or 0)
+        tokens_out = int(getattr(usage, "candidates_token_count", 0) or 0)
+        precio_in, precio_out = self.precio(self.modelo)
+        costo = (tokens_in * precio_in + tokens_out * precio_out) / 1_000_000
+        alcance = ALCANCE.get()
+        fila = {
+            "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "servicio": self.servicio, "operacion": operacion, "modelo": self.modelo,
+            "org_id": alcance.get("org_id"), "doctor_uid": alcance.get("doctor_uid"),
+            "session_id": alcance.get("session_id"), "note_id": alcance.get("note_id"),
+            "tokens_entrada": tokens_in, "tokens_salida": tokens_out,
+            "latencia_ms": round(latencia_ms, 1), "costo_usd": round(costo, 8),
+            **extra,
+        }
+        clave = (fila["org_id"] or "_sin_org", self.modelo, operacion)
+        with self._lock:
+            agg = self.agregados.setdefault(clave, {"llamadas": 0, "tokens_entrada": 0, "tokens_salida": 0,
+                                                    "latencia_ms": 0.0, "costo_usd": 0.0})
+            agg["llamadas"] += 1
+            agg["tokens_entrada"] += tokens_in
+            agg["tokens_salida"] += tokens_out
+            agg["latencia_ms"] += latencia_ms
+            agg["costo_usd"] += costo
+            if self.sink != "none" and len(self.pendientes) < self.max_pendientes:
+                self.pendientes.append(fila)
+
+    def debe_enviar(self) -> bool:
+        with self._lock:
+            return bool(self.pendientes) and (
+                len(self.pendientes) >= self.lote or time.time() - self.ultimo_envio >= self.flush_s
+            )
+
+    def enviar(self) -> None:
+        """Bloqueante (correr en threadpool). Si el sink falla, las filas vuelven a la cola."""
+        with self._lock:
+            filas, self.pendientes = self.pendientes, []
+            self.ultimo_envio = time.time()
+        if not filas:
+            return
+        if self.sink == "gcs":
+            self._enviar_gcs(filas)
+            return
+        try:
+            if self.sink == "bigquery":
+                from google.cloud import bigquery
+                errores = bigquery.Client(project=self.proyecto).insert_rows_json(self.bq_tabla, filas)
+                if errores:
+                    raise RuntimeError(str(errores)[:500])
+        except Exception as e:
+            self._reencolar(filas, e)
+
+    def _enviar_gcs(self, filas: List[Dict[str, Any]]) -> None:
+        """Un objeto NDJSON por día UTC: un lote que cruza la medianoche no cae todo en ds= del primero.
+        Si falla una partición solo vuelven a la cola sus filas (las demás ya quedaron escritas)."""
+        por_dia: Dict[str, List[Dict[str, Any]]] = {}
+        for fila in filas:
+            por_dia.setdefault(fila["ts"][:10], []).append(fila)
+        ts = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+        for ds, filas_dia in por_dia.items():
+            try:
+                path = self.almacen.ruta_servicio("_metering", self.servicio, f"ds={ds}",
+                                                  f"{ts}_{os.getpid()}_{len(filas_dia)}.ndjson")
+                self.almacen.put_bytes(path, "\n".join(json.dumps(f, ensure_ascii=False) for f in filas_dia).encode("utf-8"),
+                                       "application/x-ndjson", comprimir=True)
+            except Exception as e:
+                self._reencolar(filas_dia, e)
+
+    def _reencolar(self, filas: List[Dict[str, Any]], error: Exception) -> None:
+        self.envios_fallidos += 1
+        logger.warning(f"[medicion] No se pudo enviar lote de {len(filas)} filas: {error}")
+        with self._lock:
+            self.pendientes = (filas + self.pendientes)[:self.max_pendientes]
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            por_org = [
+                {"org_id": org, "modelo": modelo, "operacion": op, **{k: round(v, 6) for k, v in agg.items()},
+                 "latencia_ms_media": round(agg["latencia_ms"] / agg["llamadas"], 1)}
+                for (org, modelo, op), agg in self.agregados.items()
+            ]
+            pendientes = len(self.pendientes)
+        return {
+            "sink": self.sink, "pendientes": pendientes, "envios_fallidos": self.envios_fallidos,
+            "tokens_entrada": sum(r["tokens_entrada"] for r in por_org),
+            "tokens_salida": sum(r["tokens_salida"] for r in por_org),
+            "costo_usd": round(sum(r["costo_usd"] for r in por_org), 6),
+            # Lo más caro primero: guía para optimizar prompts
+            "por_org_modelo_operacion": sorted(por_org, key=lambda r: r["costo_usd"], reverse=True),
+        }
+
+    def precio(self, modelo: str) -> Tuple[float, float]:
+        """USD por 1M tokens (entrada, salida)."""
+        p = self.precios.get(modelo, {})
+        return float(p.get("entrada", 0.0)), float(p.get("salida", 0.0))
+
+    async def bucle(self, cada_s: float = 5.0) -> None:
+        while True:
+            await asyncio.sleep(cada_s)
+            if self.debe_enviar():
+                await asyncio.to_thread(self.enviar)
@@ -0,0 +1,630 @@
+"""
+Almacenamiento de artefactos compartido por los servicios (OCR, audio, análisis, orquestador).
+
+Un solo lugar para la E/S de objetos:
+  - cliente de GCS perezoso con pool HTTP ajustado (STORAGE_POOL_SIZE conexiones)
+  - JSON compacto, opcionalmente con gzip (Content-Encoding: gzip; GCS lo transcodifica al leer)
+  - verificación CRC32C en subidas y descargas
+  - reintentos con backoff (DEFAULT_RETRY de google-cloud-storage, también en subidas:
+    nuestros objetos tienen nombres únicos o contenido idéntico, así que reintentar es seguro)
+  - métricas de E/S (operaciones, bytes, errores, latencia) y caché de lectura opcional
+
+Dos backends con la misma interfaz (se elige por servicio con *_STORAGE_BACKEND):
+  - "gcs":   bucket de Google Cloud Storage
+  - "local": disco local bajo *_STORAGE_ROOT (benchmarks offline, CI, una sola máquina).
+             Escrituras atómicas (archivo temporal + os.replace) y abrir() con mmap
+             para medios grandes. Cada objeto lleva un contador de generación en
+             {archivo}.gen, que también es el flock de sus escritores.
+             Las URIs siguen siendo gs://{bucket}/{ruta}: son identificadores
+             lógicos que los servicios se pasan entre sí, y se guardan en
+             {root}/{bucket}/{ruta}.
+
+API síncrona (para hilos) y asíncrona (prefijo a_: corre la síncrona en un hilo).
+
+Layout de objetos:
+  {prefix}{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/raw|derived/...
+"""
+
+import os
+import json
+import gzip
+import time
+import mmap
+import shutil
+import asyncio
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Config (común a todos los servicios)
+POOL_SIZE            = int(os.getenv("STORAGE_POOL_SIZE", "32"))
+GZIP_JSON            = os.getenv("STORAGE_GZIP_JSON", "false").lower() == "true"
+GZIP_MIN_BYTES       = int(os.getenv("STORAGE_GZIP_MIN_BYTES", "4096"))
+UPLOAD_CHUNK_BYTES   = int(os.getenv("STORAGE_UPLOAD_CHUNK_MB", "8")) * 1024 * 1024  # múltiplo de 256 KiB
+READ_CACHE_ITEMS     = int(os.getenv("STORAGE_READ_CACHE_ITEMS", "0"))  # 0 = sin caché de lectura
+READ_CACHE_MAX_BYTES = int(os.getenv("STORAGE_READ_CACHE_MAX_BYTES", str(1024 * 1024)))
+MMAP_MIN_BYTES       = int(os.getenv("STORAGE_MMAP_MIN_BYTES", str(1024 * 1024)))  # backend local
+
+def partir_uri(uri: str) -> Tuple[str, str]:
+    """gs://bucket/path -> (bucket, path)"""
+    if not uri or not uri.startswith("gs://") or "/" not in uri[5:]:
+        raise ValueError("gcs_uri inválido")
+    bucket, path = uri[5:].split("/", 1)
+    return bucket, path
+
+def json_compacto(data: Any) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class MetricasIO:
+    """Contadores por operación: {op: {ops, bytes, errores, ms}}."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.por_op: Dict[str, Dict[str, float]] = {}
+        self.cache_hits = 0
+
+    @contextmanager
+    def medir(self, op: str, nbytes: int = 0):
+        t0 = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            with self._lock:
+                m = self.por_op.setdefault(op, {"ops": 0, "bytes": 0, "errores": 0, "ms": 0.0})
+                m["ops"] += 1
+                m["bytes"] += nbytes
+                m["errores"] += int(error)
+                m["ms"] += (time.perf_counter() - t0) * 1000
+
+    def sumar_bytes(self, op: str, nbytes: int) -> None:
+        with self._lock:
+            self.por_op.setdefault(op, {"ops": 0, "bytes": 0, "errores": 0, "ms": 0.0})["bytes"] += nbytes
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cache_hits": self.cache_hits,
+                "por_operacion": {
+                    op: {**m, "ms": round(m["ms"], 1), "ms_media": round(m["ms"] / m["ops"], 2) if m["ops"] else None}
+                    for op, m in self.por_op.items()
+                },
+            }
+
+class _Almacen:
+    """Layout, caché de lectura, métricas y wrappers async comunes a ambos backends.
+    Las rutas son relativas al bucket (ya incluyen el prefijo)."""
+
+    backend = "base"
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        self.bucket_name = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix else ""
+        self.metricas = MetricasIO()
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+    # ── Layout ────────────────────────────────────────────────────────────────
+    def ruta(self, org_id: str, doctor_uid: str, patient_id: str, session_id: str, *partes: str) -> str:
+        return "/".join([f"{self.prefix}{org_id}", doctor_uid, patient_id, "sessions", session_id, *partes])
+
+    def ruta_paciente(self, org_id: str, doctor_uid: str, patient_id: str, *partes: str) -> str:
+        return "/".join([f"{self.prefix}{org_id}", doctor_uid, patient_id, *partes])
+
+    def ruta_servicio(self, *partes: str) -> str:
+        """Objetos internos fuera del árbol de pacientes (p. ej. _cache/, _metering/)."""
+        return self.prefix + "/".join(partes)
+
+    def uri(self, ruta: str) -> str:
+        return f"gs://{self.bucket_name}/{ruta}"
+
+    def _resolver(self, uri_o_ruta: str) -> Tuple[str, str]:
+        if uri_o_ruta.startswith("gs://"):
+            return partir_uri(uri_o_ruta)
+        return self.bucket_name, uri_o_ruta
+
+    # ── Caché de lectura (opcional) ───────────────────────────────────────────
+    def _cache_get(self, clave: str) -> Optional[bytes]:
+        if not READ_CACHE_ITEMS:
+            return None
+        with self._lock:
+            data = self._cache.get(clave)
+            if data is not None:
+                self._cache.move_to_end(clave)
+                self.metricas.cache_hits += 1
+            return data
+
+    def _cache_put(self, clave: str, data: bytes) -> None:
+        if not READ_CACHE_ITEMS or len(data) > READ_CACHE_MAX_BYTES:
+            return
+        with self._lock:
+            self._cache[clave] = data
+            while len(self._cache) > READ_CACHE_ITEMS:
+                self._cache.popitem(last=False)
+
+    def _invalidar(self, uri_o_ruta: str) -> None:
+        if READ_CACHE_ITEMS:
+            with self._lock:
+                self._cache.pop(self.uri(self._resolver(uri_o_ruta)[1]), None)
+
+    # ── Interfaz (cada backend implementa estas) ──────────────────────────────
+    @property
+    def client(self):
+        return None
+
+    def put_bytes(self, ruta: str, data: bytes, content_type: str, *, comprimir: bool = False,
+                  cache_control: Optional[str] = None) -> str:
+        raise NotImplementedError
+
+    def put_stream(self, ruta: str, fileobj, content_type: str, chunk_size: int = UPLOAD_CHUNK_BYTES) -> str:
+        raise NotImplementedError
+
+    def get_bytes(self, uri_o_ruta: str) -> bytes:
+        raise NotImplementedError
+
+    def metadatos(self, uri_o_ruta: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @contextmanager
+    def abrir(self, uri_o_ruta: str) -> Iterator[Union[bytes, memoryview]]:
+        """Buffer de solo lectura del objeto (sin copia extra si el backend lo permite)."""
+        yield self.get_bytes(uri_o_ruta)
+
+    # Lectura-modificación-escritura condicionada (manifiestos, índices pequeños):
+    # generation 0 = el objeto no existe.
+    def leer_con_generacion(self, ruta: str) -> Tuple[Optional[bytes], int]:
+        raise NotImplementedError
+
+    def escribir_si_generacion(self, ruta: str, data: bytes, content_type: str, generacion: int) -> bool:
+        """Escribe solo si el objeto sigue en `generacion`. False si otro escritor ganó (412)."""
+        raise NotImplementedError
+
+    # Mantenimiento (jobs en background, no el camino de las peticiones)
+    def listar(self, prefijo: str) -> Iterator[Dict[str, Any]]:
+        """{"ruta", "size", "updated"} de cada objeto bajo `prefijo`."""
+        raise NotImplementedError
+
+    def borrar(self, ruta: str) -> None:
+        raise NotImplementedError
+
+    def tocar(self, uri_o_ruta: str) -> Optional[Dict[str, Any]]:
+        """Renueva `updated` (el objeto se está usando) y devuelve sus metadatos; None si no existe.
+        Es atómico respecto de borrar_si_viejo: o el objeto queda renovado o ya no existe."""
+        raise NotImplementedError
+
+    def borrar_si_viejo(self, ruta: str, limite: datetime) -> bool:
+        """Borra solo si `updated` sigue siendo anterior a `limite` al momento de borrar."""
+        raise NotImplementedError
+
+    # ── Derivados ─────────────────────────────────────────────────────────────
+    def put_json(self, ruta: str, data: Any, *, comprimir: Optional[bool] = None) -> str:
+        """JSON compacto; con gzip si se pide o si STORAGE_GZIP_JSON y supera STORAGE_GZIP_MIN_BYTES."""
+        raw = json_compacto(data)
+        if comprimir is None:
+            comprimir = GZIP_JSON and len(raw) >= GZIP_MIN_BYTES
+        return self.put_bytes(ruta, raw, "application/json", comprimir=comprimir)
+
+    def get_text(self, uri_o_ruta: str) -> str:
+        return self.get_bytes(uri_o_ruta).decode("utf-8")
+
+    def get_json(self, uri_o_ruta: str) -> Any:
+        return json.loads(self.get_bytes(uri_o_ruta))
+
+    def existe(self, uri_o_ruta: str) -> bool:
+        return self.metadatos(uri_o_ruta) is not None
+
+    # ── Async ─────────────────────────────────────────────────────────────────
+    async def a_put_bytes(self, *args, **kwargs) -> str:
+        return await asyncio.to_thread(self.put_bytes, *args, **kwargs)
+
+    async def a_put_json(self, *args, **kwargs) -> str:
+        return await asyncio.to_thread(self.put_json, *args, **kwargs)
+
+    async def a_put_stream(self, *args, **kwargs) -> str:
+        return await asyncio.to_thread(self.put_stream, *args, **kwargs)
+
+    async def a_get_bytes(self, uri_o_ruta: str) -> bytes:
+        return await asyncio.to_thread(self.get_bytes, uri_o_ruta)
+
+    async def a_get_text(self, uri_o_ruta: str) -> str:
+        return await asyncio.to_thread(self.get_text, uri_o_ruta)
+
+    async def a_get_json(self, uri_o_ruta: str) -> Any:
+        return await asyncio.to_thread(self.get_json, uri_o_ruta)
+
+    async def a_metadatos(self, uri_o_ruta: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.metadatos, uri_o_ruta)
+
+class AlmacenGCS(_Almacen):
+    """Objetos en un bucket de GCS."""
+
+    backend = "gcs"
+
+    def __init__(self, bucket: str, prefix: str = "", project: Optional[str] = None):
+        super().__init__(bucket, prefix)
+        self.project = project
+        self._client = None
+
+    # ── Cliente ───────────────────────────────────────────────────────────────
+    @property
+    def client(self):
+        """Cliente perezoso con pool de conexiones dimensionado para subidas/descargas en paralelo."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import google.auth
+                    from google.auth.transport.requests import AuthorizedSession
+                    from google.cloud import storage
+                    from requests.adapters import HTTPAdapter
+
+                    creds, proyecto = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+                    sesion = AuthorizedSession(creds)
+                    adaptador = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                    sesion.mount("https://", adaptador)
+                    self._client = storage.Client(project=self.project or proyecto, credentials=creds, _http=sesion)
+        return self._client
+
+    def _blob(self, uri_o_ruta: str, **kwargs):
+        bucket, ruta = self._resolver(uri_o_ruta)
+        return self.client.bucket(bucket).blob(ruta, **kwargs)
+
+    # ── Escritura ─────────────────────────────────────────────────────────────
+    def put_bytes(self, ruta: str, data: bytes, content_type: str, *, comprimir: bool = False,
+                  cache_control: Optional[str] = None) -> str:
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        blob = self._blob(ruta)
+        if cache_control:
+            blob.cache_control = cache_control
+        if comprimir:
+            data = gzip.compress(data, compresslevel=6)
+            blob.content_encoding = "gzip"
+        with self.metricas.medir("put", len(data)):
+            blob.upload_from_string(data, content_type=content_type, checksum="crc32c", retry=DEFAULT_RETRY)
+        self._invalidar(ruta)
+        return self.uri(self._resolver(ruta)[1])
+
+    def put_stream(self, ruta: str, fileobj, content_type: str, chunk_size: int = UPLOAD_CHUNK_BYTES) -> str:
+        """Subida resumible por chunks desde un file-like (no carga el archivo completo en memoria)."""
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        blob = self._blob(ruta, chunk_size=chunk_size)
+        with self.metricas.medir("put_stream"):
+            blob.upload_from_file(fileobj, content_type=content_type, rewind=True, checksum="crc32c", retry=DEFAULT_RETRY)
+        self.metricas.sumar_bytes("put_stream", blob.size or 0)
+        self._invalidar(ruta)
+        return self.uri(self._resolver(ruta)[1])
+
+    # ── Lectura ───────────────────────────────────────────────────────────────
+    def get_bytes(self, uri_o_ruta: str) -> bytes:
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        bucket, ruta = self._resolver(uri_o_ruta)
+        clave = f"gs://{bucket}/{ruta}"
+        data = self._cache_get(clave)
+        if data is not None:
+            return data
+        blob = self.client.bucket(bucket).blob(ruta)
+        with self.metricas.medir("get"):
+            data = blob.download_as_bytes(checksum="crc32c", retry=DEFAULT_RETRY)
+        self.metricas.sumar_bytes("get", len(data))
+        self._cache_put(clave, data)
+        return data
+
+    @staticmethod
+    def _meta(blob) -> Dict[str, Any]:
+        return {"size": blob.size, "crc32c": blob.crc32c, "md5": blob.md5_hash,
+                "generation": blob.generation, "updated": blob.updated.isoformat() if blob.updated else None}
+
+    def metadatos(self, uri_o_ruta: str) -> Optional[Dict[str, Any]]:
+        """size/crc32c/md5/generation del objeto, o None si no existe."""
+        bucket, ruta = self._resolver(uri_o_ruta)
+        with self.metricas.medir("head"):
+            blob = self.client.bucket(bucket).get_blob(ruta)
+        if blob is None:
+            return None
+        return self._meta(blob)
+
+    def leer_con_generacion(self, ruta: str) -> Tuple[Optional[bytes], int]:
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        bucket, ruta = self._resolver(ruta)
+        with self.metricas.medir("get_gen"):
+            blob = self.client.bucket(bucket).get_blob(ruta)
+            if blob is None:
+                return None, 0
+            try:
+                # Fijamos la generación leída: si cambió entre get_blob y la descarga, se relee
+                data = blob.download_as_bytes(if_generation_match=blob.generation, retry=DEFAULT_RETRY)
+            except (NotFound, PreconditionFailed):
+                return self.leer_con_generacion(ruta)
+        return data, int(blob.generation)
+
+    def escribir_si_generacion(self, ruta: str, data: bytes, content_type: str, generacion: int) -> bool:
+        from google.api_core.exceptions import PreconditionFailed
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        blob = self._blob(ruta)
+        blob.cache_control = "no-store"
+        try:
+            with self.metricas.medir("put_gen", len(data)):
+                # Con if_generation_match el reintento es seguro (DEFAULT_RETRY lo permite)
+                blob.upload_from_string(data, content_type=content_type, if_generation_match=generacion,
+                                        checksum="crc32c", retry=DEFAULT_RETRY)
+        except PreconditionFailed:
+            return False
+        self._invalidar(ruta)
+        return True
+
+    def listar(self, prefijo: str) -> Iterator[Dict[str, Any]]:
+        # Paginado perezoso: no se materializa el listado completo en memoria
+        for b in self.client.list_blobs(self.bucket_name, prefix=prefijo, fields="items(name,size,updated),nextPageToken"):
+            yield {"ruta": b.name, "size": int(b.size or 0), "updated": b.updated.isoformat() if b.updated else None}
+
+    def borrar(self, ruta: str) -> None:
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        with self.metricas.medir("delete"):
+            self._blob(ruta).delete(retry=DEFAULT_RETRY)
+        self._invalidar(ruta)
+
+    def tocar(self, uri_o_ruta: str) -> Optional[Dict[str, Any]]:
+        # Un PATCH de metadata sube `updated` y la metageneración: un borrar_si_viejo
+        # que leyó la metageneración anterior recibe 412
+        from google.api_core.exceptions import NotFound
+        bucket, ruta = self._resolver(uri_o_ruta)
+        blob = self.client.bucket(bucket).blob(ruta)
+        blob.metadata = {"ultimo_uso": datetime.now(timezone.utc).isoformat()}
+        try:
+            with self.metricas.medir("touch"):
+                blob.patch()
+        except NotFound:
+            return None
+        return self._meta(blob)
+
+    def borrar_si_viejo(self, ruta: str, limite: datetime) -> bool:
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        bucket, ruta_b = self._resolver(ruta)
+        with self.metricas.medir("head"):
+            blob = self.client.bucket(bucket).get_blob(ruta_b)
+        if blob is None or blob.updated is None or blob.updated >= limite:
+            return False
+        try:
+            with self.metricas.medir("delete"):
+                blob.delete(if_generation_match=blob.generation, if_metageneration_match=blob.metageneration,
+                            retry=DEFAULT_RETRY)
+        except (NotFound, PreconditionFailed):
+            return False
+        self._invalidar(ruta)
+        return True
+
+class AlmacenLocal(_Almacen):
+    """Objetos en disco: gs://{bucket}/{ruta} -> {raiz}/{bucket}/{ruta}."""
+
+    backend = "local"
+
+    def __init__(self, bucket: str, prefix: str = "", raiz: str = "data_local"):
+        super().__init__(bucket, prefix)
+        self.raiz = os.path.abspath(raiz)
+
+    def _archivo(self, uri_o_ruta: str) -> str:
+        bucket, ruta = self._resolver(uri_o_ruta)
+        base = os.path.join(self.raiz, bucket)
+        path = os.path.normpath(os.path.join(base, ruta))
+        if not path.startswith(base + os.sep):
+            raise ValueError(f"Ruta fuera del almacén: {ruta}")
+        return path
+
+    @contextmanager
+    def _escritura_atomica(self, path: str):
+        """Escribe en un temporal del mismo directorio y lo publica con os.replace (atómico en POSIX):
+        un lector nunca ve un archivo a medio escribir."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    # ── Generación ────────────────────────────────────────────────────────────
+    # El mtime no sirve de generación: el kernel lo actualiza una vez por tick, así que dos
+    # escrituras seguidas pueden compartirlo. Se usa un contador en {archivo}.gen (ancho fijo),
+    # incrementado bajo su flock DESPUÉS de publicar los datos; los lectores leen la generación
+    # ANTES que los datos, así que datos viejos nunca van con una generación nueva.
+    _GEN_ANCHO = 20
+
+    @contextmanager
+    def _bloqueo(self, path: str) -> Iterator[int]:
+        """flock sobre {path}.gen: serializa escritores entre hilos y procesos de la misma máquina."""
+        import fcntl
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path + ".gen", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield fd
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _contador(raw: bytes) -> int:
+        try:
+            return int(raw.strip() or 0)
+        except ValueError:
+            return 0
+
+    def _generacion(self, path: str) -> int:
+        """0 si el objeto no existe (como if_generation_match=0 en GCS); ≥ 1 si existe."""
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path + ".gen", "rb") as f:
+                return max(self._contador(f.read(self._GEN_ANCHO)), 1)
+        except FileNotFoundError:
+            return 1  # objeto escrito sin contador (anterior a este esquema)
+
+    def _publicar(self, path: str, escribir, generacion: Optional[int] = None) -> bool:
+        """Escritura atómica + generación nueva. Con `generacion`, solo si sigue siendo la vigente."""
+        with self._bloqueo(path) as fd:
+            actual = max(self._contador(os.pread(fd, self._GEN_ANCHO, 0)), 1) if os.path.exists(path) else 0
+            if generacion is not None and actual != generacion:
+                return False
+            with self._escritura_atomica(path) as f:
+                escribir(f)
+            siguiente = max(self._contador(os.pread(fd, self._GEN_ANCHO, 0)), 1) + 1
+            os.pwrite(fd, str(siguiente).zfill(self._GEN_ANCHO).encode(), 0)
+            os.fsync(fd)
+        return True
+
+    # ── Escritura ─────────────────────────────────────────────────────────────
+    def put_bytes(self, ruta: str, data: bytes, content_type: str, *, comprimir: bool = False,
+                  cache_control: Optional[str] = None) -> str:
+        # En disco no hay transcodificación: se guarda sin comprimir para que get_bytes sea simétrico.
+        path = self._archivo(ruta)
+        with self.metricas.medir("put", len(data)):
+            self._publicar(path, lambda f: f.write(data))
+        self._invalidar(ruta)
+        return self.uri(self._resolver(ruta)[1])
+
+    def put_stream(self, ruta: str, fileobj, content_type: str, chunk_size: int = UPLOAD_CHUNK_BYTES) -> str:
+        path = self._archivo(ruta)
+        fileobj.seek(0)
+        with self.metricas.medir("put_stream"):
+            self._publicar(path, lambda f: shutil.copyfileobj(fileobj, f, chunk_size))
+        self.metricas.sumar_bytes("put_stream", os.path.getsize(path))
+        self._invalidar(ruta)
+        return self.uri(self._resolver(ruta)[1])
+
+    # ── Lectura ───────────────────────────────────────────────────────────────
+    def get_bytes(self, uri_o_ruta: str) -> bytes:
+        clave = self.uri(self._resolver(uri_o_ruta)[1])
+        data = self._cache_get(clave)
+        if data is not None:
+            return data
+        # Lectura directa (una sola copia). abrir() queda para quien pueda trabajar sobre la vista.
+        with self.metricas.medir("get"):
+            with self._abrir_archivo(uri_o_ruta) as f:
+                data = f.read()
+        self.metricas.sumar_bytes("get", len(data))
+        self._cache_put(clave, data)
+        return data
+
+    def _abrir_archivo(self, uri_o_ruta: str):
+        try:
+            return open(self._archivo(uri_o_ruta), "rb")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"No existe: {self.uri(self._resolver(uri_o_ruta)[1])}")
+
+    @contextmanager
+    def abrir(self, uri_o_ruta: str) -> Iterator[Union[bytes, memoryview]]:
+        """Archivos >= STORAGE_MMAP_MIN_BYTES se mapean en memoria (páginas bajo demanda, sin copia);
+        los pequeños se leen de una vez. La vista solo es válida dentro del with: quien necesite
+        bytes propios debe usar get_bytes (no copiar la vista)."""
+        with self._abrir_archivo(uri_o_ruta) as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_MIN_BYTES or size == 0:
+                yield f.read()
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                vista = memoryview(mm)
+                try:
+                    yield vista
+                finally:
+                    vista.release()
+
+    def metadatos(self, uri_o_ruta: str) -> Optional[Dict[str, Any]]:
+        """En disco no hay crc32c/md5 precalculados; generation = contador de {archivo}.gen."""
+        path = self._archivo(uri_o_ruta)
+        generacion = self._generacion(path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return {"size": st.st_size, "crc32c": None, "md5": None, "generation": generacion,
+                "updated": datetime.fromtimestamp(st.st_mtime, timezone.utc).isoformat()}
+
+    def leer_con_generacion(self, ruta: str) -> Tuple[Optional[bytes], int]:
+        path = self._archivo(ruta)
+        with self.metricas.medir("get_gen"):
+            generacion = self._generacion(path)   # antes que los datos (ver _publicar)
+            try:
+                with open(path, "rb") as f:
+                    return f.read(), generacion
+            except FileNotFoundError:
+                return None, 0
+
+    def escribir_si_generacion(self, ruta: str, data: bytes, content_type: str, generacion: int) -> bool:
+        path = self._archivo(ruta)
+        with self.metricas.medir("put_gen", len(data)):
+            if not self._publicar(path, lambda f: f.write(data), generacion):
+                return False
+        self._invalidar(ruta)
+        return True
+
+    def listar(self, prefijo: str) -> Iterator[Dict[str, Any]]:
+        base = os.path.join(self.raiz, self.bucket_name)
+        # El prefijo puede cortar un nombre a la mitad (como en GCS): se recorre desde su directorio
+        inicio = os.path.join(base, os.path.dirname(prefijo))
+        for dirpath, _, archivos in os.walk(inicio):
+            for nombre in archivos:
+                if nombre.startswith(".tmp_") or nombre.endswith((".gen", ".lock")):
+                    continue
+                path = os.path.join(dirpath, nombre)
+                ruta = os.path.relpath(path, base).replace(os.sep, "/")
+                if ruta.startswith(prefijo):
+                    st = os.stat(path)
+                    yield {"ruta": ruta, "size": st.st_size,
+                           "updated": datetime.fromtimestamp(st.st_mtime, timezone.utc).isoformat()}
+
+    def borrar(self, ruta: str) -> None:
+        # El .gen se conserva: si el objeto se vuelve a crear, la generación sigue creciendo
+        path = self._archivo(ruta)
+        with self.metricas.medir("delete"):
+            with self._bloqueo(path):
+                os.unlink(path)
+        self._invalidar(ruta)
+
+    def tocar(self, uri_o_ruta: str) -> Optional[Dict[str, Any]]:
+        path = self._archivo(uri_o_ruta)
+        with self._bloqueo(path):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        return self.metadatos(uri_o_ruta)
+
+    def borrar_si_viejo(self, ruta: str, limite: datetime) -> bool:
+        path = self._archivo(ruta)
+        with self.metricas.medir("delete"):
+            with self._bloqueo(path):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    return False
+                if datetime.fromtimestamp(st.st_mtime, timezone.utc) >= limite:
+                    return False
+                os.unlink(path)
+        self._invalidar(ruta)
+        return True
+
+def crear_almacen(bucket: str, prefix: str = "", project: Optional[str] = None,
+                  backend: str = "gcs", raiz: Optional[str] = None) -> _Almacen:
+    """backend: "gcs" | "local" (raiz = directorio base; por defecto ./data_local)."""
+    if backend == "local":
+        return AlmacenLocal(bucket, prefix, raiz or "data_local")
+    if backend != "gcs":
+        raise ValueError(f"Backend de almacenamiento desconocido: {backend}")
+    return AlmacenGCS(bucket, prefix, project)
@@ -1,11 +1,21 @@
+import io
 import os
 import json
+import asyncio
+import logging
+from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Awaitable
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Form, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from common.storage import crear_almacen, json_compacto
+from common.manifiesto import Manifiesto, describir
+from common.contenido import guardar_raw
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Config
 PROJECT_ID = os.getenv("OCR_PROJECT_ID", "terapia-471517")
@@ -14,17 +24,40 @@ LOCATION   = os.getenv("OCR_LOCATION", "us-central1")
 USE_GCS         = os.getenv("OCR_USE_GCS", "true").lower() == "true"
 GCS_BUCKET      = os.getenv("OCR_GCS_BUCKET", "ceroooooo")
 GCS_BASE_PREFIX = os.getenv("OCR_GCS_BASE_PREFIX", "")  # ej: "prod"
+STORAGE_BACKEND = os.getenv("OCR_STORAGE_BACKEND", "gcs").lower()  # "gcs" | "local"
+STORAGE_ROOT    = os.getenv("OCR_STORAGE_ROOT", "data_local")     # solo backend local
+RAW_DEDUP       = os.getenv("OCR_RAW_DEDUP", "true").lower() == "true"  # raw/ direccionado por SHA-256
+
+# Motor de OCR: "vision" | "tesseract" | "auto" (auto = router por calidad de imagen)
+OCR_ENGINE          = os.getenv("OCR_ENGINE", "vision").lower()
+TESSERACT_LANG      = os.getenv("OCR_TESSERACT_LANG", "spa")
+# Umbrales del router: contraste (desv. estándar de luminancia 0-255) y fracción de
+# píxeles "polarizados" (casi blanco o casi negro) para considerar una imagen impresa/limpia.
+ROUTER_MIN_CONTRAST = float(os.getenv("OCR_ROUTER_MIN_CONTRAST", "60"))
+ROUTER_MIN_BIMODAL  = float(os.getenv("OCR_ROUTER_MIN_BIMODAL", "0.85"))
+# Si el motor local devuelve confianza media (0-1) por debajo de esto, se escala a Vision.
+ROUTER_MIN_LOCAL_CONF = float(os.getenv("OCR_ROUTER_MIN_LOCAL_CONF", "0.70"))
+
+# Previews WebP derivados de la imagen raw (lado mayor en px)
+PREVIEWS_ENABLED = os.getenv("OCR_PREVIEWS", "true").lower() == "true"
+PREVIEW_SIZES    = {
+    "thumb":   int(os.getenv("OCR_THUMB_PX", "256")),
+    "preview": int(os.getenv("OCR_PREVIEW_PX", "1024")),
+}
+PREVIEW_QUALITY  = int(os.getenv("OCR_PREVIEW_QUALITY", "70"))
+
+logger = logging.getLogger(__name__)
+
+# Almacenamiento compartido (cliente perezoso: no importa google.cloud aquí)
+ALMACEN = crear_almacen(GCS_BUCKET, GCS_BASE_PREFIX, PROJECT_ID, STORAGE_BACKEND, STORAGE_ROOT)
+MANIFIESTO = Manifiesto(ALMACEN)  # índice por sesión (sessions/{session_id}/manifest.json)
 
 # Para evitar import-time failures, no importamos google.cloud aquí.
-_storage_client = None
 _vision_client = None
 
 def _ts() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
 
-def _prefix() -> str:
-    return f"{GCS_BASE_PREFIX.strip('/')}/" if GCS_BASE_PREFIX else ""
-
 def guess_mime(filename: str, fallback: str) -> str:
     low = (filename or "").lower()
     if low.endswith(".jpg") or low.endswith(".jpeg"): return "image/jpeg"
@@ -34,14 +67,6 @@ def guess_mime(filename: str, fallback: str) -> str:
     if low.endswith(".heic"): return "image/heic"
     return fallback
 
-def get_storage_client():
-    global _storage_client
-    if _storage_client is None:
-        # IMPORTAR AQUÍ
-        from google.cloud import storage
-        _storage_client = storage.Client(project=PROJECT_ID)
-    return _storage_client
-
 def get_vision_client():
     global _vision_client
     if _vision_client is None:
@@ -52,28 +77,215 @@ def get_vision_client():
         _vision_client = vision.ImageAnnotatorClient()
     return _vision_client
 
-def gcs_upload_bytes(org_id: str, doctor_uid: str, patient_id: str, session_id: str,
-                     subfolder: str, filename: str, content: bytes, content_type: str) -> str:
+def download_gcs_bytes(uri: str) -> bytes:
+    """gs://bucket/path -> bytes"""
+    if not uri.startswith("gs://"):
+        raise HTTPException(status_code=400, detail="gcs_uri inválido")
+    return ALMACEN.get_bytes(uri)
+
+def gcs_upload_raw(org_id: str, doctor_uid: str, patient_id: str, session_id: str, note_id: str,
+                   filename: str, content: bytes, content_type: str) -> Dict[str, Any]:
+    """Imagen cruda (deduplicada por contenido si OCR_RAW_DEDUP). Devuelve la entrada de manifiesto;
+    los bytes quedan en entrada["contenido"]."""
     if not USE_GCS:
         raise HTTPException(status_code=500, detail="GCS no habilitado en OCR.")
-    client = get_storage_client()
-    bucket = client.bucket(GCS_BUCKET)
-    path = f"{_prefix()}{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/{subfolder}/{filename}"
-    blob = bucket.blob(path)
-    blob.upload_from_string(content, content_type=content_type)
-    return f"gs://{GCS_BUCKET}/{path}"
+    return guardar_raw(ALMACEN, org_id, doctor_uid, patient_id, session_id, note_id, filename,
+                       content_type, data=content, dedup=RAW_DEDUP)
 
 def gcs_upload_json(org_id: str, doctor_uid: str, patient_id: str, session_id: str,
                     note_id: str, data: Dict[str, Any]) -> str:
     if not USE_GCS:
         raise HTTPException(status_code=500, detail="GCS no habilitado en OCR.")
-    client = get_storage_client()
-    bucket = client.bucket(GCS_BUCKET)
-    fname = f"ocr_{_ts()}.json"
-    path = f"{_prefix()}{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/derived/ocr/{note_id}/{fname}"
-    blob = bucket.blob(path)
-    blob.upload_from_string(json.dumps(data, ensure_ascii=False, indent=4), content_type="application/json")
-    return f"gs://{GCS_BUCKET}/{path}"
+    path = ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, "derived", "ocr", note_id, f"ocr_{_ts()}.json")
+    return ALMACEN.put_json(path, data)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Previews (thumbnails WebP)
+#
+# Nombres deterministas para que el orquestador pueda firmar la URL sin listar:
+#   .../sessions/{session_id}/derived/previews/{note_id}/{thumb|preview}.webp
+
+def preview_object_path(org_id: str, doctor_uid: str, patient_id: str, session_id: str,
+                        note_id: str, size: str) -> str:
+    return ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, "derived", "previews", note_id, f"{size}.webp")
+
+def render_webp(image_bytes: bytes, max_px: int) -> bytes:
+    from PIL import Image, ImageOps
+    img = Image.open(io.BytesIO(image_bytes))
+    img = ImageOps.exif_transpose(img)  # fotos de celular vienen rotadas por EXIF
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img.thumbnail((max_px, max_px))
+    out = io.BytesIO()
+    img.save(out, format="WEBP", quality=PREVIEW_QUALITY, method=4)
+    return out.getvalue()
+
+def _render_and_upload(image_bytes: bytes, object_path: str, max_px: int, note_id: str) -> Dict[str, Any]:
+    """Sube un tamaño y devuelve su entrada de manifiesto."""
+    data = render_webp(image_bytes, max_px)
+    uri = ALMACEN.put_bytes(object_path, data, "image/webp", cache_control="private, max-age=86400")
+    return describir(uri, data, content_type="image/webp", nota=note_id)
+
+async def generar_previews(image_bytes: Optional[bytes], gcs_uri: Optional[str],
+                           org_id: str, doctor_uid: str, patient_id: str,
+                           session_id: str, note_id: str) -> None:
+    """
+    Genera todos los tamaños en paralelo (hilos). Corre como BackgroundTask:
+    fuera del camino crítico del OCR, y un fallo aquí solo se registra.
+    """
+    try:
+        if image_bytes is None:
+            image_bytes = await run_in_threadpool(download_gcs_bytes, gcs_uri)
+        tareas = [
+            run_in_threadpool(
+                _render_and_upload, image_bytes,
+                preview_object_path(org_id, doctor_uid, patient_id, session_id, note_id, size), px, note_id,
+            )
+            for size, px in PREVIEW_SIZES.items()
+        ]
+        entradas = await asyncio.gather(*tareas)
+        await run_in_threadpool(MANIFIESTO.registrar_seguro, org_id, doctor_uid, patient_id, session_id, entradas)
+        logger.info(f"[previews] Nota {note_id}: {[e['uri'] for e in entradas]}")
+    except Exception as e:
+        logger.warning(f"[previews] No se pudieron generar previews para nota {note_id}: {e}")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Motores de OCR
+#
+# Cada motor recibe bytes de imagen y/o una gcs_uri y devuelve
+#   {"texto": str, "confianza": float | None, "motor": str}
+# Las dependencias de cada motor se importan de forma perezosa: el servicio arranca
+# aunque Tesseract/Pillow no estén instalados, y falla solo si se pide ese motor.
+
+class OCREngine(ABC):
+    name = "base"
+
+    @abstractmethod
+    def extract(self, image_bytes: Optional[bytes], gcs_uri: Optional[str]) -> Dict[str, Any]:
+        """{"texto", "confianza", "motor"}; si el motor no está instalado, HTTPException 501."""
+
+class VisionEngine(OCREngine):
+    """Google Cloud Vision (text_detection). Acepta bytes o gs:// directamente."""
+    name = "vision"
+
+    def extract(self, image_bytes: Optional[bytes], gcs_uri: Optional[str]) -> Dict[str, Any]:
+        vision_client = get_vision_client()
+        from google.cloud import vision  # seguro aquí
+
+        if image_bytes is None and ALMACEN.backend != "gcs":
+            image_bytes = download_gcs_bytes(gcs_uri)  # Vision solo lee gs:// reales
+        if image_bytes is not None:
+            image = vision.Image(content=image_bytes)
+        else:
+            image = vision.Image(source=vision.ImageSource(image_uri=gcs_uri))
+
+        response = vision_client.text_detection(image=image)
+        if getattr(response, "error", None) and response.error.message:
+            raise HTTPException(status_code=500, detail=response.error.message)
+
+        texto = ""
+        confianza = None
+        fta = getattr(response, "full_text_annotation", None)
+        if fta and fta.text:
+            texto = fta.text.strip()
+            # Confianza media por bloque (Vision la reporta 0-1)
+            confs = [b.confidence for p in fta.pages for b in p.blocks if b.confidence]
+            if confs:
+                confianza = sum(confs) / len(confs)
+        elif getattr(response, "text_annotations", None):
+            texto = (response.text_annotations[0].description or "").strip()
+
+        return {"texto": texto, "confianza": confianza, "motor": self.name}
+
+class TesseractEngine(OCREngine):
+    """Tesseract local en CPU (pytesseract + Pillow). Sin red ni costo por llamada."""
+    name = "tesseract"
+
+    def __init__(self, lang: str = TESSERACT_LANG):
+        self.lang = lang
+
+    def extract(self, image_bytes: Optional[bytes], gcs_uri: Optional[str]) -> Dict[str, Any]:
+        try:
+            import pytesseract
+            from PIL import Image
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Motor 'tesseract' no disponible (instala pytesseract y Pillow).")
+
+        if image_bytes is None:
+            image_bytes = download_gcs_bytes(gcs_uri)
+
+        img = Image.open(io.BytesIO(image_bytes))
+        img.load()
+        data = pytesseract.image_to_data(img, lang=self.lang, output_type=pytesseract.Output.DICT)
+
+        # Reconstruir texto respetando líneas (block, par, line) y promediar confianza por palabra
+        lineas: Dict[tuple, list] = {}
+        confs = []
+        for i, palabra in enumerate(data.get("text", [])):
+            palabra = (palabra or "").strip()
+            if not palabra:
+                continue
+            key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            lineas.setdefault(key, []).append(palabra)
+            try:
+                conf = float(data["conf"][i])
+            except (TypeError, ValueError):
+                conf = -1.0
+            if conf >= 0:
+                confs.append(conf)
+
+        texto = "\n".join(" ".join(ws) for _, ws in sorted(lineas.items())).strip()
+        confianza = (sum(confs) / len(confs) / 100.0) if confs else None
+        return {"texto": texto, "confianza": confianza, "motor": self.name}
+
+OCR_ENGINES: Dict[str, OCREngine] = {
+    VisionEngine.name: VisionEngine(),
+    TesseractEngine.name: TesseractEngine(),
+}
+
+def es_imagen_limpia(image_bytes: bytes) -> bool:
+    """
+    Heurística barata para el router: una nota impresa/escaneada tiene alto contraste
+    y un histograma casi bimodal (fondo claro + tinta oscura). Fotos de escritura a mano,
+    con sombras o papel rayado, quedan por debajo y se mandan a Vision.
+    """
+    try:
+        from PIL import Image, ImageStat
+    except ImportError:
+        return False
+    try:
+        img = Image.open(io.BytesIO(image_bytes)).convert("L")
+        img.thumbnail((512, 512))
+        contraste = ImageStat.Stat(img).stddev[0]
+        hist = img.histogram()
+        total = sum(hist) or 1
+        polarizados = (sum(hist[:64]) + sum(hist[192:])) / total
+        return contraste >= ROUTER_MIN_CONTRAST and polarizados >= ROUTER_MIN_BIMODAL
+    except Exception:
+        return False
+
+def ejecutar_ocr(engine: str, image_bytes: Optional[bytes], gcs_uri: Optional[str]) -> Dict[str, Any]:
+    """
+    Ejecuta el motor pedido. Con engine="auto":
+      - imagen limpia/impresa → Tesseract local; si su confianza es baja, se escala a Vision.
+      - cualquier otra (manuscrita, foto con ruido, o sin bytes locales) → Vision.
+    """
+    engine = (engine or OCR_ENGINE).lower()
+    if engine != "auto":
+        motor = OCR_ENGINES.get(engine)
+        if motor is None:
+            raise HTTPException(status_code=400, detail=f"Motor OCR desconocido: {engine}")
+        return motor.extract(image_bytes, gcs_uri)
+
+    if image_bytes is not None and es_imagen_limpia(image_bytes):
+        try:
+            local = OCR_ENGINES["tesseract"].extract(image_bytes, gcs_uri)
+            if local["texto"] and (local["confianza"] or 0) >= ROUTER_MIN_LOCAL_CONF:
+                return local
+        except HTTPException as e:
+            if e.status_code != 501:
+                raise
+    return OCR_ENGINES["vision"].extract(image_bytes, gcs_uri)
 
 # ──────────────────────────────────────────────────────────────────────────────
 
@@ -84,83 +296,148 @@ class OCRRespuesta(BaseModel):
     user_id: Optional[str]
     imagen_gcs: Optional[str]
     resultado: Dict[str, Any]  # {"texto": "...", "archivo_guardado_gcs": "gs://..."}
+    previews: Optional[Dict[str, str]] = None  # {"thumb": "gs://...", "preview": "gs://..."} (se escriben en background)
 
 @app.get("/health")
 def health():
     return {"ok": True}
 
+@app.get("/metrics")
+def metrics():
+    return {"almacenamiento": ALMACEN.metricas.estado()}
+
+def respuesta_ndjson(servicio: str, pipeline: Callable[[Callable[..., None]], Awaitable[Dict[str, Any]]]) -> StreamingResponse:
+    """
+    Modo progreso (header X-Progress: ndjson): una línea JSON por evento
+      {"type": "progress", "servicio", "etapa", "pct", ...}  ...  {"type": "result", "data": {...}}
+    o {"type": "error", "status", "detail"} al final. El status HTTP es 200 una vez que empieza el stream.
+    """
+    cola: asyncio.Queue = asyncio.Queue()
+
+    def reportar(etapa: str, pct: float, **extra) -> None:
+        cola.put_nowait({"type": "progress", "servicio": servicio, "etapa": etapa, "pct": round(pct, 1), **extra})
+
+    async def correr():
+        try:
+            cola.put_nowait({"type": "result", "data": await pipeline(reportar)})
+        except HTTPException as e:
+            cola.put_nowait({"type": "error", "status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            cola.put_nowait({"type": "error", "status": 500, "detail": str(e)})
+        finally:
+            cola.put_nowait(None)
+
+    async def stream():
+        tarea = asyncio.create_task(correr())
+        try:
+            while (evento := await cola.get()) is not None:
+                yield json.dumps(evento, ensure_ascii=False) + "\n"
+        finally:
+            if not tarea.done():
+                tarea.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def _sin_reporte(etapa: str, pct: float, **extra) -> None:
+    pass
+
 @app.post("/ocr", response_model=OCRRespuesta)
 async def ocr_imagen(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(None, description="Imagen (jpg, png, webp, tiff, etc.)"),
     gcs_uri: Optional[str] = Form(default=None, description="URI de GCS gs://bucket/path"),
     user_id_header: Optional[str] = Header(default=None, alias="X-User-Id"),  # doctor_uid
+    progress: Optional[str] = Header(default=None, alias="X-Progress"),      # "ndjson" → stream de progreso
     org_id: str = Form(...),
     patient_id: str = Form(...),
     session_id: str = Form(...),
     note_id: str = Form(...),
+    engine: Optional[str] = Form(default=None, description="vision | tesseract | auto (default: OCR_ENGINE)"),
 ):
     """
     Acepta:
       - file (multipart)  O  gcs_uri (gs://…)
-    Hace OCR con Vision, y guarda SOLO el JSON de resultado en GCS.
+    Hace OCR con el motor elegido (Vision, Tesseract local o router 'auto'),
+    y guarda SOLO el JSON de resultado en GCS.
     Si llega file, sube la imagen a GCS (/raw/) antes del OCR.
+    Los previews WebP (derived/previews/) se generan después de responder.
+    Con X-Progress: ndjson la respuesta es un stream de eventos de etapa/porcentaje.
     """
     uid = user_id_header or "_public"
 
-    try:
-        vision_client = get_vision_client()
-        from google.cloud import vision  # seguro aquí
+    # El archivo se lee antes de (posiblemente) empezar el stream: FastAPI cierra los
+    # UploadFile al salir del handler.
+    image_bytes: Optional[bytes] = None
+    if file is not None:
+        image_bytes = await file.read()
+        if not image_bytes:
+            raise HTTPException(status_code=400, detail="Archivo vacío o no válido.")
+    elif not gcs_uri:
+        raise HTTPException(status_code=400, detail="Debes enviar 'file' o 'gcs_uri'.")
 
-        imagen_gcs_uri: Optional[str] = None
+    async def pipeline(reportar: Callable[..., None]) -> Dict[str, Any]:
+        try:
+            imagen_gcs_uri: Optional[str] = gcs_uri
+            entradas = []  # objetos escritos en esta nota → manifiesto de la sesión
 
-        if file is not None:
-            image_bytes = await file.read()
-            if not image_bytes:
-                raise HTTPException(status_code=400, detail="Archivo vacío o no válido.")
+            if image_bytes is not None:
+                reportar("subiendo_gcs", 0)
+                _, ext = os.path.splitext(file.filename or "imagen.bin")
+                gcs_filename = f"{note_id}_{_ts()}{ext or '.bin'}"
+                mime = guess_mime(file.filename or "", file.content_type or "application/octet-stream")
+                if USE_GCS:
+                    entrada_raw = await run_in_threadpool(
+                        gcs_upload_raw,
+                        org_id=org_id, doctor_uid=uid, patient_id=patient_id,
+                        session_id=session_id, note_id=note_id, filename=gcs_filename,
+                        content=image_bytes, content_type=mime
+                    )
+                    imagen_gcs_uri = entrada_raw["contenido"]
+                    entradas.append(entrada_raw)
 
-            _, ext = os.path.splitext(file.filename or "imagen.bin")
-            gcs_filename = f"{note_id}_{_ts()}{ext or '.bin'}"
-            imagen_gcs_uri = gcs_upload_bytes(
-                org_id=org_id, doctor_uid=uid, patient_id=patient_id,
-                session_id=session_id, subfolder="raw", filename=gcs_filename,
-                content=image_bytes, content_type=guess_mime(file.filename or "", file.content_type or "application/octet-stream")
+            # Tesseract es CPU-bound y Vision es bloqueante: fuera del event loop
+            reportar("ocr", 30, motor=engine or OCR_ENGINE)
+            ocr_out = await run_in_threadpool(
+                ejecutar_ocr, engine or OCR_ENGINE, image_bytes, gcs_uri if image_bytes is None else None
             )
 
-            image = vision.Image(content=image_bytes)
+            reportar("persistiendo", 85)
+            payload = {"texto": ocr_out["texto"] or "", "motor": ocr_out["motor"], "confianza": ocr_out["confianza"]}
+            json_gcs_uri = await run_in_threadpool(
+                gcs_upload_json,
+                org_id=org_id, doctor_uid=uid, patient_id=patient_id,
+                session_id=session_id, note_id=note_id, data=payload
+            ) if USE_GCS else None
+            if json_gcs_uri:
+                entradas.append(describir(json_gcs_uri, json_compacto(payload), content_type="application/json", nota=note_id))
+                await run_in_threadpool(MANIFIESTO.registrar_seguro, org_id, uid, patient_id, session_id, entradas)
 
-        elif gcs_uri:
-            imagen_gcs_uri = gcs_uri
-            image = vision.Image(source=vision.ImageSource(image_uri=gcs_uri))
+            previews = None
+            if USE_GCS and PREVIEWS_ENABLED:
+                background_tasks.add_task(
+                    generar_previews, image_bytes, imagen_gcs_uri if image_bytes is None else None,
+                    org_id, uid, patient_id, session_id, note_id,
+                )
+                previews = {
+                    size: ALMACEN.uri(preview_object_path(org_id, uid, patient_id, session_id, note_id, size))
+                    for size in PREVIEW_SIZES
+                }
 
-        else:
-            raise HTTPException(status_code=400, detail="Debes enviar 'file' o 'gcs_uri'.")
+            reportar("completado", 100)
+            return {
+                "mensaje": "OCR completado",
+                "user_id": uid,
+                "imagen_gcs": imagen_gcs_uri,
+                "resultado": {**payload, "archivo_guardado_gcs": json_gcs_uri},
+                "previews": previews,
+            }
 
-        response = vision_client.text_detection(image=image)
-        if getattr(response, "error", None) and response.error.message:
-            raise HTTPException(status_code=500, detail=response.error.message)
+        except HTTPException:
+            raise
+        except Exception as e:
+            # Cualquier error en runtime se reporta aquí, no al importar el módulo
+            raise HTTPException(status_code=500, detail=str(e))
 
-        # Texto
-        texto_detectado = ""
-        if getattr(response, "full_text_annotation", None) and response.full_text_annotation.text:
-            texto_detectado = response.full_text_annotation.text.strip()
-        elif getattr(response, "text_annotations", None):
-            texto_detectado = (response.text_annotations[0].description or "").strip()
-
-        payload = {"texto": texto_detectado or ""}
-        json_gcs_uri = gcs_upload_json(
-            org_id=org_id, doctor_uid=uid, patient_id=patient_id,
-            session_id=session_id, note_id=note_id, data=payload
-        )
-
-        return {
-            "mensaje": "OCR completado",
-            "user_id": uid,
-            "imagen_gcs": imagen_gcs_uri,
-            "resultado": {**payload, "archivo_guardado_gcs": json_gcs_uri}
-        }
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        # Cualquier error en runtime se reporta aquí, no al importar el módulo
-        raise HTTPException(status_code=500, detail=str(e))
+    if (progress or "").lower() == "ndjson":
+        return respuesta_ndjson("ocr", pipeline)
+    return await pipeline(_sin_reporte)
@@ -1,19 +1,27 @@
 import os
 import re
+import json
+import base64
+import threading
 import textwrap
+from collections import OrderedDict
 import uuid
-from datetime import datetime, timezone
-from typing import Any, Dict, Optional
+import asyncio
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
 from pathlib import Path
+from contextlib import asynccontextmanager
 import io
 import logging 
 import weasyprint
 import hashlib
 import html
 from fastapi import (
-    FastAPI, File, UploadFile, HTTPException, Header, Form, Depends, Request, Body
+    FastAPI, File, UploadFile, HTTPException, Header, Form, Depends, Request, Body,
+    WebSocket, WebSocketDisconnect, Response,
 )
-import json
+from urllib.parse import urlencode
 from google.oauth2 import service_account
 from google.auth import default as google_auth_default
 from fastapi.middleware.cors import CORSMiddleware
@@ -24,9 +32,16 @@ import httpx
 import firebase_admin
 from firebase_admin import credentials, auth
 from google.cloud import firestore
-from google.cloud import storage, bigquery # <-- AÑADIDO
+from google.cloud import bigquery
 from starlette.responses import PlainTextResponse
 
+from common.storage import crear_almacen
+from common.manifiesto import Manifiesto, describir
+from common.diario import DiarioNotas
+from common.exportador_bq import ExportadorBigQuery
+from common.emociones import TARGET_EMOTIONS
+from common.calidad_ocr import evaluar_calidad_ocr
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Configuración de logging (AÑADIDO)
 logging.basicConfig(level=logging.INFO)
@@ -53,11 +68,15 @@ def _init_firebase_admin_once():
 _init_firebase_admin_once()
 
 GCS_BUCKET_ENV = os.getenv("GCS_BUCKET_NAME", "ceroooooo") 
+STORAGE_BACKEND = os.getenv("ORC_STORAGE_BACKEND", "gcs").lower()  # "gcs" | "local"
+STORAGE_ROOT = os.getenv("ORC_STORAGE_ROOT", "data_local")
 try:
     db = firestore.Client()
-    storage_client = storage.Client()
-    bq_client = bigquery.Client()
     BUCKET_NAME = GCS_BUCKET_ENV # Usa la variable de entorno
+    ALMACEN = crear_almacen(BUCKET_NAME, backend=STORAGE_BACKEND, raiz=STORAGE_ROOT)
+    storage_client = ALMACEN.client  # cliente con pool compartido (firma de URLs); None en backend local
+    MANIFIESTO = Manifiesto(ALMACEN)
+    bq_client = bigquery.Client()
     logger.info(f"Clientes de Google Cloud (Firestore, Storage, BigQuery) inicializados. Bucket: {BUCKET_NAME}")
 except Exception as e:
     logger.error(f"Error inicializando clientes de Google Cloud: {e}")
@@ -131,10 +150,161 @@ AUDIO_URL = (
     or "https://audio-826777844588.us-central1.run.app/transcribir_audio"
 )
 
+# WebSocket de transcripción en vivo del servicio de audio (derivado de AUDIO_URL si no se define)
+AUDIO_WS_URL = (
+    os.getenv("ORC_AUDIO_WS_URL")
+    or re.sub(r"^http", "ws", AUDIO_URL).replace("/transcribir_audio", "/ws/transcribir")
+)
+
 # Timeouts (Tu lógica original)
 CONNECT_TIMEOUT = float(os.getenv("ORC_CONNECT_TIMEOUT", "10"))
 READ_TIMEOUT = float(os.getenv("ORC_READ_TIMEOUT", "120"))
 
+# Compuerta de calidad OCR (antes de mandar el texto a análisis)
+OCR_QUALITY_MIN_SCORE = float(os.getenv("ORC_OCR_QUALITY_MIN_SCORE", "0.5"))
+OCR_QUALITY_MIN_CHARS = int(os.getenv("ORC_OCR_QUALITY_MIN_CHARS", "12"))
+
+# Texto de notas: por encima del umbral va comprimido a derived/notes/{note_id}/ y en
+# Firestore queda solo un preview + hash (los listados no descargan transcripciones completas)
+NOTE_INLINE_MAX_BYTES = int(os.getenv("ORC_NOTE_INLINE_MAX_BYTES", "16384"))
+NOTE_PREVIEW_CHARS = int(os.getenv("ORC_NOTE_PREVIEW_CHARS", "400"))
+
+# Diario write-behind de notas: la escritura se registra en SQLite (durable) y se confirma
+# al cliente; un flusher en background la lleva a Firestore en lotes, con reintentos.
+# En Cloud Run /tmp es memoria: para sobrevivir reinicios montar un volumen en ORC_JOURNAL_PATH.
+JOURNAL_ENABLED = os.getenv("ORC_JOURNAL_ENABLED", "true").lower() == "true"
+JOURNAL_PATH = os.getenv("ORC_JOURNAL_PATH", "/tmp/orc_notas_journal.db")
+JOURNAL_BATCH = int(os.getenv("ORC_JOURNAL_BATCH", "100"))          # notas por ciclo (≤ 499 escrituras por transacción)
+JOURNAL_FLUSH_S = float(os.getenv("ORC_JOURNAL_FLUSH_S", "0.5"))    # espera máxima antes de vaciar
+JOURNAL_MAX_BACKOFF_S = float(os.getenv("ORC_JOURNAL_MAX_BACKOFF_S", "300"))
+JOURNAL_READ_WAIT_S = float(os.getenv("ORC_JOURNAL_READ_WAIT_S", "10"))  # lecturas que necesitan lo pendiente
+
+# Exportación a BigQuery (tablas notes y notes_emotions de BasesDeDatos.md), en micro-lotes.
+# Se activa definiendo ORC_BQ_DATASET. Lo que no se pudo insertar va a un archivo de spill
+# (ndjson) y se reintenta en los ciclos siguientes y al arrancar (ver common/exportador_bq.py).
+BQ_DATASET = os.getenv("ORC_BQ_DATASET", "")
+BQ_BATCH_ROWS = int(os.getenv("ORC_BQ_BATCH_ROWS", "500"))
+BQ_FLUSH_S = float(os.getenv("ORC_BQ_FLUSH_S", "5"))
+BQ_MAX_BUFFER = int(os.getenv("ORC_BQ_MAX_BUFFER", "20000"))   # filas en memoria; el exceso va directo al spill
+BQ_SPILL_PATH = os.getenv("ORC_BQ_SPILL_PATH", "/tmp/orc_bq_spill.ndjson")
+BQ_MAX_ESPERA_H = float(os.getenv("ORC_BQ_MAX_ESPERA_H", "72"))   # fallando desde hace más → {spill}.rechazadas
+BQ_REINTENTO_MAX_S = float(os.getenv("ORC_BQ_REINTENTO_MAX_S", "600"))  # tope del backoff del spill
+
+# Listados paginados (pacientes / sesiones / notas) con proyección de campos y caché por doctor
+LIST_PAGE_DEFAULT = int(os.getenv("ORC_LIST_PAGE_DEFAULT", "25"))
+LIST_PAGE_MAX = int(os.getenv("ORC_LIST_PAGE_MAX", "100"))
+LIST_CACHE_TTL_S = float(os.getenv("ORC_LIST_CACHE_TTL_S", "20"))
+LIST_CACHE_MAX = int(os.getenv("ORC_LIST_CACHE_MAX", "2000"))        # entradas (LRU)
+LIST_JOURNAL_WAIT_S = float(os.getenv("ORC_LIST_JOURNAL_WAIT_S", "2"))  # notas aún en el diario
+
+# Serie diaria de emociones por paciente (patients/{id}/rollups/emociones_diarias).
+# Solo se acumulan las TARGET_EMOTIONS (common/emociones.py, las mismas del análisis).
+TREND_DEFAULT_DAYS = int(os.getenv("ORC_TREND_DEFAULT_DAYS", "90"))
+TREND_MAX_DAYS = int(os.getenv("ORC_TREND_MAX_DAYS", "3660"))
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Métricas en proceso (contadores simples, expuestos en /metrics)
+METRICS: Dict[str, int] = {
+    "ocr_calidad_evaluadas": 0,
+    "ocr_calidad_rechazadas": 0,
+    "analisis_evitados": 0,
+}
+
+def _inc(metric: str, n: int = 1) -> None:
+    METRICS[metric] = METRICS.get(metric, 0) + n
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Progreso de pipelines (relevado al frontend por SSE en /progreso/{note_id})
+#
+# Los servicios de OCR/audio, llamados con "X-Progress: ndjson", devuelven un stream
+# de eventos de etapa/porcentaje que se publican aquí por canal "{uid}:{note_id}".
+# El bus vive en memoria del proceso: el SSE debe llegar a la misma instancia que el
+# POST del pipeline (Cloud Run con --session-affinity, o una sola instancia).
+PROGRESS_TTL_S = float(os.getenv("ORC_PROGRESS_TTL_S", "900"))
+PROGRESO: Dict[str, Dict[str, Any]] = {}
+
+def _canal_progreso(uid: str, note_id: str) -> Dict[str, Any]:
+    key = f"{uid}:{note_id}"
+    canal = PROGRESO.get(key)
+    if canal is None:
+        ahora = time.monotonic()
+        for k in [k for k, c in PROGRESO.items() if ahora - c["ts"] > PROGRESS_TTL_S]:
+            PROGRESO.pop(k, None)
+        canal = PROGRESO[key] = {"eventos": [], "cambio": asyncio.Event(), "ts": ahora, "cerrado": False}
+    return canal
+
+def publicar_progreso(uid: str, note_id: str, evento: Dict[str, Any]) -> None:
+    canal = _canal_progreso(uid, note_id)
+    canal["eventos"].append({**evento, "note_id": note_id})
+    if evento.get("servicio") == "orquestador" and (evento.get("type") == "error" or evento.get("etapa") == "completado"):
+        canal["cerrado"] = True
+    # Despertar a los suscriptores y dejar un Event nuevo para la siguiente espera
+    cambio, canal["cambio"] = canal["cambio"], asyncio.Event()
+    cambio.set()
+
+def _progreso(uid: str, note_id: str, etapa: str, pct: float, **extra) -> None:
+    publicar_progreso(uid, note_id, {"type": "progress", "servicio": "orquestador", "etapa": etapa, "pct": pct, **extra})
+
+def _progreso_error(uid: str, note_id: str, status_code: int, detail: str) -> None:
+    publicar_progreso(uid, note_id, {"type": "error", "servicio": "orquestador", "etapa": "error", "pct": 100,
+                                     "status": status_code, "detail": detail})
+
+@asynccontextmanager
+async def _cliente_pipeline(uid: str, note_id: str):
+    """
+    Cliente httpx de un pipeline. Cualquier excepción dentro del bloque (HTTPException propia,
+    timeout o conexión caída con un servicio, error inesperado) publica {"type": "error"} y
+    cierra el canal de progreso antes de propagarse; los errores de red salen como 504/502.
+    """
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)) as client:
+            yield client
+    except HTTPException as e:
+        _progreso_error(uid, note_id, e.status_code, str(e.detail))
+        raise
+    except httpx.TimeoutException as e:
+        detail = f"Tiempo de espera agotado con un servicio ({type(e).__name__})"
+        _progreso_error(uid, note_id, 504, detail)
+        raise HTTPException(status_code=504, detail=detail) from e
+    except httpx.HTTPError as e:
+        detail = f"Servicio no disponible: {e}"
+        _progreso_error(uid, note_id, 502, detail)
+        raise HTTPException(status_code=502, detail=detail) from e
+    except Exception as e:
+        _progreso_error(uid, note_id, 500, f"Error interno: {e}")
+        raise
+
+async def _post_con_progreso(client: httpx.AsyncClient, url: str, uid: str, note_id: str,
+                             headers: Dict[str, str], **kwargs) -> tuple:
+    """
+    POST a un servicio pidiendo stream de progreso. Devuelve (status_code, json|texto).
+    Si el servicio no soporta progreso (respuesta JSON normal), se usa tal cual.
+    """
+    async with client.stream("POST", url, headers={**headers, "X-Progress": "ndjson"}, **kwargs) as resp:
+        if resp.status_code >= 400 or "ndjson" not in resp.headers.get("content-type", ""):
+            await resp.aread()
+            return resp.status_code, (resp.json() if resp.status_code < 400 else resp.text)
+        async for line in resp.aiter_lines():
+            if not line.strip():
+                continue
+            evento = json.loads(line)
+            if evento.get("type") == "progress":
+                publicar_progreso(uid, note_id, evento)
+            elif evento.get("type") == "result":
+                return 200, evento.get("data") or {}
+            elif evento.get("type") == "error":
+                return int(evento.get("status") or 500), str(evento.get("detail"))
+    return 502, "El servicio cerró el stream sin resultado"
+
+def _note_id_cliente(note_id: Optional[str]) -> str:
+    """El frontend puede fijar el note_id para suscribirse al progreso antes del POST."""
+    if not note_id:
+        return str(uuid.uuid4())
+    try:
+        return str(uuid.UUID(note_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="note_id debe ser un UUID")
+
 # ──────────────────────────────────────────────────────────────────────────────
 
 app = FastAPI(title="Orquestador (Foto→OCR→Análisis | Audio→Transcripción→Análisis)")
@@ -154,6 +324,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"], 
+    expose_headers=["ETag"],  # el frontend lo reenvía en If-None-Match
 )
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -165,6 +336,8 @@ class OrquestacionFotoRespuesta(BaseModel):
     note_id: str
     ocr: Dict[str, Any]
     analisis: Optional[Dict[str, Any]] = None
+    calidad: Optional[Dict[str, Any]] = None
+    requiere_recaptura: bool = False
 
 class OrquestacionAudioRespuesta(BaseModel):
     mensaje: str
@@ -209,6 +382,276 @@ class SignedPdfIn(BaseModel):
     patient_id: str
     session_id: str
 
+class SignedPreviewIn(BaseModel):
+    org_id: str
+    patient_id: str
+    session_id: str
+    note_id: str
+    size: str = "thumb"  # "thumb" | "preview"
+
+def _porcentaje(valor: Any) -> float:
+    """{"porcentaje": x, ...} o x suelto (formato simple) → float."""
+    if isinstance(valor, dict):
+        valor = valor.get("porcentaje", 0)
+    try:
+        return float(valor or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def acumular_rollup(rollup: Optional[Dict[str, Any]], nota: Dict[str, Any],
+                    previa: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Resumen de la sesión tras escribir `nota` (previa = versión anterior de la misma nota, si existía).
+      note_count, latest_*                  → la nota recién escrita es la más reciente
+      emociones[e] = {n, suma, max}         → n notas con la emoción, suma de porcentajes, máximo visto
+    Re-escribir una nota (análisis inmediato y luego /guardar_nota) no la cuenta dos veces: se
+    descuenta lo que aportaba la versión previa. "max" es un máximo histórico (no se recalcula).
+    """
+    r = dict(rollup or {})
+    emociones: Dict[str, Dict[str, float]] = {k: dict(v) for k, v in (r.get("emociones") or {}).items()}
+
+    if previa is None:
+        r["note_count"] = int(r.get("note_count", 0)) + 1
+    else:
+        for emo, val in (previa.get("emotions") or {}).items():
+            if emo in emociones:
+                emociones[emo]["n"] = max(0, emociones[emo].get("n", 0) - 1)
+                emociones[emo]["suma"] = emociones[emo].get("suma", 0.0) - _porcentaje(val)
+
+    for emo, val in (nota.get("emotions") or {}).items():
+        pct = _porcentaje(val)
+        e = emociones.setdefault(emo, {"n": 0, "suma": 0.0, "max": 0.0})
+        e["n"] = e.get("n", 0) + 1
+        e["suma"] = e.get("suma", 0.0) + pct
+        e["max"] = max(e.get("max", 0.0), pct)
+
+    r["emociones"] = emociones
+    r["latest_note_id"] = nota["note_id"]
+    r["latest_note_type"] = nota.get("type")
+    # Objeto con el texto completo si se descargó de Firestore; si no, el documento de la nota
+    r["latest_text_ref"] = nota.get("text_ref") or nota.get("_path")
+    r["latest_emotions"] = nota.get("emotions") or {}
+    return r
+
+def rollup_desde_notas(notas: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Rollup inicial de una sesión anterior al rollup: acumula sus notas ya escritas
+    (cada una con "_path") de la más antigua a la más reciente.
+    """
+    sin_fecha = datetime.min.replace(tzinfo=timezone.utc)
+    rollup: Dict[str, Any] = {"note_count": 0}
+    for nota in sorted(notas, key=lambda n: n.get("created_at") or sin_fecha):
+        rollup = acumular_rollup(rollup, nota, None)
+    return rollup
+
+def acumular_serie_diaria(dias: Dict[str, Dict[str, Any]], nota: Dict[str, Any],
+                          previa: Optional[Dict[str, Any]], dia: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Serie diaria del paciente tras escribir `nota` el día `dia` (YYYY-MM-DD, UTC).
+      dias[d] = {"notas": k, "emociones": {e: {n, suma, max}}}   solo e ∈ TARGET_EMOTIONS
+    Una nota cuenta en el día en que se creó: si se re-escribe, la versión previa se descuenta
+    de ese día y la nueva se suma al mismo (la nota conserva su created_at).
+    Devuelve solo los días tocados (para escribir con merge sin reescribir la serie).
+    """
+    tocados: Dict[str, Dict[str, Any]] = {}
+
+    def _dia(d: str) -> Dict[str, Any]:
+        if d not in tocados:
+            base = dias.get(d) or {}
+            tocados[d] = {"notas": int(base.get("notas", 0)),
+                          "emociones": {k: dict(v) for k, v in (base.get("emociones") or {}).items()}}
+        return tocados[d]
+
+    if previa is not None:
+        creada = previa.get("created_at")
+        if isinstance(creada, datetime):
+            dia = creada.astimezone(timezone.utc).date().isoformat()
+        dp = _dia(dia)
+        dp["notas"] = max(0, dp["notas"] - 1)
+        for emo, val in (previa.get("emotions") or {}).items():
+            e = dp["emociones"].get(emo)
+            if e is not None:
+                e["n"] = max(0, e.get("n", 0) - 1)
+                e["suma"] = e.get("suma", 0.0) - _porcentaje(val) if e["n"] else 0.0
+
+    d = _dia(dia)
+    d["notas"] += 1
+    for emo, val in (nota.get("emotions") or {}).items():
+        if emo not in TARGET_EMOTIONS:
+            continue
+        pct = _porcentaje(val)
+        e = d["emociones"].setdefault(emo, {"n": 0, "suma": 0.0, "max": 0.0})
+        e["n"] = e.get("n", 0) + 1
+        e["suma"] = e.get("suma", 0.0) + pct
+        e["max"] = max(e.get("max", 0.0), pct)
+    return tocados
+
+def preparar_texto_nota(org_id: str, doctor_uid: str, patient_id: str, session_id: str,
+                        note_id: str, texto: str, subir: bool = True) -> Dict[str, Any]:
+    """
+    Campos de texto para el documento de la nota. Bloqueante (sube a storage): llamar en un hilo.
+      ≤ NOTE_INLINE_MAX_BYTES → ocr_text completo
+      > umbral               → ocr_text = preview, text_ref = objeto gzip con el texto completo
+    Siempre: text_len (caracteres) y text_sha256 (del texto completo).
+    subir=False fuerza el texto completo inline (respaldo cuando storage falla).
+    """
+    texto = texto or ""
+    raw = texto.encode("utf-8")
+    campos = {"text_len": len(texto), "text_sha256": hashlib.sha256(raw).hexdigest()}
+    if not subir or len(raw) <= NOTE_INLINE_MAX_BYTES:
+        return {**campos, "ocr_text": texto, "text_truncated": False, "text_ref": None}
+
+    ruta = ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, "derived", "notes", note_id, "texto.txt")
+    uri = ALMACEN.put_bytes(ruta, raw, "text/plain; charset=utf-8", comprimir=True)
+    MANIFIESTO.registrar_seguro(org_id, doctor_uid, patient_id, session_id,
+                                [describir(uri, raw, content_type="text/plain; charset=utf-8", nota=note_id)])
+    return {**campos, "ocr_text": texto[:NOTE_PREVIEW_CHARS], "text_truncated": True, "text_ref": uri}
+
+def leer_texto_nota(note_data: Dict[str, Any]) -> str:
+    """Texto completo de una nota: inline o desde su objeto (lectura perezosa). Bloqueante."""
+    if note_data.get("text_ref"):
+        return ALMACEN.get_text(note_data["text_ref"])
+    return note_data.get("ocr_text") or ""
+
+def _note_data(nota: Dict[str, Any], campos_texto: Dict[str, Any]) -> Dict[str, Any]:
+    """Documento de Firestore de una nota (campos de scoping para collectionGroup y reglas)."""
+    from google.cloud import firestore as _fs  # import local para evitar sombras
+    return {
+        "note_id": nota["note_id"],
+        "org_id": nota["org_id"],                 # ← NUEVO
+        "doctor_uid": nota["doctor_uid"],         # ← NUEVO
+        "patient_id": nota["patient_id"],         # ← NUEVO
+        "session_id": nota["session_id"],         # ← NUEVO
+
+        "type": nota["note_type"],                # "image" | "audio" | "text"
+        "source": nota["source_type"],            # "upload" | "gcs_uri" | "final"
+        "gcs_uri_source": nota["source_gcs_uri"], # gs://... o None
+        **campos_texto,                           # ocr_text (completo o preview), text_ref, text_len, text_sha256
+        "emotions": (nota.get("analysis_result") or {}).get("resultado", {}),  # JSON limpio
+        "status_pipeline": "done",
+        # Timestamps del lado servidor
+        "created_at": _fs.SERVER_TIMESTAMP,
+        "processed_at": _fs.SERVER_TIMESTAMP,
+    }
+
+def escribir_notas_sesion(db_client, notas: List[Dict[str, Any]]) -> None:
+    """
+    Escribe notas de UNA sesión, su `rollup` y la serie diaria de emociones del paciente
+    en una sola transacción (bloqueante). Si la misma nota viene varias veces gana la última.
+    """
+    from google.cloud import firestore as _fs
+    ultima: Dict[str, Dict[str, Any]] = {}
+    for nota in notas:
+        ultima[nota["note_id"]] = nota
+    notas = list(ultima.values())
+    n0 = notas[0]
+    session_ref = (
+        db_client.collection("orgs").document(n0["org_id"])
+        .collection("doctors").document(n0["doctor_uid"])
+        .collection("patients").document(n0["patient_id"])
+        .collection("sessions").document(n0["session_id"])
+    )
+    serie_ref = session_ref.parent.parent.collection("rollups").document("emociones_diarias")
+
+    # Texto largo → objeto comprimido; en el documento solo preview + hash
+    docs = []
+    for nota in notas:
+        try:
+            campos_texto = preparar_texto_nota(n0["org_id"], n0["doctor_uid"], n0["patient_id"], n0["session_id"],
+                                               nota["note_id"], nota["text_content"])
+        except Exception as e:
+            logger.warning(f"[WARN] No se pudo descargar el texto de la nota {nota['note_id']} a storage, va inline: {e}")
+            campos_texto = preparar_texto_nota(n0["org_id"], n0["doctor_uid"], n0["patient_id"], n0["session_id"],
+                                               nota["note_id"], nota["text_content"], subir=False)
+        docs.append((session_ref.collection("notes").document(nota["note_id"]), _note_data(nota, campos_texto)))
+
+    @_fs.transactional
+    def _escribir(transaction):
+        # Todas las lecturas antes de las escrituras
+        previas = {snap.reference.path: snap for snap in transaction.get_all([ref for ref, _ in docs])}
+        sesion = session_ref.get(transaction=transaction)
+        rollup = (sesion.to_dict() or {}).get("rollup") if sesion.exists else None
+        if rollup is None and sesion.exists:
+            # Sesión anterior al rollup: se parte de las notas que ya tiene (solo esta vez)
+            existentes = (session_ref.collection("notes")
+                          .select(["note_id", "type", "emotions", "text_ref", "created_at"])
+                          .stream(transaction=transaction))
+            rollup = rollup_desde_notas([{**(snap.to_dict() or {}), "note_id": snap.id, "_path": snap.reference.path}
+                                         for snap in existentes])
+        serie = serie_ref.get(transaction=transaction)
+        dias = dict((serie.to_dict() or {}).get("dias") or {}) if serie.exists else {}
+        hoy = datetime.now(timezone.utc).date().isoformat()
+        dias_tocados: Dict[str, Dict[str, Any]] = {}
+        for nota, (ref, data) in zip(notas, docs):
+            previa = previas.get(ref.path)
+            previa = previa.to_dict() if previa is not None and previa.exists else None
+            data = {**data, "version": int((previa or {}).get("version") or (1 if previa else 0)) + 1}
+            if previa is not None and previa.get("created_at") is not None:
+                data["created_at"] = previa["created_at"]  # re-escritura: conserva su creación
+            # Para la exportación a BigQuery (insertId por versión, created_ts = creación real)
+            nota["version"] = data["version"]
+            nota["created_at"] = previa.get("created_at") if previa else None
+            rollup = acumular_rollup(rollup, {**data, "_path": ref.path}, previa)
+            tocados = acumular_serie_diaria(dias, data, previa, hoy)
+            dias.update(tocados)
+            dias_tocados.update(tocados)
+            transaction.set(ref, data)
+        rollup.setdefault("created_at", _fs.SERVER_TIMESTAMP)  # solo al crearlo
+        rollup["updated_at"] = _fs.SERVER_TIMESTAMP
+        # updated_at/created_at de la sesión: orden del listado de sesiones
+        datos_sesion = {"rollup": rollup, "updated_at": _fs.SERVER_TIMESTAMP}
+        if not sesion.exists or "created_at" not in (sesion.to_dict() or {}):
+            datos_sesion["created_at"] = _fs.SERVER_TIMESTAMP
+        transaction.set(session_ref, datos_sesion, merge=True)
+        # merge: solo se reescriben los días tocados
+        transaction.set(serie_ref, {"dias": dias_tocados, "updated_at": _fs.SERVER_TIMESTAMP}, merge=True)
+
+    _escribir(db_client.transaction())
+    CACHE_LISTADOS.invalidar(n0["doctor_uid"])
+    if EXPORTADOR_BQ is not None:
+        for nota in notas:
+            EXPORTADOR_BQ.encolar_nota(nota)
+
+def filas_bq_nota(nota: Dict[str, Any], ahora: Optional[datetime] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Una nota persistida → 1 fila de `notes` + 1 fila de `notes_emotions` por emoción.
+    Cada re-escritura exporta una versión nueva (columna `version`): las consultas toman la
+    mayor por note_id. created_ts/ds son de la creación de la nota, processed_ts de esta versión.
+    """
+    ahora = ahora or datetime.now(timezone.utc)
+    creada = nota.get("created_at") if isinstance(nota.get("created_at"), datetime) else ahora
+    ts, ds = creada.isoformat(), creada.astimezone(timezone.utc).date().isoformat()
+    analisis = nota.get("analysis_result") or {}
+    base = {k: nota[k] for k in ("note_id", "session_id", "patient_id", "doctor_uid", "org_id")}
+    base["version"] = int(nota.get("version") or 1)
+    fila_nota = {
+        **base, "ds": ds, "type": nota["note_type"], "gcs_uri": nota.get("source_gcs_uri"),
+        "language": "es", "ocr_text": nota.get("text_content") or "", "created_ts": ts,
+        "processed_ts": ahora.isoformat(),
+    }
+    emociones = []
+    for emocion, valor in (analisis.get("resultado") or {}).items():
+        extra = {k: v for k, v in valor.items() if k != "porcentaje"} if isinstance(valor, dict) else {}
+        emociones.append({
+            **base, "ds": ds, "nlp_model": analisis.get("motor") or "gemini", "emotion": emocion,
+            "score": _porcentaje(valor), "extra": json.dumps(extra, ensure_ascii=False), "created_ts": ts,
+        })
+    return {"notes": [fila_nota], "notes_emotions": emociones}
+
+EXPORTADOR_BQ: Optional[ExportadorBigQuery] = None
+if BQ_DATASET:
+    EXPORTADOR_BQ = ExportadorBigQuery(bq_client, BQ_DATASET, BQ_SPILL_PATH, filas_bq_nota, lote=BQ_BATCH_ROWS,
+                                       flush_s=BQ_FLUSH_S, max_buffer=BQ_MAX_BUFFER,
+                                       max_espera_s=BQ_MAX_ESPERA_H * 3600, reintento_max_s=BQ_REINTENTO_MAX_S)
+
+DIARIO: Optional[DiarioNotas] = None
+if JOURNAL_ENABLED:
+    try:
+        DIARIO = DiarioNotas(JOURNAL_PATH, escribir_notas_sesion, lote=JOURNAL_BATCH, flush_s=JOURNAL_FLUSH_S,
+                             max_backoff_s=JOURNAL_MAX_BACKOFF_S, espera_lectura_s=JOURNAL_READ_WAIT_S)
+    except Exception as e:
+        logger.error(f"[diario] No se pudo abrir {JOURNAL_PATH}, las notas se escriben directo: {e}")
+
 async def _save_note_to_firestore(
     db_client,
     org_id: str,
@@ -224,46 +667,27 @@ async def _save_note_to_firestore(
 ):
     """
     Guarda la nota con campos de scoping para poder filtrar con collectionGroup
-    y para que las reglas puedan autorizar la lectura.
+    y para que las reglas puedan autorizar la lectura, y actualiza en la misma
+    transacción el `rollup` de la sesión (ver escribir_notas_sesion).
+    Con el diario activo la escritura se registra en disco y se aplica en background.
     """
     if not db_client:
         return
-    try:
-        note_ref = (
-            db_client.collection("orgs").document(org_id)
-            .collection("doctors").document(doctor_uid)
-            .collection("patients").document(patient_id)
-            .collection("sessions").document(session_id)
-            .collection("notes").document(note_id)
-        )
-
-        # ⬇️ Campos denormalizados claves para seguridad/consultas
-        note_data = {
-            "note_id": note_id,
-            "org_id": org_id,                 # ← NUEVO
-            "doctor_uid": doctor_uid,         # ← NUEVO
-            "patient_id": patient_id,         # ← NUEVO
-            "session_id": session_id,         # ← NUEVO
-
-            "type": note_type,                # "image" | "audio" | "text"
-            "source": source_type,            # "upload" | "gcs_uri" | "final"
-            "gcs_uri_source": source_gcs_uri, # gs://... o None
-            "ocr_text": text_content,         # texto extraído o final
-            "emotions": (analysis_result or {}).get("resultado", {}),  # JSON limpio
-            "status_pipeline": "done",
-        }
-
-        # Timestamps del lado servidor (siempre que se pueda)
+    nota = {
+        "org_id": org_id, "doctor_uid": doctor_uid, "patient_id": patient_id,
+        "session_id": session_id, "note_id": note_id, "note_type": note_type,
+        "source_type": source_type, "source_gcs_uri": source_gcs_uri,
+        "text_content": text_content, "analysis_result": analysis_result,
+    }
+    if DIARIO is not None:
         try:
-            from google.cloud import firestore as _fs  # import local para evitar sombras
-            note_data["created_at"] = _fs.SERVER_TIMESTAMP
-            note_data["processed_at"] = _fs.SERVER_TIMESTAMP
-        except Exception:
-            pass
-
-        note_ref.set(note_data)
-        logger.info(f"[OK] Nota guardada: {note_ref.path}")
-
+            await asyncio.to_thread(DIARIO.agregar, nota)
+            return
+        except Exception as e:
+            logger.warning(f"[diario] No se pudo registrar la nota {note_id}, se escribe directo: {e}")
+    try:
+        await asyncio.to_thread(escribir_notas_sesion, db_client, [nota])
+        logger.info(f"[OK] Nota guardada: {note_id} (rollup de sesión actualizado)")
     except Exception as e:
         logger.warning(f"[WARN] Firestore write failed for note {note_id}: {e}")
 
@@ -280,20 +704,25 @@ def build_forward_headers(authorization: Optional[str], uid: Optional[str]) -> D
     return headers
 
 # ──────────────────────────────────────────────────────────────────────────────
-from datetime import timedelta
-
 def build_pdf_object_name(org_id: str, doctor_uid: str, patient_id: str, session_id: str) -> str:
     return f"{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/derived/evolution/evolution_note_{session_id}.pdf"
 
+PREVIEW_SIZES = ("thumb", "preview")
+
+def build_preview_object_name(org_id: str, doctor_uid: str, patient_id: str, session_id: str,
+                              note_id: str, size: str) -> str:
+    # Debe coincidir con preview_object_path() del servicio OCR
+    return f"{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/derived/previews/{note_id}/{size}.webp"
+
 def object_exists(bucket_name: str, object_name: str) -> bool:
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(object_name)
-    return blob.exists(storage_client)
+    return ALMACEN.existe(f"gs://{bucket_name}/{object_name}")
 
 def generate_signed_get_url(bucket_name: str, object_name: str, expires_seconds: int = 300) -> str:
     if not SIGNED_URL_CREDS:
         logger.error("[signed_url] SIGNED_URL_CREDS es None, no se puede firmar")
         raise HTTPException(status_code=500, detail="Config error: no hay credenciales para firmar PDFs")
+    if storage_client is None:
+        raise HTTPException(status_code=501, detail="URLs firmadas no disponibles con ORC_STORAGE_BACKEND=local")
 
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(object_name)
@@ -417,25 +846,38 @@ async def finalizar_y_firmar_sesion(
 
         # --- PASO 2: OBTENER DATOS DE IA DE LA SESIÓN (DE FIRESTORE) ---
         session_ref = patient_ref.collection("sessions").document(session_id)
-        
-        # Buscamos la *última* nota de IA guardada (la de /guardar_nota)
-        notes_collection = session_ref.collection("notes").order_by(
-            "created_at", direction=firestore.Query.DESCENDING
-        ).limit(1).stream()
+
+        # Las notas confirmadas pueden seguir en el diario: esperar a que lleguen a Firestore
+        if DIARIO is not None and not await DIARIO.esperar_sesion(org_id, doctor_uid, patient_id, session_id):
+            logger.warning(f"[diario] Sesión {session_id}: quedan notas pendientes, se firma con lo ya escrito")
         
         datos_ia_procesados = {
             "origen": "N/A",
             "texto_completo": "No se procesaron notas de IA para esta sesión.",
             "analisis_sentimiento": {}
         }
-        
-        for note in notes_collection:
-            note_data = note.to_dict() or {}
-            datos_ia_procesados["origen"] = note_data.get("type", "N/A").capitalize()
-            datos_ia_procesados["texto_completo"] = note_data.get("ocr_text", "Texto no extraído.")
-            # Lee el campo 'emotions' que tu función _save_note_to_firestore guardó
-            datos_ia_procesados["analisis_sentimiento"] = note_data.get("emotions", {})
-            break
+
+        # La *última* nota de IA sale del rollup que mantiene _save_note_to_firestore
+        session_doc = session_ref.get()
+        rollup = ((session_doc.to_dict() or {}).get("rollup") or {}) if session_doc.exists else {}
+        if rollup.get("latest_note_id"):
+            datos_ia_procesados["origen"] = (rollup.get("latest_note_type") or "N/A").capitalize()
+            datos_ia_procesados["analisis_sentimiento"] = rollup.get("latest_emotions") or {}
+            # El texto completo vive en la nota: lectura directa por id, sin consulta ni índice
+            note_doc = session_ref.collection("notes").document(rollup["latest_note_id"]).get()
+            datos_ia_procesados["texto_completo"] = (leer_texto_nota(note_doc.to_dict() or {}) or "Texto no extraído.") if note_doc.exists else "Texto no extraído."
+        else:
+            # Sesiones anteriores al rollup: consulta ordenada como antes
+            notes_collection = session_ref.collection("notes").order_by(
+                "created_at", direction=firestore.Query.DESCENDING
+            ).limit(1).stream()
+            for note in notes_collection:
+                note_data = note.to_dict() or {}
+                datos_ia_procesados["origen"] = note_data.get("type", "N/A").capitalize()
+                datos_ia_procesados["texto_completo"] = leer_texto_nota(note_data) or "Texto no extraído."
+                # Lee el campo 'emotions' que tu función _save_note_to_firestore guardó
+                datos_ia_procesados["analisis_sentimiento"] = note_data.get("emotions", {})
+                break
             
     except Exception as e:
         logger.error(f"Error al leer datos de Firestore para sesión {session_id}: {e}")
@@ -569,11 +1011,12 @@ async def finalizar_y_firmar_sesion(
     # -----------------------------------------------------
     try:
         # 1. Guardar PDF en GCS
-        gcs_path = f"{org_id}/{doctor_uid}/{patient_id}/sessions/{session_id}/derived/evolution/evolution_note_{session_id}.pdf"
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(gcs_path)
-        blob.upload_from_string(pdf_bytes, content_type='application/pdf')
-        gcs_uri = f"gs://{BUCKET_NAME}/{gcs_path}"
+        gcs_path = ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, "derived", "evolution", f"evolution_note_{session_id}.pdf")
+        gcs_uri = ALMACEN.put_bytes(gcs_path, pdf_bytes, "application/pdf")
+        await asyncio.to_thread(
+            MANIFIESTO.registrar_seguro, org_id, doctor_uid, patient_id, session_id,
+            [describir(gcs_uri, pdf_bytes, content_type="application/pdf")],
+        )
         logger.info(f"PDF guardado en GCS: {gcs_uri}")
 
         # 2. Actualizar Documento de Sesión en Firestore
@@ -585,11 +1028,15 @@ async def finalizar_y_firmar_sesion(
             "status_pipeline": "done", # Marcamos la sesión como completada
             "signed_at_ts": timestamp_firma,
             "signature_method": "firma_simple_terappia",
-            "document_hash": document_hash
+            "document_hash": document_hash,
+            "updated_at": firestore.SERVER_TIMESTAMP,
         }
+        if not session_doc.exists or "created_at" not in (session_doc.to_dict() or {}):
+            datos_firma["created_at"] = firestore.SERVER_TIMESTAMP  # sesión firmada sin notas
         
         # Usamos update() para añadir estos campos al documento de sesión existente
         session_ref.set(datos_firma, merge = True)
+        CACHE_LISTADOS.invalidar(doctor_uid)
         logger.info(f"Documento de sesión {session_id} actualizado en Firestore.")
 
         # 3. (Opcional) Guardar en BigQuery
@@ -660,11 +1107,512 @@ async def signed_pdf_url(
             detail=f"No se pudo firmar el PDF: {e}",
         )
 
+@app.post("/signed_preview_url")
+async def signed_preview_url(
+    payload: SignedPreviewIn,
+    current_user: dict = Depends(get_current_user),
+):
+    """URL firmada (GET) del thumbnail/preview WebP de una nota de imagen."""
+    if not BUCKET_NAME:
+        raise HTTPException(status_code=500, detail="Bucket no configurado")
+
+    doctor_uid = current_user.get("uid")
+    if not doctor_uid:
+        raise HTTPException(status_code=401, detail="Token sin uid")
+    if payload.size not in PREVIEW_SIZES:
+        raise HTTPException(status_code=400, detail=f"size debe ser uno de {PREVIEW_SIZES}")
+
+    object_name = build_preview_object_name(
+        org_id=payload.org_id,
+        doctor_uid=doctor_uid,
+        patient_id=payload.patient_id,
+        session_id=payload.session_id,
+        note_id=payload.note_id,
+        size=payload.size,
+    )
+
+    try:
+        if not object_exists(BUCKET_NAME, object_name):
+            # Puede estar generándose todavía (background del OCR)
+            raise HTTPException(status_code=404, detail=f"Preview no disponible: gs://{BUCKET_NAME}/{object_name}")
+        url = generate_signed_get_url(BUCKET_NAME, object_name, expires_seconds=900)
+        return {"url": url, "expires_in_seconds": 900}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[signed_preview_url] Error firmando gs://{BUCKET_NAME}/{object_name}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"No se pudo firmar el preview: {e}")
+
+@app.get("/sesion/{session_id}/artefactos")
+async def artefactos_sesion(
+    session_id: str,
+    org_id: str,
+    patient_id: str,
+    tipo: Optional[str] = None,     # "raw" | "ocr" | "transcription" | "analisis" | "previews" | ...
+    note_id: Optional[str] = None,
+    familia: Optional[str] = None,  # nombre sin sello ni extensión: "thumb" | "preview" | "ocr" | ...
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Artefactos de la sesión desde su manifiesto (una sola lectura, sin listar prefijos).
+    Con tipo + note_id devuelve además el último objeto de ese tipo para la nota (de esa familia si se indica).
+    """
+    doctor_uid = current_user.get("uid")
+    if not doctor_uid:
+        raise HTTPException(status_code=401, detail="Token sin uid")
+    try:
+        m = await asyncio.to_thread(MANIFIESTO.leer, org_id, doctor_uid, patient_id, session_id)
+    except Exception as e:
+        logger.error(f"[artefactos] Error leyendo manifiesto de {session_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"No se pudo leer el manifiesto: {e}")
+    if m is None:
+        raise HTTPException(status_code=404, detail="La sesión no tiene artefactos registrados")
+
+    def _uri(rel: str) -> str:
+        return ALMACEN.uri(ALMACEN.ruta(org_id, doctor_uid, patient_id, session_id, rel))
+
+    out: Dict[str, Any] = {
+        "session_id": session_id,
+        "actualizado": m.get("actualizado"),
+        "objetos": [{"ruta": rel, "uri": _uri(rel), **meta} for rel, meta in m.get("objetos", {}).items()],
+    }
+    if tipo and note_id:
+        rel = Manifiesto.ultimo(m, tipo, note_id, familia)
+        out["ultimo"] = {"ruta": rel, "uri": _uri(rel), **m["objetos"].get(rel, {})} if rel else None
+    return out
+
+@app.get("/nota/{note_id}/texto")
+async def texto_nota(
+    note_id: str,
+    org_id: str,
+    patient_id: str,
+    session_id: str,
+    current_user: dict = Depends(get_current_user),
+):
+    """Texto completo de una nota (vista de detalle). Si se descargó de Firestore se lee del objeto."""
+    doctor_uid = current_user.get("uid")
+    if not doctor_uid:
+        raise HTTPException(status_code=401, detail="Token sin uid")
+    try:
+        note_doc = await asyncio.to_thread(
+            db.collection("orgs").document(org_id)
+            .collection("doctors").document(doctor_uid)
+            .collection("patients").document(patient_id)
+            .collection("sessions").document(session_id)
+            .collection("notes").document(note_id).get
+        )
+        if not note_doc.exists:
+            raise HTTPException(status_code=404, detail="Nota no encontrada")
+        data = note_doc.to_dict() or {}
+        texto = await asyncio.to_thread(leer_texto_nota, data)
+        return {"note_id": note_id, "texto": texto, "text_len": len(texto), "text_sha256": data.get("text_sha256")}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[texto_nota] Error leyendo nota {note_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"No se pudo leer el texto de la nota: {e}")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Listados paginados para el frontend (en lugar de leer Firestore con documentos completos)
+
+# Proyección por recurso: "base" se devuelve siempre; "extra" solo si se pide en ?campos=
+CAMPOS_LISTADO = {
+    "pacientes": {
+        "base": ("fullName", "email", "phone", "address", "important", "createdAt"),
+        "extra": ("age", "gender", "medicalConditions", "allergies", "medications", "notes"),
+    },
+    "sesiones": {
+        "base": ("created_at", "updated_at", "status_pipeline", "signed_at_ts", "evolution_note_md_uri",
+                 "rollup.note_count", "rollup.latest_note_id", "rollup.latest_note_type", "rollup.updated_at"),
+        "extra": ("rollup.latest_emotions", "evolution_note_txt", "document_hash"),
+    },
+    "notas": {
+        # ocr_text se recorta a NOTE_PREVIEW_CHARS en la respuesta (campo "preview")
+        "base": ("note_id", "type", "source", "status_pipeline", "created_at",
+                 "ocr_text", "text_len", "text_truncated"),
+        "extra": ("emotions", "gcs_uri_source", "text_ref", "text_sha256"),
+    },
+}
+
+class CacheListados:
+    """
+    Respuestas de listados ya serializadas, por doctor, con TTL corto y ETag (hash del cuerpo).
+    Se invalida todo lo del doctor cuando el orquestador escribe notas o firma una sesión;
+    lo que se escribe desde el frontend (p. ej. pacientes nuevos) aparece al vencer el TTL.
+    """
+
+    def __init__(self, ttl_s: float, max_entradas: int):
+        self.ttl_s = ttl_s
+        self.max_entradas = max_entradas
+        self._datos: "OrderedDict[tuple, tuple]" = OrderedDict()   # clave → (expira, etag, cuerpo)
+        self._lock = threading.Lock()
+        self.stats = {"aciertos": 0, "fallos": 0, "no_modificado": 0, "invalidaciones": 0}
+
+    def obtener(self, clave: tuple) -> Optional[tuple]:
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None or entrada[0] < time.monotonic():
+                self._datos.pop(clave, None)
+                self.stats["fallos"] += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.stats["aciertos"] += 1
+            return entrada[1], entrada[2]
+
+    def guardar(self, clave: tuple, cuerpo: bytes) -> str:
+        etag = '"' + hashlib.sha256(cuerpo).hexdigest()[:32] + '"'
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + self.ttl_s, etag, cuerpo)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+        return etag
+
+    def contar_no_modificado(self) -> None:
+        """Una respuesta 304 (el cliente ya tenía esa versión)."""
+        with self._lock:
+            self.stats["no_modificado"] += 1
+
+    def invalidar(self, doctor_uid: str) -> None:
+        with self._lock:
+            for clave in [k for k in self._datos if k[0] == doctor_uid]:
+                del self._datos[clave]
+            self.stats["invalidaciones"] += 1
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "entradas": len(self._datos)}
+
+CACHE_LISTADOS = CacheListados(LIST_CACHE_TTL_S, LIST_CACHE_MAX)
+
+def _a_json(valor: Any) -> Any:
+    """Valores de Firestore (timestamps, referencias) → JSON."""
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    if isinstance(valor, dict):
+        return {k: _a_json(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_a_json(v) for v in valor]
+    if hasattr(valor, "path") and hasattr(valor, "id"):   # DocumentReference
+        return valor.path
+    return valor
+
+def _cursor_codificar(pos: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(pos, ensure_ascii=False).encode()).decode().rstrip("=")
+
+def _cursor_decodificar(cursor: str) -> Dict[str, Any]:
+    try:
+        pos = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(pos, dict) or not isinstance(pos.get("id"), str):
+            raise ValueError(cursor)
+        return pos
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def _valor_a_cursor(valor: Any) -> Dict[str, Any]:
+    # Timestamps de Firestore (DatetimeWithNanoseconds) van como ISO; Firestore guarda µs
+    if isinstance(valor, datetime):
+        return {"t": valor.isoformat()}
+    return {"v": valor}
+
+def _valor_de_cursor(pos: Dict[str, Any]) -> Any:
+    try:
+        return datetime.fromisoformat(pos["t"]) if "t" in pos else pos["v"]
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def _valor_campo(datos: Dict[str, Any], campo: str) -> Any:
+    for parte in campo.split("."):
+        if not isinstance(datos, dict) or parte not in datos:
+            return None
+        datos = datos[parte]
+    return datos
+
+def _campos_pedidos(recurso: str, campos: Optional[str]) -> List[str]:
+    permitidos = CAMPOS_LISTADO[recurso]
+    pedidos = [c.strip() for c in (campos or "").split(",") if c.strip()]
+    invalidos = [c for c in pedidos if c not in permitidos["extra"] and c not in permitidos["base"]]
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"Campos no permitidos para {recurso}: {invalidos}")
+    return list(permitidos["base"]) + [c for c in pedidos if c not in permitidos["base"]]
+
+def _pagina(coleccion, campos: List[str], orden: str, descendente: bool,
+            limit: int, cursor: Optional[str]) -> Dict[str, Any]:
+    """
+    Una página de `coleccion` (bloqueante) ordenada por `orden`, con desempate por id.
+    El cursor lleva el valor de orden y el id del último documento: start_after sin leerlo,
+    así cada página cuesta limit+1 lecturas. Firestore deja fuera de un order_by a los
+    documentos sin ese campo: el orquestador lo escribe siempre y los anteriores se
+    completan con rellenar_orden.py.
+    """
+    sentido = firestore.Query.DESCENDING if descendente else firestore.Query.ASCENDING
+    por_id = firestore.FieldPath.document_id()
+    pos = _cursor_decodificar(cursor) if cursor else {}
+    sel = campos if orden in campos else [*campos, orden]
+
+    q = coleccion.select(sel).order_by(orden, direction=sentido).order_by(por_id, direction=sentido)
+    if pos:
+        q = q.start_after({orden: _valor_de_cursor(pos), por_id: coleccion.document(pos["id"])})
+    docs = list(q.limit(limit + 1).stream())
+    siguiente = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        ultimo = docs[-1]
+        siguiente = {"id": ultimo.id, **_valor_a_cursor(_valor_campo(ultimo.to_dict() or {}, orden))}
+    return {
+        "items": [{"id": d.id, **_a_json(d.to_dict() or {})} for d in docs],
+        "next_cursor": _cursor_codificar(siguiente) if siguiente else None,
+        "limit": limit,
+    }
+
+async def _responder_listado(request: Request, clave: tuple, construir) -> Response:
+    """Caché por doctor + ETag: si el cliente ya tiene esa versión responde 304 sin cuerpo."""
+    cacheado = CACHE_LISTADOS.obtener(clave)
+    if cacheado is not None:
+        etag, cuerpo = cacheado
+    else:
+        try:
+            datos = await asyncio.to_thread(construir)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"[listados] Error consultando {clave[1]}: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"No se pudo leer el listado: {e}")
+        cuerpo = json.dumps(datos, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = CACHE_LISTADOS.guardar(clave, cuerpo)
+
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(LIST_CACHE_TTL_S)}"}
+    si_no = request.headers.get("if-none-match", "")
+    if etag in [t.strip() for t in si_no.split(",")] or si_no.strip() == "*":
+        CACHE_LISTADOS.contar_no_modificado()
+        return Response(status_code=304, headers=headers)
+    return Response(content=cuerpo, media_type="application/json", headers=headers)
+
+def _limite(limit: Optional[int]) -> int:
+    return max(1, min(int(limit or LIST_PAGE_DEFAULT), LIST_PAGE_MAX))
+
+def _doctor_ref(org_id: str, doctor_uid: str):
+    return db.collection("orgs").document(org_id).collection("doctors").document(doctor_uid)
+
+@app.get("/pacientes")
+async def listar_pacientes(
+    request: Request,
+    org_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    campos: Optional[str] = None,    # extras separados por coma (ver CAMPOS_LISTADO)
+    current_user: dict = Depends(get_current_user),
+):
+    """Pacientes del doctor ordenados por fullName, paginados con cursor."""
+    doctor_uid = current_user.get("uid")
+    if not doctor_uid:
+        raise HTTPException(status_code=401, detail="Token sin uid")
+    sel, n = _campos_pedidos("pacientes", campos), _limite(limit)
+    col = _doctor_ref(org_id, doctor_uid).collection("patients")
+    return await _responder_listado(
+        request, (doctor_uid, "pacientes", org_id, n, cursor, tuple(sel)),
+        lambda: _pagina(col, sel, "fullName", False, n, cursor),
+    )
+
+@app.get("/pacientes/{patient_id}/sesiones")
+async def listar_sesiones(
+    request: Request,
+    patient_id: str,
+    org_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    campos: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Sesiones de un paciente con el resumen del rollup, sin las notas. Más recientes primero
+    por updated_at (última nota o firma).
+    """
+    doctor_uid = current_user.get("uid")
+    if not doctor_uid:
+        raise HTTPException(status_code=401, detail="Token sin uid")
+    sel, n = _campos_pedidos("sesiones", campos), _limite(limit)
+    col = _doctor_ref(org_id, doctor_uid).collection("patients").document(patient_id).collection("sessions")
+    return await _responder_listado(
+        request, (doctor_uid, "sesiones", org_id, patient_id, n, cursor, tuple(sel)),
+        lambda: _pagina(col, sel, "updated_at", True, n, cursor),
+    )
+
+@app.get("/sesion/{session_id}/notas")
+async def listar_notas(
+    request: Request,
+    session_id: str,
+    org_id: str,
+    patient_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    campos: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Notas de la sesión (más recientes primero) con preview del texto; el texto completo
+    se pide en /nota/{note_id}/texto.
+    """
+    doctor_uid = current_user.get("uid")
+    if not doctor_uid:
+        raise HTTPException(status_code=401, detail="Token sin uid")
+    sel, n = _campos_pedidos("notas", campos), _limite(limit)
+    col = (_doctor_ref(org_id, doctor_uid).collection("patients").document(patient_id)
+           .collection("sessions").document(session_id).collection("notes"))
+    # Espera breve a lo que siga en el diario; si no llega se lista lo ya escrito
+    if DIARIO is not None:
+        await DIARIO.esperar_sesion(org_id, doctor_uid, patient_id, session_id, timeout=LIST_JOURNAL_WAIT_S)
+
+    def _construir() -> Dict[str, Any]:
+        pagina = _pagina(col, sel, "created_at", True, n, cursor)
+        for item in pagina["items"]:
+            texto = item.pop("ocr_text", None) or ""
+            item["preview"] = texto[:NOTE_PREVIEW_CHARS]
+            item["text_truncated"] = bool(item.get("text_truncated")) or len(texto) > NOTE_PREVIEW_CHARS
+        return pagina
+
+    return await _responder_listado(
+        request, (doctor_uid, "notas", org_id, patient_id, session_id, n, cursor, tuple(sel)), _construir,
+    )
+
+def tendencia_emociones(dias: Dict[str, Dict[str, Any]], emociones: List[str],
+                        desde: date, hasta: date, ventana: int, paso: int) -> Dict[str, Any]:
+    """
+    Agrega la serie diaria en ventanas de `ventana` días que terminan cada `paso` días,
+    la última en `hasta` (paso=1 → media móvil; paso=ventana → bloques). Días sin notas
+    cuentan como n=0. Matrices [emoción × día] en NumPy: sumas por diferencia de acumuladas,
+    máximos con sliding_window_view; las primeras ventanas pueden quedar incompletas.
+    """
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    n_dias = (hasta - desde).days + 1
+    fechas = [(desde + timedelta(days=i)).isoformat() for i in range(n_dias)]
+    n = np.zeros((len(emociones), n_dias), dtype=np.float64)
+    suma = np.zeros_like(n)
+    maximo = np.zeros_like(n)
+    notas = np.zeros(n_dias, dtype=np.float64)
+    for j, f in enumerate(fechas):
+        d = dias.get(f)
+        if not d:
+            continue
+        notas[j] = d.get("notas", 0)
+        for i, emo in enumerate(emociones):
+            e = (d.get("emociones") or {}).get(emo)
+            if e:
+                n[i, j], suma[i, j], maximo[i, j] = e.get("n", 0), e.get("suma", 0.0), e.get("max", 0.0)
+
+    fines = np.arange(n_dias, 0, -paso)[::-1]          # exclusivos
+    inicios = np.maximum(fines - ventana, 0)
+    acum = lambda m: np.concatenate([np.zeros(m.shape[:-1] + (1,)), np.cumsum(m, axis=-1)], axis=-1)
+    n_acum, suma_acum, notas_acum = acum(n), acum(suma), acum(notas)
+    n_v = n_acum[:, fines] - n_acum[:, inicios]
+    suma_v = suma_acum[:, fines] - suma_acum[:, inicios]
+    relleno = np.pad(maximo, ((0, 0), (ventana - 1, 0)))
+    max_v = sliding_window_view(relleno, ventana, axis=1)[:, fines - 1].max(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        media_v = np.where(n_v > 0, suma_v / n_v, np.nan)
+
+    redondear = lambda fila: [None if np.isnan(x) else round(float(x), 2) for x in fila]
+    return {
+        "desde": fechas[0], "hasta": fechas[-1], "ventana": ventana, "paso": paso,
+        "inicio": [fechas[i] for i in inicios],
+        "fin": [fechas[f - 1] for f in fines],
+        "notas": (notas_acum[fines] - notas_acum[inicios]).astype(int).tolist(),
+        "emociones": {
+            emo: {"media": redondear(media_v[i]), "n": n_v[i].astype(int).tolist(),
+                  "max": [round(float(x), 2) for x in max_v[i]]}
+            for i, emo in enumerate(emociones)
+        },
+    }
+
+@app.get("/pacientes/{patient_id}/tendencia")
+async def tendencia_paciente(
+    request: Request,
+    patient_id: str,
+    org_id: str,
+    emociones: Optional[str] = None,   # separadas por coma; por defecto TARGET_EMOTIONS
+    desde: Optional[str] = None,       # YYYY-MM-DD; por defecto hasta - ORC_TREND_DEFAULT_DAYS
+    hasta: Optional[str] = None,       # YYYY-MM-DD; por defecto hoy (UTC)
+    ventana: int = 7,                  # días por ventana
+    paso: int = 1,                     # días entre inicios de ventana
+    current_user: dict = Depends(get_current_user),
+):
+    """Evolución de las emociones del paciente desde su serie diaria (una sola lectura)."""
+    doctor_uid = current_user.get("uid")
+    if not doctor_uid:
+        raise HTTPException(status_code=401, detail="Token sin uid")
+    emos = [e.strip() for e in emociones.split(",") if e.strip()] if emociones else list(TARGET_EMOTIONS)
+    invalidas = [e for e in emos if e not in TARGET_EMOTIONS]
+    if invalidas:
+        raise HTTPException(status_code=400, detail=f"Emociones no soportadas: {invalidas}")
+    try:
+        h = date.fromisoformat(hasta) if hasta else datetime.now(timezone.utc).date()
+        d = date.fromisoformat(desde) if desde else h - timedelta(days=TREND_DEFAULT_DAYS - 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fechas en formato YYYY-MM-DD")
+    if d > h or (h - d).days + 1 > TREND_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Rango inválido (máximo {TREND_MAX_DAYS} días)")
+    if not 1 <= ventana <= 366 or not 1 <= paso <= 366:
+        raise HTTPException(status_code=400, detail="ventana y paso deben estar entre 1 y 366")
+
+    serie_ref = (_doctor_ref(org_id, doctor_uid).collection("patients").document(patient_id)
+                 .collection("rollups").document("emociones_diarias"))
+
+    def _construir() -> Dict[str, Any]:
+        snap = serie_ref.get()
+        dias = ((snap.to_dict() or {}).get("dias") or {}) if snap.exists else {}
+        return {"patient_id": patient_id, **tendencia_emociones(dias, emos, d, h, ventana, paso)}
+
+    return await _responder_listado(
+        request, (doctor_uid, "tendencia", org_id, patient_id, tuple(emos), d, h, ventana, paso), _construir,
+    )
+
 # ──────────────────────────────────────────────────────────────────────────────
 @app.get("/health")
 def health():
     return {"ok": True, "ts": _timestamp()}
 
+@app.get("/metrics")
+def metrics():
+    return {
+        **METRICS,
+        "diario_notas": DIARIO.estado() if DIARIO is not None else None,
+        "exportador_bq": EXPORTADOR_BQ.estado() if EXPORTADOR_BQ is not None else None,
+        "cache_listados": CACHE_LISTADOS.estado(),
+        "ts": _timestamp(),
+    }
+
+@app.on_event("startup")
+async def _iniciar_diario():
+    if DIARIO is not None and db:
+        app.state.diario = asyncio.create_task(DIARIO.bucle(db))
+
+@app.on_event("shutdown")
+async def _cerrar_diario():
+    # Último intento de vaciar antes de salir; lo que falle queda en el archivo para el replay
+    tarea = getattr(app.state, "diario", None)
+    if tarea is not None:
+        tarea.cancel()
+        try:
+            while await asyncio.wait_for(DIARIO.vaciar(db), timeout=8):
+                pass
+        except Exception as e:
+            logger.warning(f"[diario] Cierre con pendientes ({DIARIO.pendientes()}): {e}")
+
+@app.on_event("startup")
+async def _iniciar_exportador_bq():
+    if EXPORTADOR_BQ is not None:
+        app.state.exportador_bq = asyncio.create_task(EXPORTADOR_BQ.bucle())
+
+@app.on_event("shutdown")
+async def _cerrar_exportador_bq():
+    # Lo que no alcance a insertarse queda en el spill para el próximo arranque
+    tarea = getattr(app.state, "exportador_bq", None)
+    if tarea is not None:
+        tarea.cancel()
+        await EXPORTADOR_BQ.cerrar()
+
 @app.options("/{full_path:path}")
 async def preflight_catch_all(full_path: str, request: Request):
     return PlainTextResponse("", status_code=204)
@@ -678,6 +1626,8 @@ async def orquestar_foto(
     session_id: str = Form(...),
     org_id: str = Form(...),
     analyze_now: bool = Form(default=False),
+    ocr_engine: Optional[str] = Form(default=None),  # "vision" | "tesseract" | "auto"
+    note_id: Optional[str] = Form(default=None),     # opcional: para seguir /progreso/{note_id}
     current_user: dict = Depends(get_current_user),
     authorization: Optional[str] = Header(default=None, alias="Authorization"),
 ):
@@ -685,35 +1635,48 @@ async def orquestar_foto(
     if not file and not gcs_uri:
         raise HTTPException(status_code=400, detail="Envía 'file' o 'gcs_uri'.")
 
-    note_id = str(uuid.uuid4())
+    note_id = _note_id_cliente(note_id)
     downstream_form = {
         "org_id": org_id,
         "patient_id": patient_id,
         "session_id": session_id,
         "note_id": note_id,
     }
+    ocr_form = {**downstream_form, "engine": ocr_engine} if ocr_engine else downstream_form
     headers = build_forward_headers(authorization, effective_user_id)
 
-    async with httpx.AsyncClient(timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)) as client:
+    _progreso(effective_user_id, note_id, "recibido", 0)
+    async with _cliente_pipeline(effective_user_id, note_id) as client:
         # OCR
         if file is not None:
             file_bytes = await file.read()
             if not file_bytes:
                 raise HTTPException(status_code=400, detail="Archivo vacío o no válido.")
             files = {"file": (file.filename or "upload.bin", file_bytes, file.content_type or "application/octet-stream")}
-            ocr_resp = await client.post(OCR_URL, files=files, data=downstream_form, headers=headers)
+            ocr_status, ocr_json = await _post_con_progreso(client, OCR_URL, effective_user_id, note_id, headers, files=files, data=ocr_form)
         else:
-            form = {**downstream_form, "gcs_uri": gcs_uri}
-            ocr_resp = await client.post(OCR_URL, data=form, headers=headers)
+            form = {**ocr_form, "gcs_uri": gcs_uri}
+            ocr_status, ocr_json = await _post_con_progreso(client, OCR_URL, effective_user_id, note_id, headers, data=form)
 
-        if ocr_resp.status_code >= 400:
-            raise HTTPException(status_code=ocr_resp.status_code, detail=f"OCR error: {ocr_resp.text}")
-        ocr_json = ocr_resp.json()
+        if ocr_status >= 400:
+            raise HTTPException(status_code=ocr_status, detail=f"OCR error: {ocr_json}")
+
+        # Compuerta de calidad: texto vacío/basura no se manda a Gemini
+        resultado_ocr = ocr_json.get("resultado", {})
+        calidad = evaluar_calidad_ocr(resultado_ocr.get("texto") or "", resultado_ocr.get("confianza"),
+                                      min_score=OCR_QUALITY_MIN_SCORE, min_chars=OCR_QUALITY_MIN_CHARS)
+        _inc("ocr_calidad_evaluadas")
+        if not calidad["ok"]:
+            _inc("ocr_calidad_rechazadas")
+            logger.info(f"[calidad_ocr] Nota {note_id} bajo umbral: {calidad}")
 
         analysis_json = None
-        if analyze_now:
+        if analyze_now and not calidad["ok"]:
+            _inc("analisis_evitados")
+        elif analyze_now:
+            _progreso(effective_user_id, note_id, "analisis", 0)
             texto_detectado = (ocr_json.get("resultado", {}).get("texto") or "").strip()
-            an_payload = {**downstream_form, "texto": texto_detectado}
+            an_payload = {**downstream_form, "texto": texto_detectado, "incremental": True}
             an_resp = await client.post(ANALYSIS_URL, json=an_payload, headers=headers)
             if an_resp.status_code >= 400:
                 raise HTTPException(status_code=an_resp.status_code, detail=f"Análisis error: {an_resp.text}")
@@ -721,6 +1684,7 @@ async def orquestar_foto(
 
         # Persistimos si ya analizamos (Tu lógica original de 'if analysis_json:')
         if analysis_json:
+            _progreso(effective_user_id, note_id, "persistiendo", 90)
             source_gcs_uri = ocr_json.get("imagen_gcs") if file else gcs_uri
             await _save_note_to_firestore(
                 db_client=db,
@@ -736,12 +1700,20 @@ async def orquestar_foto(
                 analysis_result=analysis_json,
             )
 
+    if not calidad["ok"]:
+        mensaje = "OCR de baja calidad: vuelve a capturar la imagen"
+    else:
+        mensaje = "OCR listo (pendiente de confirmación)" if not analyze_now else "Pipeline completado (foto)"
+
+    _progreso(effective_user_id, note_id, "completado", 100)
     return {
-        "mensaje": "OCR listo (pendiente de confirmación)" if not analyze_now else "Pipeline completado (foto)",
+        "mensaje": mensaje,
         "user_id": effective_user_id,
         "note_id": note_id,
         "ocr": ocr_json,
         "analisis": analysis_json,
+        "calidad": calidad,
+        "requiere_recaptura": not calidad["ok"],
     }
 
 # AUDIO → TRANSCRIPCIÓN → ANÁLISIS
@@ -753,6 +1725,7 @@ async def orquestar_audio(
     session_id: str = Form(...),
     org_id: str = Form(...),
     analyze_now: bool = Form(default=False),
+    note_id: Optional[str] = Form(default=None),     # opcional: para seguir /progreso/{note_id}
     current_user: dict = Depends(get_current_user),
     authorization: Optional[str] = Header(default=None, alias="Authorization"),
 ):
@@ -760,30 +1733,32 @@ async def orquestar_audio(
     if not file and not gcs_uri:
         raise HTTPException(status_code=400, detail="Envía 'file' o 'gcs_uri'.")
 
-    note_id = str(uuid.uuid4())
+    note_id = _note_id_cliente(note_id)
     downstream_form = { "org_id": org_id, "patient_id": patient_id, "session_id": session_id, "note_id": note_id }
     headers = build_forward_headers(authorization, effective_user_id)
 
-    async with httpx.AsyncClient(timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)) as client:
+    _progreso(effective_user_id, note_id, "recibido", 0)
+    async with _cliente_pipeline(effective_user_id, note_id) as client:
         # Transcripción
         if file is not None:
-            file_bytes = await file.read()
-            if not file_bytes:
+            # Reenviamos el spool en disco de Starlette: httpx lo manda por streaming
+            if not file.file.seek(0, os.SEEK_END):
                 raise HTTPException(status_code=400, detail="Archivo vacío o no válido.")
-            files = {"file": (file.filename or "audio.bin", file_bytes, file.content_type or "audio/mpeg")}
-            tr_resp = await client.post(AUDIO_URL, files=files, data=downstream_form, headers=headers)
+            file.file.seek(0)
+            files = {"file": (file.filename or "audio.bin", file.file, file.content_type or "audio/mpeg")}
+            tr_status, tr_json = await _post_con_progreso(client, AUDIO_URL, effective_user_id, note_id, headers, files=files, data=downstream_form)
         else:
             form = {**downstream_form, "gcs_uri": gcs_uri}
-            tr_resp = await client.post(AUDIO_URL, data=form, headers=headers)
+            tr_status, tr_json = await _post_con_progreso(client, AUDIO_URL, effective_user_id, note_id, headers, data=form)
 
-        if tr_resp.status_code >= 400:
-            raise HTTPException(status_code=tr_resp.status_code, detail=f"Audio error: {tr_resp.text}")
-        tr_json = tr_resp.json()
+        if tr_status >= 400:
+            raise HTTPException(status_code=tr_status, detail=f"Audio error: {tr_json}")
 
         analysis_json = None
         if analyze_now:
+            _progreso(effective_user_id, note_id, "analisis", 0)
             texto = (tr_json.get("resultado", {}).get("texto") or "").strip()
-            an_payload = {**downstream_form, "texto": texto}
+            an_payload = {**downstream_form, "texto": texto, "incremental": True}
             an_resp = await client.post(ANALYSIS_URL, json=an_payload, headers=headers)
             if an_resp.status_code >= 400:
                 raise HTTPException(status_code=an_resp.status_code, detail=f"Análisis error: {an_resp.text}")
@@ -791,6 +1766,7 @@ async def orquestar_audio(
 
         # Persistimos si ya analizamos (Tu lógica original de 'if analysis_json:')
         if analysis_json:
+            _progreso(effective_user_id, note_id, "persistiendo", 90)
             source_gcs_uri = tr_json.get("audio_gcs") if file else gcs_uri
             await _save_note_to_firestore(
                 db_client=db,
@@ -806,6 +1782,7 @@ async def orquestar_audio(
                 analysis_result=analysis_json,
             )
 
+    _progreso(effective_user_id, note_id, "completado", 100)
     return {
         "mensaje": "Transcripción lista (pendiente de confirmación)" if not analyze_now else "Pipeline completado (audio)",
         "user_id": effective_user_id,
@@ -814,6 +1791,120 @@ async def orquestar_audio(
         "analisis": analysis_json,
     }
 
+# PROGRESO (SSE)
+@app.get("/progreso/{note_id}")
+async def progreso_sse(note_id: str, token: str, request: Request):
+    """
+    Server-Sent Events con las etapas del pipeline de `note_id` (orquestador + OCR/audio).
+    EventSource no permite headers: el ID token de Firebase va en el query param `token`.
+    Se puede abrir antes del POST a /orquestar_* si el frontend fija el note_id.
+    """
+    try:
+        uid = auth.verify_id_token(token).get("uid")
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"Token inválido: {e}")
+
+    def _sse(evento: Dict[str, Any]) -> str:
+        return f"event: {evento.get('type', 'progress')}\ndata: {json.dumps(evento, ensure_ascii=False, default=str)}\n\n"
+
+    async def eventos():
+        enviados = 0
+        try:
+            while True:
+                canal = _canal_progreso(uid, note_id)
+                cambio = canal["cambio"]
+                while enviados < len(canal["eventos"]):
+                    evento = canal["eventos"][enviados]
+                    enviados += 1
+                    yield _sse(evento)
+                if canal["cerrado"] or await request.is_disconnected():
+                    return
+                try:
+                    await asyncio.wait_for(cambio.wait(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # keep-alive para proxies
+        except Exception as e:
+            # El suscriptor recibe el error y el stream termina (no se queda esperando un "completado")
+            logger.error(f"[progreso] Error en el stream de {note_id}: {e}", exc_info=True)
+            yield _sse({"type": "error", "servicio": "orquestador", "etapa": "error", "pct": 100,
+                        "status": 500, "detail": f"Error en el stream de progreso: {e}", "note_id": note_id})
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# AUDIO EN VIVO (proxy WebSocket → servicio de audio)
+@app.websocket("/ws/transcribir")
+async def transcribir_en_vivo_proxy(
+    ws: WebSocket,
+    token: str,
+    org_id: str,
+    patient_id: str,
+    session_id: str,
+    mime: str = "audio/webm",
+):
+    """
+    Los navegadores no pueden mandar headers en WebSocket: el ID token de Firebase
+    llega como query param `token`. Se verifica aquí y el uid viaja al servicio de
+    audio como X-User-Id (igual que en los endpoints HTTP).
+    """
+    await ws.accept()
+    try:
+        decoded = auth.verify_id_token(token)
+    except Exception as e:
+        logger.warning(f"[ws] Token inválido: {e}")
+        await ws.close(code=4401)
+        return
+    uid = decoded.get("uid")
+
+    from websockets.asyncio.client import connect as ws_connect
+
+    note_id = str(uuid.uuid4())
+    params = urlencode({
+        "org_id": org_id, "patient_id": patient_id, "session_id": session_id,
+        "note_id": note_id, "mime": mime,
+    })
+    headers = build_forward_headers(f"Bearer {token}", uid)
+
+    try:
+        async with ws_connect(f"{AUDIO_WS_URL}?{params}", additional_headers=headers, max_size=None) as upstream:
+            await ws.send_json({"type": "ready", "note_id": note_id})
+
+            async def cliente_a_audio():
+                while True:
+                    msg = await ws.receive()
+                    if msg.get("type") == "websocket.disconnect":
+                        await upstream.close()
+                        return
+                    if msg.get("bytes"):
+                        await upstream.send(msg["bytes"])
+                    elif msg.get("text"):
+                        await upstream.send(msg["text"])
+
+            async def audio_a_cliente():
+                async for msg in upstream:
+                    await ws.send_text(msg if isinstance(msg, str) else msg.decode("utf-8"))
+
+            subida = asyncio.create_task(cliente_a_audio())
+            try:
+                # Termina cuando el servicio de audio cierra (tras "done"/"error")
+                await audio_a_cliente()
+            finally:
+                subida.cancel()
+        if ws.client_state.name == "CONNECTED":
+            await ws.close()
+    except WebSocketDisconnect:
+        logger.info(f"[ws] Cliente desconectado (nota {note_id})")
+    except Exception as e:
+        logger.error(f"[ws] Error en proxy de audio en vivo (nota {note_id}): {e}")
+        try:
+            await ws.send_json({"type": "error", "detail": f"Audio en vivo no disponible: {e}"})
+            await ws.close(code=1011)
+        except Exception:
+            pass
+
 @app.post("/guardar_nota", response_model=GuardarNotaOut)
 async def guardar_nota(
     payload: GuardarNotaIn,
@@ -830,6 +1921,8 @@ async def guardar_nota(
         "patient_id": payload.patient_id,
         "session_id": payload.session_id,
         "note_id": payload.note_id,
+        # Solo se re-analizan los párrafos que cambiaron desde el último análisis de la nota
+        "incremental": True,
     }
     async with httpx.AsyncClient(timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)) as client:
         an_resp = await client.post(ANALYSIS_URL, json=an_payload, headers=headers)
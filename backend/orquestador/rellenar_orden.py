@@ -0,0 +1,95 @@
+"""
+Migración única: rellena los campos por los que ordenan los listados paginados del
+orquestador (/pacientes, /pacientes/{id}/sesiones, /sesion/{id}/notas).
+
+Firestore deja fuera de un order_by a los documentos que no tienen el campo, y los
+listados ya no recorren la colección buscándolos: los documentos escritos antes de que
+el orquestador fijara estos campos se completan aquí, una vez.
+  patients  → fullName   ("" si falta: quedan primero en el orden alfabético)
+  sessions  → created_at / updated_at (de otros timestamps de la sesión, o la hora actual)
+  notes     → created_at (processed_at, o la hora actual)
+
+Uso (credenciales por ADC):
+  python rellenar_orden.py [--org ORG_ID] [--aplicar]
+Sin --aplicar solo cuenta lo que cambiaría.
+"""
+
+import argparse
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("rellenar_orden")
+
+LOTE_ESCRITURAS = 400  # por batch (límite de Firestore: 500)
+
+# colección → campos que se leen para decidir (select)
+CAMPOS = {
+    "patients": ["fullName"],
+    "sessions": ["created_at", "updated_at", "signed_at_ts", "rollup.created_at", "rollup.updated_at"],
+    "notes": ["created_at", "processed_at"],
+}
+
+def _campo(datos: Dict[str, Any], ruta: str) -> Any:
+    for parte in ruta.split("."):
+        if not isinstance(datos, dict):
+            return None
+        datos = datos.get(parte)
+    return datos
+
+def faltantes(coleccion: str, datos: Dict[str, Any], ahora: Any) -> Dict[str, Any]:
+    """Campos a escribir (merge) en un documento de `coleccion`; {} si no le falta nada.
+    `ahora` es el valor por defecto (SERVER_TIMESTAMP al aplicar)."""
+    if coleccion == "patients":
+        return {} if datos.get("fullName") is not None else {"fullName": ""}
+    if coleccion == "notes":
+        return {} if datos.get("created_at") is not None else {"created_at": datos.get("processed_at") or ahora}
+    if coleccion == "sessions":
+        marcas = [m for m in (_campo(datos, c) for c in CAMPOS["sessions"]) if isinstance(m, datetime)]
+        out: Dict[str, Any] = {}
+        if datos.get("created_at") is None:
+            out["created_at"] = min(marcas) if marcas else ahora
+        if datos.get("updated_at") is None:
+            out["updated_at"] = max(marcas) if marcas else ahora
+        return out
+    raise ValueError(f"Colección desconocida: {coleccion}")
+
+def rellenar(db, coleccion: str, org_id: Optional[str] = None, aplicar: bool = False) -> int:
+    """Recorre el collectionGroup `coleccion` (solo los campos de CAMPOS) y completa lo que falte."""
+    from google.cloud import firestore
+
+    prefijo = f"orgs/{org_id}/" if org_id else ""
+    batch, pendientes, total = db.batch(), 0, 0
+    for snap in db.collection_group(coleccion).select(CAMPOS[coleccion]).stream():
+        if not snap.reference.path.startswith(prefijo):
+            continue
+        cambios = faltantes(coleccion, snap.to_dict() or {}, firestore.SERVER_TIMESTAMP)
+        if not cambios:
+            continue
+        total += 1
+        if not aplicar:
+            continue
+        batch.set(snap.reference, cambios, merge=True)
+        pendientes += 1
+        if pendientes >= LOTE_ESCRITURAS:
+            batch.commit()
+            batch, pendientes = db.batch(), 0
+    if aplicar and pendientes:
+        batch.commit()
+    logger.info(f"[{coleccion}] {total} documentos {'actualizados' if aplicar else 'por actualizar'}")
+    return total
+
+def main() -> None:
+    from google.cloud import firestore
+
+    parser = argparse.ArgumentParser(description="Rellena los campos de orden de los listados paginados.")
+    parser.add_argument("--org", help="solo esta organización")
+    parser.add_argument("--aplicar", action="store_true", help="escribir (por defecto solo cuenta)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    db = firestore.Client()
+    for coleccion in CAMPOS:
+        rellenar(db, coleccion, args.org, args.aplicar)
+
+if __name__ == "__main__":
+    main()
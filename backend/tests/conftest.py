@@ -0,0 +1,24 @@
+"""
+Pruebas del backend. Correr desde backend/:
+  python -m pytest -q tests
+
+Cada servicio se importa como módulo suelto (igual que en su imagen: /app/{servicio}.py
+junto a /app/common), así que se agregan backend/ y las carpetas de servicio al path.
+Los servicios usan backend local y sin caché/medición remota para no tocar GCP.
+"""
+
+import os
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for ruta in (BACKEND, *(os.path.join(BACKEND, d) for d in ("analisis", "audio", "ocr", "orquestador"))):
+    if ruta not in sys.path:
+        sys.path.insert(0, ruta)
+
+os.environ.setdefault("AN_STORAGE_BACKEND", "local")
+os.environ.setdefault("AN_CACHE_ENABLED", "false")
+os.environ.setdefault("AN_METER_SINK", "none")
+os.environ.setdefault("AUDIO_STORAGE_BACKEND", "local")
+os.environ.setdefault("AUDIO_CACHE_ENABLED", "false")
+os.environ.setdefault("AUDIO_METER_SINK", "none")
+os.environ.setdefault("OCR_STORAGE_BACKEND", "local")
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+analysis = pytest.importorskip("analysis")
+
+TEXTO = "Hoy me sentí muy triste por la pelea.\n\nFui al parque.\n\nMañana tengo una entrevista y estoy nervioso."
+
+@pytest.fixture
+def llamadas(monkeypatch):
+    """Reemplaza el modelo: "parque" no tiene emociones ({}), el resto tristeza 50."""
+    vistos = []
+
+    async def _paquete(model, textos):
+        vistos.append(dict(textos))
+        return {k: ({} if "parque" in t else {"tristeza": {"porcentaje": 50.0, "entidades": []}})
+                for k, t in textos.items()}
+
+    monkeypatch.setattr(analysis, "analizar_paquete_con_respaldo", _paquete)
+    return vistos
+
+def test_primer_analisis_llena_la_cache(llamadas):
+    combinado, vigente, stats, _ = asyncio.run(analysis.analizar_incremental(None, TEXTO, {}))
+    assert stats["parrafos"] == 3
+    assert stats["parrafos_desde_cache"] == 0
+    assert len(vigente) == 3
+    assert {} in vigente.values()
+    assert combinado["tristeza"]["porcentaje"] > 0
+
+def test_resultado_vacio_en_cache_no_rompe_la_reedicion(llamadas):
+    _, cache, _, _ = asyncio.run(analysis.analizar_incremental(None, TEXTO, {}))
+    llamadas.clear()
+
+    # Mismo texto: todo sale de la caché, incluido el párrafo con resultado {}
+    _, vigente, stats, _ = asyncio.run(analysis.analizar_incremental(None, TEXTO, cache))
+    assert llamadas == []
+    assert stats["parrafos_desde_cache"] == 3
+    assert vigente == cache
+
+def test_solo_los_parrafos_cambiados_van_al_modelo(llamadas):
+    _, cache, _, _ = asyncio.run(analysis.analizar_incremental(None, TEXTO, {}))
+    llamadas.clear()
+
+    editado = TEXTO.replace("Fui al parque.", "Fui al parque con mi hermana.")
+    _, vigente, stats, _ = asyncio.run(analysis.analizar_incremental(None, editado, cache))
+    assert [list(p.values()) for p in llamadas] == [["Fui al parque con mi hermana."]]
+    assert stats["parrafos_desde_cache"] == 2
+    # La caché resultante solo tiene los párrafos del texto actual
+    assert len(vigente) == 3 and set(vigente) != set(cache)
+
+def _texto_largo(n=60):
+    return "\n\n".join(f"Párrafo {i}: " + "el paciente describe su semana con detalle. " * 6 for i in range(n))
+
+@pytest.fixture
+def fragmentos_analizados(monkeypatch):
+    vistos = []
+
+    async def _texto(model, texto):
+        vistos.append(texto)
+        return {"estres": {"porcentaje": 30.0, "entidades": []}}
+
+    monkeypatch.setattr(analysis, "analizar_texto", _texto)
+    return vistos
+
+def test_texto_largo_usa_los_fragmentos_del_map_reduce(fragmentos_analizados):
+    texto = _texto_largo()
+    assert analysis.estimar_tokens(texto) > analysis.MR_THRESHOLD_TOKENS
+    combinado, vigente, stats, fragmentos = asyncio.run(analysis.analizar_incremental(None, texto, {}))
+    assert stats["unidad"] == "fragmento"
+    assert len(fragmentos) == len(vigente) == len(fragmentos_analizados) > 1
+    assert combinado["estres"]["porcentaje"] == 30.0
+
+def test_editar_un_parrafo_de_un_texto_largo_reutiliza_el_resto(fragmentos_analizados):
+    texto = _texto_largo()
+    _, cache, _, fragmentos = asyncio.run(analysis.analizar_incremental(None, texto, {}))
+    fragmentos_analizados.clear()
+
+    editado = texto.replace("Párrafo 3: ", "Párrafo 3 (corregido por el terapeuta, con más contexto): ")
+    _, _, stats, _ = asyncio.run(analysis.analizar_incremental(None, editado, cache))
+    # Cortes por contenido: solo cambia el fragmento editado (y a lo sumo el siguiente)
+    assert 1 <= stats["llamadas_modelo"] <= 2
+    assert stats["parrafos_desde_cache"] >= len(fragmentos) - 2
+
+def test_map_reduce_sin_cache_siembra_la_misma_clave(fragmentos_analizados):
+    texto = _texto_largo()
+    _, _, vigente_mr = asyncio.run(analysis.analizar_texto_largo(None, texto))
+    fragmentos_analizados.clear()
+    _, _, stats, _ = asyncio.run(analysis.analizar_incremental(None, texto, vigente_mr))
+    assert fragmentos_analizados == [] and stats["llamadas_modelo"] == 0
+
+def test_cambiar_la_version_de_prompt_invalida_la_cache_de_parrafos(llamadas, monkeypatch, tmp_path):
+    monkeypatch.setattr(analysis, "USE_GCS", True)
+    monkeypatch.setattr(analysis, "ALMACEN", analysis.crear_almacen("bucket", "", None, "local", str(tmp_path)))
+    path = analysis.cache_parrafos_path("org", "doc", "pac", "s1", "n1")
+    _, vigente, _, _ = asyncio.run(analysis.analizar_incremental(None, TEXTO, {}))
+    analysis.guardar_cache_parrafos(path, vigente)
+    assert analysis.leer_cache_parrafos(path) == vigente
+
+    monkeypatch.setattr(analysis, "PROMPT_VERSION", analysis.PROMPT_VERSION + "-nueva")
+    llamadas.clear()
+    _, _, stats, _ = asyncio.run(analysis.analizar_incremental(None, TEXTO, analysis.leer_cache_parrafos(path)))
+    assert stats["parrafos_desde_cache"] == 0 and len(llamadas) == 1
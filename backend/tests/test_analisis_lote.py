@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+analysis = pytest.importorskip("analysis")
+from fastapi import HTTPException
+
+@pytest.fixture
+def modelo_falso(monkeypatch):
+    async def _texto(model, texto):
+        return {"eco": texto}
+
+    async def _paquete(model, textos):
+        return {k: {"eco": t} for k, t in textos.items()}
+
+    monkeypatch.setattr(analysis, "ensure_vertex_model", lambda: object())
+    monkeypatch.setattr(analysis, "analizar_texto", _texto)
+    monkeypatch.setattr(analysis, "analizar_paquete", _paquete)
+    monkeypatch.setattr(analysis, "USE_GCS", False)
+
+def _lote(*items):
+    return analysis.LoteEntrada(org_id="org", patient_id="pac", session_id="s1",
+                                items=[analysis.ItemLote(note_id=n, texto=t) for n, t in items])
+
+def test_note_id_repetido_se_rechaza(modelo_falso):
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(analysis.analizar_emociones_lote(_lote(("a", "uno"), ("b", "dos"), ("a", "tres")), "doc"))
+    assert e.value.status_code == 400 and "a" in e.value.detail
+
+def test_cada_nota_recibe_su_resultado(modelo_falso):
+    r = asyncio.run(analysis.analizar_emociones_lote(_lote(("a", "uno"), ("b", "dos"), ("c", "tres")), "doc"))
+    assert [(it["note_id"], it["resultado"]["eco"]) for it in r["items"]] == [("a", "uno"), ("b", "dos"), ("c", "tres")]
+    assert r["ok"] == 3
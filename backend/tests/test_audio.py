@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("multipart")
+audio = pytest.importorskip("audio_transcriber")
+from fastapi.testclient import TestClient
+
+FORM = {"org_id": "org", "patient_id": "pac", "session_id": "ses", "note_id": "n1", "modo": "uri"}
+
+@pytest.fixture
+def servicio_uri(monkeypatch):
+    """Modo uri con GCS y modelo falsos; registra lo que leyó la subida."""
+    subidas = []
+
+    def _subir(*args, fileobj=None, **kwargs):
+        subidas.append(fileobj.read())
+        return {"contenido": "gs://bucket/raw/n1.m4a"}
+
+    async def _transcribir(model, uri, mime, segundos=None):
+        return f"texto de {uri}"
+
+    monkeypatch.setattr(audio, "USE_GCS", True)
+    monkeypatch.setattr(audio.ALMACEN, "backend", "gcs")
+    monkeypatch.setattr(audio, "gcs_upload_raw", _subir)
+    monkeypatch.setattr(audio, "gcs_upload_json", lambda **kw: None)
+    monkeypatch.setattr(audio, "ensure_vertex_model", lambda: object())
+    monkeypatch.setattr(audio, "transcribir_uri", _transcribir)
+    return subidas
+
+def test_modo_uri_sube_dentro_del_stream_con_progreso(servicio_uri):
+    r = TestClient(audio.app).post("/transcribir_audio", data=FORM, headers={"X-Progress": "ndjson"},
+                                   files={"file": ("nota.m4a", b"audio-crudo", "audio/mp4")})
+    eventos = [json.loads(l) for l in r.text.splitlines()]
+    etapas = [e["etapa"] for e in eventos if e["type"] == "progress"]
+    assert etapas[:2] == ["subiendo_gcs", "modelo"]
+    assert servicio_uri == [b"audio-crudo"]
+    assert eventos[-1]["type"] == "result"
+    assert eventos[-1]["data"]["audio_gcs"] == "gs://bucket/raw/n1.m4a"
+    assert eventos[-1]["data"]["resultado"]["texto"] == "texto de gs://bucket/raw/n1.m4a"
+
+def test_modo_uri_sin_stream_y_archivo_vacio(servicio_uri):
+    cliente = TestClient(audio.app)
+    r = cliente.post("/transcribir_audio", data=FORM, files={"file": ("nota.m4a", b"audio-crudo", "audio/mp4")})
+    assert r.status_code == 200 and r.json()["audio_gcs"] == "gs://bucket/raw/n1.m4a"
+    r = cliente.post("/transcribir_audio", data=FORM, headers={"X-Progress": "ndjson"},
+                     files={"file": ("nota.m4a", b"", "audio/mp4")})
+    assert r.status_code == 400 and servicio_uri == [b"audio-crudo"]
+
+def test_segmento_saturado_cancela_los_demas(monkeypatch):
+    iniciados, cancelados = [], []
+
+    async def _transcribir(model, data, mime, etiqueta, sem, segundos=None):
+        iniciados.append(etiqueta)
+        if etiqueta.endswith("segmento 0"):
+            await asyncio.sleep(0.01)
+            raise audio.Saturado(5)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelados.append(etiqueta)
+            raise
+        return "texto"
+
+    monkeypatch.setattr(audio, "puntos_de_corte", lambda a: [(0, 1), (1, 2), (2, 3)])
+    monkeypatch.setattr(audio, "codificar", lambda seg: (b"", "audio/ogg"))
+    monkeypatch.setattr(audio, "transcribir_con_reintentos", _transcribir)
+    with pytest.raises(audio.Saturado):
+        asyncio.run(asyncio.wait_for(audio.transcribir_por_segmentos(None, b"abc", "n1"), 5))
+    assert len(iniciados) == 3 and sorted(cancelados) == ["Nota n1 segmento 1", "Nota n1 segmento 2"]
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from common.cache_respuestas import CacheRespuestas
+from common.storage import AlmacenLocal
+
+def _cache(nivel="memoria", **kw) -> CacheRespuestas:
+    return CacheRespuestas("analisis", 16, 3600, nivel, modelo="m1", version_prompt="1", **kw)
+
+class Modelo:
+    def __init__(self):
+        self.llamadas = 0
+
+    async def __call__(self):
+        self.llamadas += 1
+        return {"alegria": self.llamadas}
+
+def test_modelo_y_version_de_prompt_entran_en_la_clave():
+    base = _cache().clave("prompt")
+    assert CacheRespuestas("analisis", 16, 3600, "memoria", modelo="m2", version_prompt="1").clave("prompt") != base
+    assert CacheRespuestas("analisis", 16, 3600, "memoria", modelo="m1", version_prompt="2").clave("prompt") != base
+
+def test_cada_organizacion_tiene_su_cache():
+    cache, modelo = _cache(), Modelo()
+    clave = cache.clave("prompt")
+
+    async def _prueba():
+        a = await cache.obtener_o_calcular(clave, modelo, org_id="org_a")
+        a_otra_vez = await cache.obtener_o_calcular(clave, modelo, org_id="org_a")
+        b = await cache.obtener_o_calcular(clave, modelo, org_id="org_b")
+        return a, a_otra_vez, b
+
+    a, a_otra_vez, b = asyncio.run(_prueba())
+    assert a == a_otra_vez and b != a and modelo.llamadas == 2
+
+def test_nivel_gcs_guarda_bajo_la_organizacion(tmp_path):
+    almacen = AlmacenLocal("bucket", raiz=str(tmp_path))
+    cache, modelo = _cache("gcs", almacen=almacen), Modelo()
+    clave = cache.clave("prompt")
+    asyncio.run(cache.obtener_o_calcular(clave, modelo, org_id="org_a"))
+
+    rutas = [o["ruta"] for o in almacen.listar("")]
+    assert rutas == [f"org_a/_cache/analisis/{clave[:2]}/{clave}.json"]
+    # Otro proceso (memoria vacía) la encuentra en el nivel persistente
+    otra = _cache("gcs", almacen=almacen)
+    assert asyncio.run(otra.obtener_o_calcular(clave, modelo, org_id="org_a")) == {"alegria": 1}
+    assert otra.estado()["hits_persistente"] == 1
+
+def test_deshabilitada_siempre_calcula():
+    cache, modelo = _cache(habilitada=False), Modelo()
+    for _ in range(2):
+        asyncio.run(cache.obtener_o_calcular(cache.clave("p"), modelo))
+    assert modelo.llamadas == 2
+
+def test_nivel_desconocido_se_rechaza():
+    with pytest.raises(ValueError):
+        _cache("redis")
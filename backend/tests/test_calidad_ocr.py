@@ -0,0 +1,28 @@
+from common.calidad_ocr import evaluar_calidad_ocr
+
+PROSA = ("El paciente refiere que durante la semana durmió mal y que se siente más "
+         "tranquilo cuando sale a caminar con su hermana por las tardes.")
+
+def test_prosa_en_espanol_pasa():
+    r = evaluar_calidad_ocr(PROSA, 0.9)
+    assert r["ok"] and r["idioma"] == "es" and r["motivos"] == []
+    assert r["chars"] == len(PROSA.replace(" ", ""))
+
+def test_texto_vacio_o_corto():
+    for texto in ("", "   ", "hola"):
+        r = evaluar_calidad_ocr(texto)
+        assert r == {"score": 0.0, "ok": False, "motivos": ["texto_vacio_o_muy_corto"],
+                     "chars": len(texto.strip()), "idioma": None}
+    assert evaluar_calidad_ocr("hola", min_chars=3)["motivos"] != ["texto_vacio_o_muy_corto"]
+
+def test_basura_de_simbolos_no_pasa():
+    r = evaluar_calidad_ocr("#$% &&* ||| ~~~ @@@ 123 ;;; ::: xkq zzv", 0.9)
+    assert not r["ok"]
+    assert {"muchos_simbolos", "pocas_palabras_validas", "idioma_no_detectado"} <= set(r["motivos"])
+
+def test_baja_confianza_resta_y_se_reporta():
+    alta = evaluar_calidad_ocr(PROSA, 0.95)
+    baja = evaluar_calidad_ocr(PROSA, 0.1)
+    assert "baja_confianza_ocr" in baja["motivos"] and "baja_confianza_ocr" not in alta["motivos"]
+    assert baja["score"] < alta["score"]
+    assert not evaluar_calidad_ocr(PROSA, 0.1, min_score=0.9)["ok"]
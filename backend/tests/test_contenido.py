@@ -0,0 +1,69 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from common.contenido import guardar_raw, reconciliar, ruta_contenido, sha256_de
+from common.storage import AlmacenLocal
+
+FOTO = b"\xff\xd8" + b"foto" * 1000
+
+@pytest.fixture
+def almacen(tmp_path):
+    return AlmacenLocal("bucket", raiz=str(tmp_path))
+
+def _guardar(almacen, nota: str, data: bytes = FOTO) -> dict:
+    return guardar_raw(almacen, "org", "doc", "pac", "s1", nota, f"{nota}.jpg", "image/jpeg", data=data)
+
+def _envejecer(almacen, ruta: str, horas: float = 48) -> None:
+    t = time.time() - horas * 3600
+    os.utime(almacen._archivo(ruta), (t, t))
+
+def _ruta_cas(almacen, data: bytes = FOTO) -> str:
+    return ruta_contenido(almacen, "org", sha256_de(data)["sha256"])
+
+def test_reconciliar_cuenta_ahorro_por_dedup(almacen):
+    assert not _guardar(almacen, "n1")["dedup"]
+    assert _guardar(almacen, "n2")["dedup"]
+    r = reconciliar(almacen, "org")
+    assert r["objetos_unicos"] == 1 and r["referencias"] == 2
+    assert r["bytes_ahorrados_dedup"] == len(FOTO)
+    assert r["huerfanos"] == 0
+
+def test_borra_huerfanos_viejos_y_respeta_la_gracia(almacen):
+    viejo, nuevo = b"viejo" * 10, b"nuevo" * 10
+    for data in (viejo, nuevo):
+        almacen.put_bytes(_ruta_cas(almacen, data), data, "image/jpeg")
+    _envejecer(almacen, _ruta_cas(almacen, viejo))
+
+    r = reconciliar(almacen, "org", borrar_huerfanos=True, gracia_h=24)
+    assert r["huerfanos"] == 2 and r["huerfanos_borrados"] == 1
+    assert not almacen.existe(_ruta_cas(almacen, viejo))
+    assert almacen.existe(_ruta_cas(almacen, nuevo))
+
+def test_reuso_durante_la_reconciliacion_no_pierde_el_objeto(almacen, monkeypatch):
+    # Objeto viejo cuya única referencia se perdió: huérfano en el listado
+    almacen.put_bytes(_ruta_cas(almacen), FOTO, "image/jpeg")
+    _envejecer(almacen, _ruta_cas(almacen))
+    listar = almacen.listar
+
+    def _listar_y_subir(prefijo):
+        objetos = list(listar(prefijo))
+        # Entre el listado y el borrado llega la misma foto: dedup + referencia nueva
+        assert _guardar(almacen, "n1")["dedup"]
+        return iter(objetos)
+
+    monkeypatch.setattr(almacen, "listar", _listar_y_subir)
+    r = reconciliar(almacen, "org", borrar_huerfanos=True, gracia_h=24)
+    assert r["huerfanos"] == 1 and r["huerfanos_borrados"] == 0
+    assert almacen.get_bytes(_ruta_cas(almacen)) == FOTO
+
+def test_borrar_si_viejo_no_borra_lo_tocado(almacen):
+    ruta = _ruta_cas(almacen)
+    almacen.put_bytes(ruta, FOTO, "image/jpeg")
+    _envejecer(almacen, ruta)
+    limite = datetime.now(timezone.utc) - timedelta(hours=24)
+    assert almacen.tocar(ruta)["size"] == len(FOTO)
+    assert not almacen.borrar_si_viejo(ruta, limite)
+    assert almacen.tocar("no/existe") is None
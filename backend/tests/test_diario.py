@@ -0,0 +1,85 @@
+import asyncio
+import threading
+
+import pytest
+
+from common.diario import DiarioNotas
+
+def _nota(note_id: str, texto: str, session_id: str = "s1") -> dict:
+    return {"org_id": "o", "doctor_uid": "d", "patient_id": "p", "session_id": session_id,
+            "note_id": note_id, "text_content": texto}
+
+class Destino:
+    """escribir(cliente, notas) de prueba: registra lo escrito; puede fallar a pedido."""
+
+    def __init__(self):
+        self.escritas = []
+        self.fallar = 0
+        self.hilos = set()
+
+    def __call__(self, cliente, notas):
+        self.hilos.add(threading.get_ident())
+        if self.fallar:
+            self.fallar -= 1
+            raise RuntimeError("firestore no disponible")
+        self.escritas.append([(n["note_id"], n["text_content"]) for n in notas])
+
+@pytest.fixture
+def destino():
+    return Destino()
+
+def test_agregar_desde_otro_hilo_despierta_al_flusher(tmp_path, destino):
+    diario = DiarioNotas(str(tmp_path / "j.db"), destino, flush_s=30)
+
+    async def _prueba():
+        tarea = asyncio.create_task(diario.bucle(None))
+        await asyncio.sleep(0.05)
+        # Hilo suelto (sin to_thread, cuyo resultado ya despertaría al loop). Con flush_s=30,
+        # si el aviso no cruza de hilo el loop sigue en select() hasta que vence el sleep
+        threading.Thread(target=diario.agregar, args=(_nota("n1", "hola"),)).start()
+        await asyncio.sleep(1.0)
+        escritas = list(destino.escritas)
+        tarea.cancel()
+        return escritas
+
+    assert asyncio.run(_prueba()) == [[("n1", "hola")]]
+    assert diario.estado()["registradas"] == 1
+
+def test_se_escribe_solo_la_ultima_version_de_cada_nota(tmp_path, destino):
+    diario = DiarioNotas(str(tmp_path / "j.db"), destino)
+    for texto in ("v1", "v2", "v3"):
+        diario.agregar(_nota("n1", texto))
+    diario.agregar(_nota("n2", "otra"))
+
+    assert asyncio.run(diario.vaciar(None)) == 2
+    assert sorted(destino.escritas[0]) == [("n1", "v3"), ("n2", "otra")]
+    assert diario.pendientes() == 0
+    assert diario.estado()["deduplicadas"] == 2
+
+def test_fallo_pospone_y_una_version_vieja_no_pisa_a_la_nueva(tmp_path, destino):
+    diario = DiarioNotas(str(tmp_path / "j.db"), destino, max_backoff_s=0)
+    diario.agregar(_nota("n1", "vieja"))
+    destino.fallar = 1
+    assert asyncio.run(diario.vaciar(None)) == 0
+    assert diario.pendientes() == 1 and diario.estado()["pendientes_con_error"] == 1
+
+    diario.agregar(_nota("n1", "nueva"))
+    assert asyncio.run(diario.vaciar(None)) == 1
+    assert destino.escritas == [[("n1", "nueva")]]
+    assert diario.pendientes() == 0
+
+def test_replay_de_lo_pendiente_tras_reiniciar(tmp_path, destino):
+    ruta = str(tmp_path / "j.db")
+    DiarioNotas(ruta, destino).agregar(_nota("n1", "sin escribir"))
+
+    reabierto = DiarioNotas(ruta, destino)
+    assert reabierto.pendientes() == 1
+    assert asyncio.run(reabierto.vaciar(None)) == 1
+    assert destino.escritas == [[("n1", "sin escribir")]]
+
+def test_sesiones_distintas_van_en_escrituras_separadas(tmp_path, destino):
+    diario = DiarioNotas(str(tmp_path / "j.db"), destino)
+    diario.agregar(_nota("n1", "a", session_id="s1"))
+    diario.agregar(_nota("n2", "b", session_id="s2"))
+    assert asyncio.run(diario.vaciar(None)) == 2
+    assert sorted(destino.escritas) == [[("n1", "a")], [("n2", "b")]]
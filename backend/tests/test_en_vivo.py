@@ -0,0 +1,77 @@
+import os
+import stat
+import time
+
+import pytest
+
+pytest.importorskip("pydub")
+pytest.importorskip("multipart")
+audio = pytest.importorskip("audio_transcriber")
+
+MS = audio.PCM_BYTES_POR_MS
+
+@pytest.fixture
+def ffmpeg_falso(tmp_path, monkeypatch):
+    """ffmpeg que "decodifica" copiando stdin a stdout: los bytes del spool ya son PCM."""
+    binario = tmp_path / "bin" / "ffmpeg"
+    binario.parent.mkdir()
+    binario.write_text("#!/bin/sh\nexec cat\n")
+    binario.chmod(binario.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{binario.parent}{os.pathsep}{os.environ['PATH']}")
+
+def _esperar_ms(obtener, ms: int):
+    limite = time.monotonic() + 5
+    while len(valor := obtener()) < ms and time.monotonic() < limite:
+        time.sleep(0.01)
+    return valor
+
+def test_decodificador_solo_procesa_y_guarda_lo_nuevo(tmp_path, ffmpeg_falso):
+    spool = tmp_path / "spool"
+    spool.write_bytes(b"\x01" * 100 * MS)
+    dec = audio.DecodificadorPCM()
+    try:
+        dec.alimentar(str(spool))
+        assert len(_esperar_ms(lambda: dec.desde(0), 100)) == 100
+
+        with open(spool, "ab") as f:
+            f.write(b"\x02" * 200 * MS)
+        dec.alimentar(str(spool))
+        assert dec.enviados == 300 * MS
+        assert len(_esperar_ms(lambda: dec.desde(0), 300)) == 300
+
+        # Lo anterior al último corte se descarta del buffer
+        assert len(dec.desde(200)) == 100 and len(dec._pcm) == 100 * MS
+
+        with open(spool, "ab") as f:
+            f.write(b"\x03" * 50 * MS)
+        dec.alimentar(str(spool), final=True)
+        assert len(dec.desde(200)) == 150
+    finally:
+        dec.cerrar()
+
+def test_sesion_webm_no_redecodifica_el_spool(ffmpeg_falso, monkeypatch):
+    def _no(path):
+        raise AssertionError("no debe re-decodificar todo el spool")
+
+    monkeypatch.setattr(audio, "decodificar_spool", _no)
+    sesion = audio.SesionEnVivo(None, None, "n1", "audio/webm;codecs=opus")
+    try:
+        sesion.agregar(b"\x00" * 400 * MS)
+        assert len(_esperar_ms(lambda: sesion._pendiente(False), 400)) == 400
+        sesion.finalizado_ms = 300
+        sesion.agregar(b"\x00" * 100 * MS)
+        assert len(_esperar_ms(lambda: sesion._pendiente(False), 200)) == 200
+    finally:
+        sesion.decodificador.cerrar()
+        sesion.spool.close()
+
+def test_mp4_usa_el_spool_desde_el_ultimo_corte(monkeypatch):
+    from pydub import AudioSegment
+    monkeypatch.setattr(audio, "decodificar_spool", lambda path: AudioSegment.silent(duration=1000, frame_rate=16000))
+    sesion = audio.SesionEnVivo(None, None, "n1", "audio/mp4")
+    try:
+        assert sesion.decodificador is None
+        sesion.finalizado_ms = 400
+        assert len(sesion._pendiente(False)) == 600
+    finally:
+        sesion.spool.close()
@@ -0,0 +1,128 @@
+import asyncio
+import glob
+import json
+import os
+import time
+
+import pytest
+
+from common.exportador_bq import ExportadorBigQuery
+
+def _filas(nota: dict) -> dict:
+    return {"notes": [{"note_id": nota["note_id"]}], "notes_emotions": []}
+
+class ClienteBQ:
+    """insert_rows_json de prueba: registra lo insertado; puede fallar o "morir" a pedido."""
+
+    project = "p"
+
+    def __init__(self):
+        self.insertadas = []
+        self.fallar = 0
+        self.morir = False
+
+    def insert_rows_json(self, tabla, filas, row_ids=None):
+        if self.morir:
+            raise SystemExit("proceso terminado a mitad del reintento")
+        if self.fallar:
+            self.fallar -= 1
+            raise RuntimeError("BigQuery no disponible")
+        self.insertadas.extend(row_ids)
+        return []
+
+@pytest.fixture
+def cliente():
+    return ClienteBQ()
+
+def _exportador(tmp_path, cliente, **kw) -> ExportadorBigQuery:
+    return ExportadorBigQuery(cliente, "ds", str(tmp_path / "spill.ndjson"), _filas, **kw)
+
+def _reintentos(exp) -> list:
+    return glob.glob(f"{exp.spill_path}.*.reintento")
+
+def test_fallo_va_al_spill_y_se_reinserta(tmp_path, cliente):
+    exp = _exportador(tmp_path, cliente)
+    exp.encolar_nota({"note_id": "n1"})
+    cliente.fallar = 1
+    asyncio.run(exp.vaciar())
+    assert cliente.insertadas == [] and os.path.getsize(exp.spill_path) > 0
+
+    assert exp._desde_spill() == 1
+    assert len(cliente.insertadas) == 1 and cliente.insertadas[0].startswith("n1:")
+    assert not os.path.exists(exp.spill_path) and _reintentos(exp) == []
+
+def test_caida_durante_el_reintento_no_pierde_filas(tmp_path, cliente):
+    exp = _exportador(tmp_path, cliente)
+    exp.encolar_nota({"note_id": "n1"})
+    exp.encolar_nota({"note_id": "n2"})
+    cliente.fallar = 1
+    asyncio.run(exp.vaciar())
+
+    cliente.morir = True
+    with pytest.raises(SystemExit):
+        exp._desde_spill()
+    # El archivo tomado sigue en disco con sus filas
+    (tomado,) = _reintentos(exp)
+    with open(tomado, encoding="utf-8") as f:
+        assert len([json.loads(l) for l in f]) == 2
+
+    # "Reinicio": un exportador nuevo recoge el *.reintento huérfano
+    cliente.morir = False
+    nuevo = _exportador(tmp_path, cliente)
+    assert nuevo._desde_spill() == 2
+    assert sorted(i.split(":")[0] for i in cliente.insertadas) == ["n1", "n2"]
+    assert _reintentos(nuevo) == []
+
+def test_fallo_en_el_reintento_vuelve_al_spill_y_aplaza_el_siguiente(tmp_path, cliente):
+    exp = _exportador(tmp_path, cliente)
+    exp.encolar_nota({"note_id": "n1"})
+    cliente.fallar = 30
+    asyncio.run(exp.vaciar())
+    esperas = []
+    for _ in range(25):
+        exp._desde_spill()
+        esperas.append(exp.estado()["proximo_reintento_s"])
+    # Muchos intentos en poco tiempo: la fila sigue en el spill, no se rechaza
+    with open(exp.spill_path, encoding="utf-8") as f:
+        assert [json.loads(l)["intentos"] for l in f] == [26]
+    assert exp.estado()["rechazadas"] == 0
+    assert 0 < esperas[0] < esperas[3] and max(esperas) <= exp.reintento_max_s
+
+    cliente.fallar = 0
+    exp._desde_spill()
+    assert len(cliente.insertadas) == 1 and exp.estado()["proximo_reintento_s"] == 0
+
+def test_fila_que_falla_mas_alla_de_la_espera_maxima_se_rechaza(tmp_path, cliente):
+    exp = _exportador(tmp_path, cliente, max_espera_s=3600)
+    fila = {"tabla": "notes", "id": "n1:v1:0", "fila": {"note_id": "n1"}, "intentos": 3,
+            "primer_fallo": time.time() - 7200}
+    with open(exp.spill_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(fila) + "\n")
+    cliente.fallar = 1
+    exp._desde_spill()
+    assert not os.path.exists(exp.spill_path)
+    assert os.path.getsize(f"{exp.spill_path}.rechazadas") > 0
+    assert exp.estado()["rechazadas"] == 1 and cliente.insertadas == []
+
+def test_insert_id_usa_la_version_de_la_nota(tmp_path, cliente):
+    exp = _exportador(tmp_path, cliente)
+    exp.encolar_nota({"note_id": "n1", "version": 2, "texto": "a"})
+    exp.encolar_nota({"note_id": "n1", "version": 2, "texto": "a"})  # reintento de la misma versión
+    asyncio.run(exp.vaciar())
+    assert cliente.insertadas == ["n1:v2:0", "n1:v2:0"]
+
+def test_linea_cortada_no_bloquea_el_resto(tmp_path, cliente):
+    exp = _exportador(tmp_path, cliente)
+    fila = {"tabla": "notes", "id": "n1:x:0", "fila": {"note_id": "n1"}}
+    with open(exp.spill_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(fila) + "\n" + '{"tabla": "no')
+    assert exp._desde_spill() == 1
+    assert cliente.insertadas == ["n1:x:0"]
+
+def test_cierre_deja_lo_no_insertado_en_el_spill(tmp_path, cliente):
+    exp = _exportador(tmp_path, cliente)
+    exp.encolar_nota({"note_id": "n1"})
+    cliente.fallar = 1
+    asyncio.run(exp.cerrar())
+    assert exp.estado()["en_buffer"] == {"notes": 0, "notes_emotions": 0}
+    assert exp.estado()["spill_bytes"] > 0
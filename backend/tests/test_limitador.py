@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+from common.limitador import LimitadorVertex, Saturado
+
+def test_cola_llena_rechaza_con_retry_after_y_mensaje_del_servicio():
+    lim = LimitadorVertex(tpm=1000, concurrencia=1, max_cola=0, deadline_s=1, mensaje_saturado="Audio saturado.")
+
+    async def _prueba():
+        async with lim.admitir(10):
+            with pytest.raises(Saturado) as e:
+                await lim.adquirir(10)
+        return e.value
+
+    error = asyncio.run(_prueba())
+    assert error.status_code == 429 and error.detail == "Audio saturado."
+    assert int(error.headers["Retry-After"]) >= 1
+    assert lim.estado()["rechazadas"] == 1 and lim.estado()["en_curso"] == 0
+
+def test_espera_en_cola_hasta_que_se_libera():
+    lim = LimitadorVertex(tpm=1000, concurrencia=1, max_cola=4, deadline_s=5)
+    orden = []
+
+    async def _llamada(n):
+        async with lim.admitir(10):
+            orden.append(n)
+            await asyncio.sleep(0.01)
+
+    async def _prueba():
+        await asyncio.gather(*[_llamada(n) for n in range(3)])
+
+    asyncio.run(_prueba())
+    assert sorted(orden) == [0, 1, 2] and lim.estado()["admitidas"] == 3
@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from common import manifiesto as manifiesto_mod
+from common.manifiesto import Manifiesto, describir
+from common.storage import AlmacenLocal
+
+SESION = ("org", "doc", "pac", "s1")
+
+@pytest.fixture
+def almacen(tmp_path):
+    return AlmacenLocal("bucket", raiz=str(tmp_path))
+
+def _entrada(almacen, nombre: str, nota: str) -> dict:
+    ruta = almacen.ruta(*SESION, "derived", "ocr", nota, nombre)
+    data = nombre.encode()
+    return describir(almacen.put_bytes(ruta, data, "application/json"), data, nota=nota)
+
+def test_generacion_cambia_en_escrituras_del_mismo_tick(almacen):
+    generaciones = []
+    for i in range(50):
+        almacen.put_bytes("x.json", str(i).encode(), "application/json")
+        generaciones.append(almacen.metadatos("x.json")["generation"])
+    assert generaciones == sorted(set(generaciones))
+
+def test_escritura_con_generacion_vieja_se_rechaza(almacen):
+    assert almacen.leer_con_generacion("m.json") == (None, 0)
+    assert almacen.escribir_si_generacion("m.json", b"a", "application/json", 0)
+    _, gen = almacen.leer_con_generacion("m.json")
+    ruta = almacen._archivo("m.json")
+    mtime = os.stat(ruta).st_mtime_ns
+    assert almacen.escribir_si_generacion("m.json", b"b", "application/json", gen)
+    # Reloj de fs grueso (o dos escrituras en el mismo tick): el mtime no cambia
+    os.utime(ruta, ns=(mtime, mtime))
+    # Otro escritor leyó `gen` antes de la escritura anterior: debe perder
+    assert not almacen.escribir_si_generacion("m.json", b"c", "application/json", gen)
+    assert almacen.get_bytes("m.json") == b"b"
+
+def test_generacion_sigue_creciendo_si_el_objeto_se_recrea(almacen):
+    almacen.put_bytes("y.json", b"1", "application/json")
+    vieja = almacen.metadatos("y.json")["generation"]
+    almacen.borrar("y.json")
+    assert almacen.metadatos("y.json") is None
+    almacen.put_bytes("y.json", b"2", "application/json")
+    assert almacen.metadatos("y.json")["generation"] > vieja
+
+def test_registrar_con_escritores_concurrentes_no_pierde_entradas(almacen, monkeypatch):
+    monkeypatch.setattr(manifiesto_mod, "MANIFEST_RETRIES", 200)
+    m = Manifiesto(almacen)
+    errores = []
+
+    def _escritor(k: int):
+        try:
+            for i in range(10):
+                m.registrar(*SESION, [_entrada(almacen, f"ocr_{k}_{i}.json", f"n{k}")])
+        except Exception as e:  # pragma: no cover - se reporta abajo
+            errores.append(e)
+
+    hilos = [threading.Thread(target=_escritor, args=(k,)) for k in range(8)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+
+    assert errores == []
+    final = m.leer(*SESION)
+    assert len(final["objetos"]) == 80
+    assert all(Manifiesto.ultimo(final, "ocr", f"n{k}") for k in range(8))
+
+def _proceso_escritor(raiz: str, k: int) -> None:
+    manifiesto_mod.MANIFEST_RETRIES = 200
+    almacen = AlmacenLocal("bucket", raiz=raiz)
+    m = Manifiesto(almacen)
+    for i in range(10):
+        m.registrar(*SESION, [_entrada(almacen, f"ocr_{k}_{i}.json", f"n{k}")])
+
+def test_registrar_entre_procesos_no_pierde_entradas(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    procesos = [ctx.Process(target=_proceso_escritor, args=(str(tmp_path), k)) for k in range(4)]
+    for p in procesos:
+        p.start()
+    for p in procesos:
+        p.join()
+    assert all(p.exitcode == 0 for p in procesos)
+    final = Manifiesto(AlmacenLocal("bucket", raiz=str(tmp_path))).leer(*SESION)
+    assert len(final["objetos"]) == 40
+
+def test_ultimos_distingue_archivos_de_la_misma_nota(almacen):
+    m = Manifiesto(almacen)
+    entradas = []
+    for tipo, nombre in (("previews", "thumb.webp"), ("previews", "preview.webp"),
+                         ("ocr", "ocr_20250101_120000.json"), ("ocr", "ocr_20250102_080000.json")):
+        ruta = almacen.ruta(*SESION, "derived", tipo, "n1", nombre)
+        entradas.append(describir(almacen.put_bytes(ruta, b"x", "application/octet-stream"), b"x", nota="n1"))
+    final = m.registrar(*SESION, entradas)
+
+    assert Manifiesto.ultimo(final, "previews", "n1", "thumb") == "derived/previews/n1/thumb.webp"
+    assert Manifiesto.ultimo(final, "previews", "n1", "preview") == "derived/previews/n1/preview.webp"
+    assert Manifiesto.ultimo(final, "ocr", "n1") == "derived/ocr/n1/ocr_20250102_080000.json"
+
+def test_ultimo_sin_familia_toma_el_mas_reciente_de_todas():
+    m = {
+        "objetos": {
+            "derived/previews/n1/thumb.webp": {"ts": "20250101_120000"},
+            "derived/previews/n1/preview.webp": {"ts": "20250101_120500"},
+            "derived/ocr/n1/ocr_20250101_120000.json": {"ts": "20250101_120000"},
+            "derived/ocr/n1/ocr_20250102_080000.json": {"ts": "20250102_080000"},
+        },
+        "ultimos": {
+            "previews/n1/thumb": "derived/previews/n1/thumb.webp",
+            "previews/n1/preview": "derived/previews/n1/preview.webp",
+            # manifiesto viejo: clave sin familia y objeto sin ts
+            "ocr/n1": "derived/ocr/n1/ocr_20241231_235959.json",
+            "ocr/n1/ocr": "derived/ocr/n1/ocr_20250102_080000.json",
+        },
+    }
+    assert Manifiesto.ultimo(m, "previews", "n1") == "derived/previews/n1/preview.webp"
+    assert Manifiesto.ultimo(m, "ocr", "n1") == "derived/ocr/n1/ocr_20250102_080000.json"
+    assert Manifiesto.ultimo({"ultimos": {"ocr/n1": "derived/ocr/n1/ocr_x.json"}}, "ocr", "n1") == "derived/ocr/n1/ocr_x.json"
+    assert Manifiesto.ultimo(m, "ocr", "n2") is None and Manifiesto.ultimo(None, "ocr", "n1") is None
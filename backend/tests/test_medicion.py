@@ -0,0 +1,76 @@
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from common.medicion import Medidor, fijar_alcance
+from common.storage import AlmacenLocal
+
+PRECIOS = {"m1": {"entrada": 1.0, "salida": 2.0}}
+
+def _respuesta(entrada: int, salida: int):
+    return SimpleNamespace(usage_metadata=SimpleNamespace(prompt_token_count=entrada, candidates_token_count=salida))
+
+def test_registra_costo_alcance_y_hora_utc(tmp_path):
+    almacen = AlmacenLocal("bucket", raiz=str(tmp_path))
+    medidor = Medidor("analisis", "gcs", 10, modelo="m1", precios=PRECIOS, almacen=almacen)
+    fijar_alcance("org_a", "doc", "s1", "n1")
+    medidor.registrar("analisis", _respuesta(1_000_000, 500_000), 12.5)
+
+    (fila,) = medidor.pendientes
+    assert fila["org_id"] == "org_a" and fila["costo_usd"] == 2.0
+    assert fila["ts"].endswith("Z")
+    ts = datetime.fromisoformat(fila["ts"][:-1]).replace(tzinfo=timezone.utc)
+    assert abs(datetime.now(timezone.utc) - ts) < timedelta(minutes=1)
+
+    medidor.enviar()
+    (obj,) = list(almacen.listar("_metering/analisis/"))
+    assert obj["ruta"].startswith(f"_metering/analisis/ds={fila['ts'][:10]}/")
+    assert json.loads(almacen.get_text(obj["ruta"]))["note_id"] == "n1"
+    assert medidor.estado()["costo_usd"] == 2.0 and medidor.pendientes == []
+
+def test_bigquery_sin_tabla_se_rechaza_al_arrancar():
+    with pytest.raises(ValueError):
+        Medidor("audio", "bigquery", 10, modelo="m1", precios=PRECIOS)
+    with pytest.raises(ValueError):
+        Medidor("audio", "kafka", 10, modelo="m1", precios=PRECIOS)
+    with pytest.raises(ValueError):
+        Medidor("audio", "gcs", 10, modelo="m1", precios=PRECIOS)
+    assert Medidor("audio", "bigquery", 10, modelo="m1", precios=PRECIOS, bq_tabla="p.d.t").sink == "bigquery"
+
+def test_lote_que_cruza_la_medianoche_se_parte_por_dia(tmp_path):
+    almacen = AlmacenLocal("bucket", raiz=str(tmp_path))
+    medidor = Medidor("audio", "gcs", 10, modelo="m1", precios=PRECIOS, almacen=almacen)
+    for ts in ("2026-03-01T23:59:59.900Z", "2026-03-02T00:00:00.100Z", "2026-03-02T00:00:01.000Z"):
+        medidor.pendientes.append({"ts": ts, "note_id": ts})
+    medidor.enviar()
+
+    por_dia = {}
+    for obj in almacen.listar("_metering/audio/"):
+        ds = obj["ruta"].split("/")[2]
+        por_dia[ds] = [json.loads(l)["ts"][:10] for l in almacen.get_text(obj["ruta"]).splitlines()]
+    assert por_dia == {"ds=2026-03-01": ["2026-03-01"], "ds=2026-03-02": ["2026-03-02", "2026-03-02"]}
+    assert medidor.pendientes == []
+
+def test_particion_fallida_vuelve_a_la_cola(tmp_path):
+    almacen = AlmacenLocal("bucket", raiz=str(tmp_path))
+    subir = almacen.put_bytes
+
+    def put_bytes(path, *args, **kwargs):
+        if "ds=2026-03-02" in path:
+            raise OSError("sin red")
+        return subir(path, *args, **kwargs)
+
+    almacen.put_bytes = put_bytes
+    medidor = Medidor("audio", "gcs", 10, modelo="m1", precios=PRECIOS, almacen=almacen)
+    medidor.pendientes = [{"ts": "2026-03-01T23:59:59.900Z"}, {"ts": "2026-03-02T00:00:00.100Z"}]
+    medidor.enviar()
+    assert medidor.pendientes == [{"ts": "2026-03-02T00:00:00.100Z"}] and medidor.envios_fallidos == 1
+    assert len(list(almacen.listar("_metering/audio/ds=2026-03-01/"))) == 1
+
+def test_sink_none_solo_agrega():
+    medidor = Medidor("audio", "none", 10, modelo="m1", precios=PRECIOS)
+    medidor.registrar("transcripcion", _respuesta(10, 5), 3.0)
+    assert medidor.pendientes == [] and not medidor.debe_enviar()
+    assert medidor.estado()["tokens_entrada"] == 10
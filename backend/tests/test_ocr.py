@@ -0,0 +1,107 @@
+import asyncio
+import io
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("multipart")
+ocr = pytest.importorskip("ocr")
+from fastapi import HTTPException
+
+class MotorFalso(ocr.OCREngine):
+    def __init__(self, name, texto="texto", confianza=0.9, error=None):
+        self.name = name
+        self.texto, self.confianza, self.error = texto, confianza, error
+        self.llamadas = 0
+
+    def extract(self, image_bytes, gcs_uri):
+        self.llamadas += 1
+        if self.error:
+            raise self.error
+        return {"texto": self.texto, "confianza": self.confianza, "motor": self.name}
+
+@pytest.fixture
+def motores(monkeypatch):
+    m = {"vision": MotorFalso("vision"), "tesseract": MotorFalso("tesseract")}
+    monkeypatch.setattr(ocr, "OCR_ENGINES", m)
+    return m
+
+def _png(pixeles) -> bytes:
+    Image = pytest.importorskip("PIL.Image")
+    img = Image.new("L", (len(pixeles[0]), len(pixeles)))
+    img.putdata([v for fila in pixeles for v in fila])
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+def test_motor_base_es_abstracto():
+    with pytest.raises(TypeError):
+        ocr.OCREngine()
+
+def test_router_distingue_impreso_de_foto():
+    impreso = _png([[0 if (x // 8 + y // 8) % 2 else 255 for x in range(64)] for y in range(64)])
+    foto = _png([[100 + (x + y) % 60 for x in range(64)] for y in range(64)])
+    assert ocr.es_imagen_limpia(impreso)
+    assert not ocr.es_imagen_limpia(foto)
+    assert not ocr.es_imagen_limpia(b"no es una imagen")
+
+def test_auto_usa_tesseract_en_imagen_limpia(motores, monkeypatch):
+    monkeypatch.setattr(ocr, "es_imagen_limpia", lambda b: True)
+    assert ocr.ejecutar_ocr("auto", b"img", None)["motor"] == "tesseract"
+    assert motores["vision"].llamadas == 0
+
+@pytest.mark.parametrize("limpia, tesseract", [
+    (False, MotorFalso("tesseract")),                                         # foto → Vision directo
+    (True, MotorFalso("tesseract", confianza=0.2)),                           # confianza baja → escala
+    (True, MotorFalso("tesseract", texto="")),                                # sin texto → escala
+    (True, MotorFalso("tesseract", error=HTTPException(status_code=501))),    # no instalado → escala
+])
+def test_auto_escala_a_vision(motores, monkeypatch, limpia, tesseract):
+    motores["tesseract"] = tesseract
+    monkeypatch.setattr(ocr, "es_imagen_limpia", lambda b: limpia)
+    assert ocr.ejecutar_ocr("auto", b"img", None)["motor"] == "vision"
+
+def test_auto_sin_bytes_va_a_vision_y_errores_reales_se_propagan(motores, monkeypatch):
+    assert ocr.ejecutar_ocr("auto", None, "gs://b/x.jpg")["motor"] == "vision"
+    assert motores["tesseract"].llamadas == 0
+
+    motores["tesseract"] = MotorFalso("tesseract", error=HTTPException(status_code=500, detail="roto"))
+    monkeypatch.setattr(ocr, "es_imagen_limpia", lambda b: True)
+    with pytest.raises(HTTPException) as e:
+        ocr.ejecutar_ocr("auto", b"img", None)
+    assert e.value.status_code == 500
+
+def test_motor_explicito_y_desconocido(motores):
+    assert ocr.ejecutar_ocr("tesseract", b"img", None)["motor"] == "tesseract"
+    with pytest.raises(HTTPException) as e:
+        ocr.ejecutar_ocr("easyocr", b"img", None)
+    assert e.value.status_code == 400
+
+@pytest.fixture
+def almacen_local(monkeypatch, tmp_path):
+    from common.manifiesto import Manifiesto
+    from common.storage import AlmacenLocal
+    almacen = AlmacenLocal("bucket", raiz=str(tmp_path))
+    monkeypatch.setattr(ocr, "ALMACEN", almacen)
+    monkeypatch.setattr(ocr, "MANIFIESTO", Manifiesto(almacen))
+    return almacen
+
+SESION = ("org", "doc", "pac", "ses")
+
+def test_previews_se_suben_acotados_y_quedan_en_el_manifiesto(almacen_local):
+    Image = pytest.importorskip("PIL.Image")
+    foto = io.BytesIO()
+    Image.new("RGB", (3000, 1500), (120, 80, 40)).save(foto, format="PNG")
+    asyncio.run(ocr.generar_previews(foto.getvalue(), None, *SESION, "n1"))
+
+    m = ocr.MANIFIESTO.leer(*SESION)
+    for size, px in ocr.PREVIEW_SIZES.items():
+        relativa = ocr.Manifiesto.ultimo(m, "previews", "n1", size)
+        assert relativa == f"derived/previews/n1/{size}.webp"
+        img = Image.open(io.BytesIO(almacen_local.get_bytes(ocr.preview_object_path(*SESION, "n1", size))))
+        assert img.format == "WEBP" and max(img.size) == px
+
+def test_previews_fallidos_solo_se_registran(almacen_local, caplog):
+    asyncio.run(ocr.generar_previews(b"no es una imagen", None, *SESION, "n1"))
+    assert "No se pudieron generar previews para nota n1" in caplog.text
+    assert ocr.Manifiesto.ultimo(ocr.MANIFIESTO.leer(*SESION), "previews", "n1", "thumb") is None
@@ -0,0 +1,23 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from rellenar_orden import faltantes
+
+AHORA = object()  # marcador de SERVER_TIMESTAMP
+
+def test_sesion_sin_campos_de_orden_los_toma_de_sus_otros_timestamps():
+    firma = datetime(2025, 3, 2, tzinfo=timezone.utc)
+    rollup = datetime(2025, 3, 1, tzinfo=timezone.utc)
+    datos = {"signed_at_ts": firma, "rollup": {"updated_at": rollup}}
+    assert faltantes("sessions", datos, AHORA) == {"created_at": rollup, "updated_at": firma}
+    assert faltantes("sessions", {}, AHORA) == {"created_at": AHORA, "updated_at": AHORA}
+    assert faltantes("sessions", {"created_at": rollup, "updated_at": firma}, AHORA) == {}
+
+def test_pacientes_y_notas():
+    assert faltantes("patients", {}, AHORA) == {"fullName": ""}
+    assert faltantes("patients", {"fullName": "Ana"}, AHORA) == {}
+    procesada = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    assert faltantes("notes", {"processed_at": procesada}, AHORA) == {"created_at": procesada}
+    with pytest.raises(ValueError):
+        faltantes("orgs", {}, AHORA)
@@ -0,0 +1,18 @@
+import pytest
+
+from common import storage
+from common.storage import AlmacenLocal
+
+def test_get_bytes_devuelve_bytes_y_abrir_una_vista(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "MMAP_MIN_BYTES", 16)
+    almacen = AlmacenLocal("bucket", raiz=str(tmp_path))
+    datos = bytes(range(256)) * 4
+    uri = almacen.put_bytes("org/audio/a.webm", datos, "audio/webm")
+
+    leido = almacen.get_bytes(uri)
+    assert type(leido) is bytes and leido == datos
+    with almacen.abrir(uri) as buf:
+        assert isinstance(buf, memoryview) and buf[:4] == datos[:4] and len(buf) == len(datos)
+
+    with pytest.raises(FileNotFoundError, match="gs://bucket/org/audio/otro.webm"):
+        almacen.get_bytes("org/audio/otro.webm")
@@ -4,7 +4,6 @@ import { useNavigate } from "react-router-dom";
 import { useAuth } from "../context/AuthContext";
 import { db } from "../services/firebaseConfig";
 import {
-  collection,
   collectionGroup,
   getDocs,
   orderBy,
@@ -15,6 +14,7 @@ import AppLayout from "../components/AppLayout";
 import AppSidebar from "../components/AppSidebar";
 import LoadingOverlay from "../components/LoadingOverlay";
 import { useDoctorProfile } from "../services/userDoctorProfile";
+import { listPatients } from "../services/orchestrator";
 
 // ——— estilos embebidos
 const pageCSS = `
@@ -307,16 +307,19 @@ export default function NotesList() {
     async function loadPatients() {
       if (!uid || !orgId) return;
       try {
-        const colRef = collection(db, "orgs", orgId, "doctors", uid, "patients");
-        const snap = await getDocs(colRef);
-        if (!alive) return;
         const map = {};
-        snap.forEach((d) => {
-          map[d.id] = {
-            fullName: d.data()?.fullName || d.id,
-            id: d.id,
-          };
-        });
+        let cursor = null;
+        do {
+          const page = await listPatients({ org_id: orgId, limit: 100, cursor });
+          if (!alive) return;
+          page.items.forEach((p) => {
+            map[p.id] = {
+              fullName: p.fullName || p.id,
+              id: p.id,
+            };
+          });
+          cursor = page.next_cursor;
+        } while (cursor);
         setPatientsMap(map);
       } catch {
         // noop
@@ -2,8 +2,7 @@
 import React, { useEffect, useMemo, useState } from "react";
 import { useNavigate } from "react-router-dom";
 import { useAuth } from "../context/AuthContext";
-import { db } from "../services/firebaseConfig";
-import { collection, getDocs, orderBy, query } from "firebase/firestore";
+import { listPatients } from "../services/orchestrator";
 
 import AppLayout from "../components/AppLayout";
 import LoadingOverlay from "../components/LoadingOverlay";
@@ -232,11 +231,16 @@ export default function PatientList() {
         setErr("");
         setPatients([]);
         if (!uid || !orgId) { setLoading(false); return; }
-        const colRef = collection(db, "orgs", orgId, "doctors", uid, "patients");
-        const qy = query(colRef, orderBy("fullName"));
-        const snap = await getDocs(qy);
+        // Paginado en el orquestador (solo campos de listado): se muestra la primera página
+        // y el resto se va agregando
+        let page = await listPatients({ org_id: orgId, limit: 50 });
         if (!alive) return;
-        setPatients(snap.docs.map((d) => ({ id: d.id, ...d.data() })));
+        setPatients(page.items);
+        setLoading(false);
+        while (page.next_cursor && alive) {
+          page = await listPatients({ org_id: orgId, limit: 50, cursor: page.next_cursor });
+          if (alive) setPatients((prev) => [...prev, ...page.items]);
+        }
       } catch (e) {
         console.error("Error cargando pacientes:", e);
         if (alive) setErr("No se pudieron cargar los pacientes.");
@@ -3,11 +3,11 @@ import React, { useEffect, useMemo, useState } from "react";
 import { useLocation, useNavigate } from "react-router-dom";
 import { useAuth } from "../context/AuthContext";
 import { db } from "../services/firebaseConfig";
-import { doc, getDoc, collection, query, orderBy, limit, getDocs } from "firebase/firestore";
+import { doc, getDoc } from "firebase/firestore";
 
 import AppLayout from "../components/AppLayout";
 import LoadingOverlay from "../components/LoadingOverlay";
-import { finalizarSesionYGenerarNota } from "../services/orchestrator";
+import { finalizarSesionYGenerarNota, getNoteText, listSessionNotes } from "../services/orchestrator";
 
 
 const ToastBubble = ({ type = "info", title, message, actionLabel, onAction, onClose }) => {
@@ -97,6 +97,7 @@ export default function PatientProgressNoteOverview() {
 
   const [patient, setPatient] = useState(null);
   const [note, setNote] = useState(null);
+  const [fullText, setFullText] = useState(""); // texto completo si la nota solo trae preview
   const [loading, setLoading] = useState(true);
   const [err, setErr] = useState("");
   const [saving, setSaving] = useState(false);
@@ -268,14 +269,12 @@ export default function PatientProgressNoteOverview() {
           if (alive) setPatient(pSnap.exists() ? { id: pSnap.id, ...pSnap.data() } : null);
         }
         if (user?.uid && orgId && patientId && sessionId) {
-          const notesQuery = query(
-            collection(db, "orgs", orgId, "doctors", user.uid, "patients", patientId, "sessions", sessionId, "notes"),
-            orderBy("created_at", "desc"),
-            limit(1)
-          );
-          const qs = await getDocs(notesQuery);
-          if (alive && !qs.empty) setNote({ id: qs.docs[0].id, ...qs.docs[0].data() });
-          else if (alive) setNote(null);
+          // Última nota, proyectada: preview del texto + emociones (el completo va por getNoteText)
+          const page = await listSessionNotes({
+            org_id: orgId, patient_id: patientId, session_id: sessionId, limit: 1, campos: "emotions",
+          });
+          const last = page.items[0];
+          if (alive) setNote(last ? { ...last, ocr_text: last.preview } : null);
         }
       } catch (e) {
         console.error(e);
@@ -285,6 +284,18 @@ export default function PatientProgressNoteOverview() {
     loadAll(); return () => { alive = false; };
   }, [user?.uid, orgId, patientId, sessionId, noteId]);
 
+  // Texto largo: Firestore guarda un preview; el completo se pide solo al abrir el detalle
+  useEffect(() => {
+    let alive = true;
+    setFullText("");
+    if (note?.text_truncated && orgId && patientId && sessionId) {
+      getNoteText({ org_id: orgId, patient_id: patientId, session_id: sessionId, note_id: note.id })
+        .then((r) => { if (alive) setFullText(r?.texto || ""); })
+        .catch((e) => console.error(e));
+    }
+    return () => { alive = false; };
+  }, [note?.id, note?.text_truncated, orgId, patientId, sessionId]);
+
   // ---------- normalización de análisis ----------
   const { emotions, analysisRaw, analysisSource } = useMemo(() => {
     const rawFromState = state?.analisis ?? null;
@@ -309,8 +320,8 @@ export default function PatientProgressNoteOverview() {
   }, [state?.analisis, note?.emotions]);
 
   const extractedText = useMemo(
-    () => (state?.text || state?.texto || note?.ocr_text || "").trim(),
-    [state?.text, state?.texto, note?.ocr_text]
+    () => (state?.text || state?.texto || fullText || note?.ocr_text || "").trim(),
+    [state?.text, state?.texto, fullText, note?.ocr_text]
   );
 
   // ---------- firmar + pdf ----------
@@ -70,14 +70,16 @@ function postMultipartXHR({ endpoint, formData, idToken, onProgress }) {
  * @param {File | null} params.file
  * @param {string | null} params.gcs_uri
  * @param {boolean} params.analyze_now
+ * @param {string} [params.note_id] - UUID fijado por el cliente (para seguir el progreso).
  * @returns {FormData}
  */
-function buildFormData({ org_id, patient_id, session_id, file, gcs_uri, analyze_now }) {
+function buildFormData({ org_id, patient_id, session_id, file, gcs_uri, analyze_now, note_id }) {
   const fd = new FormData();
   fd.append("org_id", org_id);
   fd.append("patient_id", patient_id);
   fd.append("session_id", session_id);
   fd.append("analyze_now", analyze_now ? "true" : "false");
+  if (note_id) fd.append("note_id", note_id);
   if (file) fd.append("file", file);
   else if (gcs_uri) fd.append("gcs_uri", gcs_uri);
   else throw new Error("Debes enviar file o gcs_uri");
@@ -94,10 +96,11 @@ function buildFormData({ org_id, patient_id, session_id, file, gcs_uri, analyze_
  * @param {string | null} params.gcs_uri
  * @param {string} params.idToken
  * @param {(loaded: number) => void} [params.onProgress]
+ * @param {string} [params.note_id]
  * @returns {Promise<object>}
  */
-export async function orchestratePhotoPre({ org_id, patient_id, session_id, file, gcs_uri, idToken, onProgress }) {
-  const fd = buildFormData({ org_id, patient_id, session_id, file, gcs_uri, analyze_now: false });
+export async function orchestratePhotoPre({ org_id, patient_id, session_id, file, gcs_uri, idToken, onProgress, note_id }) {
+  const fd = buildFormData({ org_id, patient_id, session_id, file, gcs_uri, analyze_now: false, note_id });
   return await postMultipartXHR({ endpoint: "/orquestar_foto", formData: fd, idToken, onProgress });
 }
 
@@ -111,13 +114,40 @@ export async function orchestratePhotoPre({ org_id, patient_id, session_id, file
  * @param {string | null} params.gcs_uri
  * @param {string} params.idToken
  * @param {(loaded: number) => void} [params.onProgress]
+ * @param {string} [params.note_id]
  * @returns {Promise<object>}
  */
-export async function orchestrateAudioPre({ org_id, patient_id, session_id, file, gcs_uri, idToken, onProgress }) {
-  const fd = buildFormData({ org_id, patient_id, session_id, file, gcs_uri, analyze_now: false });
+export async function orchestrateAudioPre({ org_id, patient_id, session_id, file, gcs_uri, idToken, onProgress, note_id }) {
+  const fd = buildFormData({ org_id, patient_id, session_id, file, gcs_uri, analyze_now: false, note_id });
   return await postMultipartXHR({ endpoint: "/orquestar_audio", formData: fd, idToken, onProgress });
 }
 
+/**
+ * Se suscribe (SSE) al progreso del pipeline de una nota: etapas del orquestador y de
+ * los servicios (subiendo_gcs, preprocesando, modelo con segmento k de n, persistiendo...).
+ * Generar el note_id con crypto.randomUUID(), abrir esto y luego enviar el archivo con ese note_id.
+ * Si el pipeline falla llega un evento {type: "error", status, detail} y la suscripción se cierra.
+ * @param {object} params
+ * @param {string} params.note_id
+ * @param {string} params.idToken
+ * @param {(evt: object) => void} params.onEvent
+ * @returns {EventSource} Llamar .close() al terminar.
+ */
+export function subscribeProgress({ note_id, idToken, onEvent }) {
+  const qs = new URLSearchParams({ token: idToken });
+  const es = new EventSource(`${BASE}/progreso/${encodeURIComponent(note_id)}?${qs}`);
+  const handler = (e) => {
+    if (!e.data) return; // "error" nativo de EventSource (reconexión), sin payload
+    let evt = {};
+    try { evt = JSON.parse(e.data); } catch {}
+    if (typeof onEvent === "function") onEvent(evt);
+    if (evt.servicio === "orquestador" && (evt.type === "error" || evt.etapa === "completado")) es.close();
+  };
+  es.addEventListener("progress", handler);
+  es.addEventListener("error", handler); // {"type": "error", status, detail}: el pipeline falló
+  return es;
+}
+
 /**
  * Guarda la nota final (texto editado) y solicita el análisis final.
  * @param {object} params
@@ -146,6 +176,215 @@ export async function saveFinalNote({ org_id, patient_id, session_id, note_id, t
   return await res.json();
 }
 
+/**
+ * Obtiene una URL firmada para el thumbnail/preview WebP de una nota de imagen.
+ * Usar en listas en lugar de la imagen raw (KB en vez de MB).
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {string} params.patient_id
+ * @param {string} params.session_id
+ * @param {string} params.note_id
+ * @param {"thumb" | "preview"} [params.size]
+ * @param {string} params.idToken
+ * @returns {Promise<{url: string, expires_in_seconds: number}>}
+ */
+export async function getSignedPreviewUrl({ org_id, patient_id, session_id, note_id, size = "thumb", idToken }) {
+  const res = await fetch(`${BASE}/signed_preview_url`, {
+    method: "POST",
+    headers: {
+      Authorization: `Bearer ${idToken}`,
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify({ org_id, patient_id, session_id, note_id, size }),
+  });
+  if (!res.ok) {
+    const err = await res.json().catch(() => ({}));
+    throw new Error(err?.detail || res.statusText);
+  }
+  return await res.json();
+}
+
+/**
+ * Artefactos de una sesión (raw y derivados) leídos del manifiesto de la sesión.
+ * Con `tipo` + `note_id` incluye `ultimo`: el objeto más reciente de ese tipo para la nota
+ * (con `familia`, solo entre los archivos de ese nombre, p. ej. "thumb" o "preview").
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {string} params.patient_id
+ * @param {string} params.session_id
+ * @param {string} [params.tipo] - "raw" | "ocr" | "transcription" | "analisis" | "previews"
+ * @param {string} [params.note_id]
+ * @param {string} [params.familia] - nombre del archivo sin sello ni extensión
+ * @param {string} params.idToken
+ * @returns {Promise<{session_id: string, actualizado: string, objetos: object[], ultimo?: object | null}>}
+ */
+export async function getSessionArtifacts({ org_id, patient_id, session_id, tipo, note_id, familia, idToken }) {
+  const qs = new URLSearchParams({ org_id, patient_id });
+  if (tipo) qs.set("tipo", tipo);
+  if (note_id) qs.set("note_id", note_id);
+  if (familia) qs.set("familia", familia);
+  const res = await fetch(`${BASE}/sesion/${encodeURIComponent(session_id)}/artefactos?${qs}`, {
+    headers: { Authorization: `Bearer ${idToken}` },
+  });
+  if (!res.ok) {
+    const err = await res.json().catch(() => ({}));
+    throw new Error(err?.detail || res.statusText);
+  }
+  return await res.json();
+}
+
+/**
+ * Texto completo de una nota. Los documentos de Firestore solo traen un preview
+ * (`text_truncated: true`) cuando el texto es largo; la vista de detalle lo pide aquí.
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {string} params.patient_id
+ * @param {string} params.session_id
+ * @param {string} params.note_id
+ * @returns {Promise<{note_id: string, texto: string, text_len: number, text_sha256: string | null}>}
+ */
+export async function getNoteText({ org_id, patient_id, session_id, note_id }) {
+  const token = await getAuthToken();
+  const qs = new URLSearchParams({ org_id, patient_id, session_id });
+  const res = await fetch(`${BASE}/nota/${encodeURIComponent(note_id)}/texto?${qs}`, {
+    headers: { Authorization: `Bearer ${token}` },
+  });
+  if (!res.ok) {
+    const err = await res.json().catch(() => ({}));
+    throw new Error(err?.detail || res.statusText);
+  }
+  return await res.json();
+}
+
+// ETag por URL: con If-None-Match el orquestador responde 304 y se reutiliza lo ya recibido
+const listCache = new Map();
+
+/**
+ * GET JSON autenticado con revalidación por ETag.
+ * @param {string} path - Ruta con query string.
+ * @returns {Promise<object>}
+ */
+async function getJsonWithEtag(path) {
+  const token = await getAuthToken();
+  const cached = listCache.get(path);
+  const headers = { Authorization: `Bearer ${token}` };
+  if (cached?.etag) headers["If-None-Match"] = cached.etag;
+  const res = await fetch(`${BASE}${path}`, { headers });
+  if (res.status === 304 && cached) return cached.data;
+  if (!res.ok) {
+    const err = await res.json().catch(() => ({}));
+    throw new Error(err?.detail || res.statusText);
+  }
+  const data = await res.json();
+  const etag = res.headers.get("ETag");
+  if (etag) listCache.set(path, { etag, data });
+  return data;
+}
+
+/**
+ * @param {Record<string, string | number | undefined>} params
+ * @returns {string}
+ */
+function listQuery(params) {
+  const qs = new URLSearchParams();
+  Object.entries(params).forEach(([k, v]) => { if (v !== undefined && v !== null && v !== "") qs.set(k, String(v)); });
+  return qs.toString();
+}
+
+/**
+ * Página de pacientes del doctor (orden por fullName), solo campos de listado.
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {number} [params.limit] - Tamaño de página (máx. 100).
+ * @param {string | null} [params.cursor] - `next_cursor` de la página anterior.
+ * @param {string} [params.campos] - Campos extra separados por coma (ej: "age,gender").
+ * @returns {Promise<{items: object[], next_cursor: string | null, limit: number}>}
+ */
+export async function listPatients({ org_id, limit, cursor, campos }) {
+  return await getJsonWithEtag(`/pacientes?${listQuery({ org_id, limit, cursor, campos })}`);
+}
+
+/**
+ * Página de sesiones de un paciente con el resumen del rollup (sin notas), más recientes primero
+ * (updated_at: última nota o firma).
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {string} params.patient_id
+ * @param {number} [params.limit]
+ * @param {string | null} [params.cursor]
+ * @param {string} [params.campos] - Ej: "rollup.latest_emotions,evolution_note_txt".
+ * @returns {Promise<{items: object[], next_cursor: string | null, limit: number}>}
+ */
+export async function listSessions({ org_id, patient_id, limit, cursor, campos }) {
+  const qs = listQuery({ org_id, limit, cursor, campos });
+  return await getJsonWithEtag(`/pacientes/${encodeURIComponent(patient_id)}/sesiones?${qs}`);
+}
+
+/**
+ * Página de notas de una sesión (más recientes primero). Cada nota trae `preview` en lugar
+ * del texto completo; si `text_truncated` es true, pedirlo con getNoteText.
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {string} params.patient_id
+ * @param {string} params.session_id
+ * @param {number} [params.limit]
+ * @param {string | null} [params.cursor]
+ * @param {string} [params.campos] - Ej: "emotions".
+ * @returns {Promise<{items: object[], next_cursor: string | null, limit: number}>}
+ */
+export async function listSessionNotes({ org_id, patient_id, session_id, limit, cursor, campos }) {
+  const qs = listQuery({ org_id, patient_id, limit, cursor, campos });
+  return await getJsonWithEtag(`/sesion/${encodeURIComponent(session_id)}/notas?${qs}`);
+}
+
+/**
+ * Tendencia de emociones del paciente (series por ventana desde la serie diaria).
+ * paso=1 → media móvil de `ventana` días; paso=ventana → bloques (ej: semanas).
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {string} params.patient_id
+ * @param {string} [params.emociones] - Separadas por coma (ej: "tristeza,estres"). Por defecto todas.
+ * @param {string} [params.desde] - YYYY-MM-DD.
+ * @param {string} [params.hasta] - YYYY-MM-DD.
+ * @param {number} [params.ventana] - Días por ventana (7 por defecto).
+ * @param {number} [params.paso] - Días entre ventanas (1 por defecto).
+ * @returns {Promise<{inicio: string[], fin: string[], notas: number[], emociones: Record<string, {media: (number|null)[], n: number[], max: number[]}>}>}
+ */
+export async function getPatientTrend({ org_id, patient_id, emociones, desde, hasta, ventana, paso }) {
+  const qs = listQuery({ org_id, emociones, desde, hasta, ventana, paso });
+  return await getJsonWithEtag(`/pacientes/${encodeURIComponent(patient_id)}/tendencia?${qs}`);
+}
+
+/**
+ * Abre una transcripción en vivo por WebSocket mientras se graba la sesión.
+ * Enviar los chunks del MediaRecorder con `send(blob)` y llamar `stop()` al terminar:
+ * el servidor responde con mensajes "partial"/"final" y al final "done" con la
+ * transcripción completa (ya guardada bajo sessions/{session_id}).
+ * @param {object} params
+ * @param {string} params.org_id
+ * @param {string} params.patient_id
+ * @param {string} params.session_id
+ * @param {string} params.idToken
+ * @param {string} [params.mime] - mimeType del MediaRecorder (ej: audio/webm).
+ * @param {(msg: object) => void} params.onMessage
+ * @returns {{ socket: WebSocket, send: (chunk: Blob) => void, stop: () => void }}
+ */
+export function openLiveTranscription({ org_id, patient_id, session_id, idToken, mime = "audio/webm", onMessage }) {
+  const qs = new URLSearchParams({ token: idToken, org_id, patient_id, session_id, mime });
+  const socket = new WebSocket(`${BASE.replace(/^http/, "ws")}/ws/transcribir?${qs}`);
+  socket.binaryType = "arraybuffer";
+  socket.onmessage = (e) => {
+    let msg = {};
+    try { msg = JSON.parse(e.data); } catch {}
+    if (typeof onMessage === "function") onMessage(msg);
+  };
+  return {
+    socket,
+    send: (chunk) => { if (socket.readyState === WebSocket.OPEN && chunk?.size) socket.send(chunk); },
+    stop: () => { if (socket.readyState === WebSocket.OPEN) socket.send(JSON.stringify({ type: "stop" })); },
+  };
+}
+
 // --- FUNCIÓN FINALIZAR SESIÓN (ADAPTADA) ---
 
 /**